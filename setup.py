@@ -14,7 +14,7 @@ setup(
     author="David Reed",
     author_email="david@ktema.org",
     packages=["trapeza", "trapeza.formats"],
-    scripts=["trapeza-sheet.py", "trapeza-match.py", "trapeza-process.py"],
+    scripts=["trapeza-sheet.py", "trapeza-match.py", "trapeza-process.py", "trapeza-serve.py"],
     license="MIT",
     install_requires=["Python >= 2.7"],
     long_description=open("README.md").read())
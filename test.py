@@ -6,10 +6,43 @@
 #  This file is available under the terms of the MIT License.
 
 import StringIO
+import argparse
+import cPickle
+import imp
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import trapeza
+import trapeza.cache
+import trapeza.checkpoint
 import trapeza.match
+import trapeza.offsets
+import trapeza.phonetic
+import trapeza.pipeline
+import trapeza.service
+import trapeza.shards
+import trapeza.stats
 import unittest
 
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sheet = imp.load_source("trapeza_sheet", os.path.join(_DIRECTORY, "trapeza-sheet.py"))
+match_script = imp.load_source("trapeza_match", os.path.join(_DIRECTORY, "trapeza-match.py"))
+
+
+def run_script(name, arguments, stdin=None, directory=None):
+    # Runs one of the trapeza-*.py scripts, returning (exit status, standard output, standard error).
+    process = subprocess.Popen([sys.executable, os.path.join(_DIRECTORY, name)] + arguments, cwd=directory,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (out, err) = process.communicate(stdin)
+
+    return (process.returncode, out, err)
+
 
 class TestTrapeza(unittest.TestCase):
 
@@ -94,6 +127,9 @@ class TestTrapeza(unittest.TestCase):
         self.assertEqual(trapeza.get_format("test.tsv"), "tsv")
         self.assertEqual(trapeza.get_format("test"), "csv")
         self.assertEqual(trapeza.get_format("test", "chr"), "chr")
+        self.assertEqual(trapeza.get_format("test.TSV.gz"), "tsv.gz")
+        self.assertEqual(trapeza.get_format("test.bz2", "tsv"), "tsv.bz2")
+        self.assertEqual(trapeza.get_format("test.xz", "csv.gz"), "csv.xz")
         
     def test_unify_sources(self):
         a = trapeza.Source([u"Name", u"ID", u"Email"])
@@ -125,6 +161,158 @@ class TestTrapeza(unittest.TestCase):
         b.set_primary_key(u"ID")
         self.assertEqual(b.get_record_with_id(u"5").values[u"Name"], u"Εὐθύφρων")
 
+    def test_compression(self):
+        s = trapeza.Source([u"Name", u"ID"])
+        for i in range(1000):
+            s.add_record(trapeza.Record({u"Name": u"Zoë {}".format(i), u"ID": unicode(i)}))
+
+        for compression in ["gz", "bz2"]:
+            of = StringIO.StringIO()
+            trapeza.write_source(s, of, "tsv." + compression)
+            self.assertEqual(trapeza.formats.split_format("tsv." + compression), ("tsv", compression))
+
+            a = trapeza.load_source(StringIO.StringIO(of.getvalue()), "tsv." + compression)
+            self.assertEqual([record.values for record in a.records()], [record.values for record in s.records()])
+
+            # Appended streams are read in turn.
+            trapeza.write_records(s.headers(), s.records()[:2], of, "tsv." + compression, write_header=False)
+            reader = trapeza.formats.CompressedReader(StringIO.StringIO(of.getvalue()), compression, threaded=False,
+                                                      chunk_size=7)
+            self.assertEqual(len(reader.read().splitlines()), 1003)
+
+            # A truncated file is an error, even where every row it holds is complete.
+            for cut in [1, 8, len(of.getvalue()) // 2]:
+                for threaded in [False, True]:
+                    reader = trapeza.formats.CompressedReader(StringIO.StringIO(of.getvalue()[:-cut]), compression,
+                                                              threaded=threaded)
+                    with self.assertRaises(Exception):
+                        reader.read()
+
+    def test_iterate_source(self):
+        test_data = u"Name,ID\r\nTim,1\rMary,2\nZoë,3\r\n".encode("latin-1")
+        (headers, records) = trapeza.iterate_source(StringIO.StringIO(test_data), "csv", encoding="latin-1")
+        self.assertEqual(headers, [u"Name", u"ID"])
+
+        records = list(records)
+        self.assertEqual([record.values[u"ID"] for record in records], [u"1", u"2", u"3"])
+        self.assertEqual([record.input_line() for record in records], [1, 2, 3])
+
+        of = StringIO.StringIO()
+        trapeza.write_records(headers, iter(records), of, "csv", encoding="utf-8")
+        self.assertEqual(of.getvalue(), u"Name,ID\r\nTim,1\r\nMary,2\r\nZoë,3\r\n".encode("utf-8"))
+
+    def test_load_columns(self):
+        test_data = "Name,Donations,ID\nTim,500,1\n\nMary,125.3,2\n"
+
+        a = trapeza.load_source(StringIO.StringIO(test_data), "csv", columns=[u"ID", u"Name", u"Missing"])
+        self.assertEqual(a.headers(), [u"Name", u"ID"])
+        self.assertEqual([record.values for record in a.records()],
+                         [{u"Name": u"Tim", u"ID": u"1"}, {u"Name": u"Mary", u"ID": u"2"}])
+        self.assertEqual([record.input_line() for record in a.records()], [1, 2])
+
+        b = trapeza.load_source(StringIO.StringIO(test_data), "csv", predicate=lambda rec: rec.values[u"ID"] != u"1")
+        self.assertEqual(b.headers(), [u"Name", u"Donations", u"ID"])
+        self.assertEqual([record.input_line() for record in b.records()], [2])
+
+        with self.assertRaises(Exception):
+            trapeza.load_source(StringIO.StringIO(test_data + "Sam,1\n"), "csv")
+
+    def test_pipeline(self):
+        written = []
+        trapeza.pipeline.pipeline(trapeza.pipeline.batches(xrange(10), 3),
+                                  lambda items: ([2 * item for item in batch] for batch in items),
+                                  written.extend, depth=1)
+        self.assertEqual(written, [[0, 2, 4], [6, 8, 10], [12, 14, 16], [18]])
+
+        # Results arrive in order from a pool, which can run functions that cannot be pickled.
+        pool = trapeza.pipeline.process_pool(lambda item: item * item, 2)
+        try:
+            self.assertEqual(list(trapeza.pipeline.parallel_map(pool, xrange(10), 4)),
+                             [item * item for item in xrange(10)])
+        finally:
+            pool.terminate()
+            pool.join()
+
+        def fail(items):
+            for item in items:
+                if item == 5:
+                    raise ValueError("Bad item")
+                yield item
+
+        with self.assertRaises(ValueError):
+            trapeza.pipeline.pipeline(xrange(100), fail, list, depth=1)
+
+    def test_checkpoint(self):
+        directory = tempfile.mkdtemp()
+        try:
+            incoming_path = os.path.join(directory, "incoming.csv")
+            with open(incoming_path, "wb") as incoming_file:
+                incoming_file.write("Name\nTim\n")
+
+            path = os.path.join(directory, "checkpoint")
+            fingerprint = trapeza.checkpoint.Checkpoint.fingerprint_of([incoming_path], [1])
+            self.assertNotEqual(fingerprint, trapeza.checkpoint.Checkpoint.fingerprint_of([incoming_path], [2]))
+
+            checkpoint = trapeza.checkpoint.Checkpoint(path, fingerprint)
+            self.assertIsNone(checkpoint.load())
+
+            headers = [u"Name"]
+            with checkpoint.open_output() as output:
+                trapeza.write_records(headers, [trapeza.Record({u"Name": u"Tim"})], output, "csv")
+                checkpoint.save([0, 1], output, force=True)
+                # Written after the checkpoint was saved, so discarded on resuming.
+                trapeza.write_records(headers, [trapeza.Record({u"Name": u"Mary"})], output, "csv",
+                                      write_header=False)
+
+            resumed = trapeza.checkpoint.Checkpoint(path, fingerprint)
+            (position, offset) = resumed.load()
+            self.assertEqual(position, [0, 1])
+            with resumed.open_output(offset) as output:
+                trapeza.write_records(headers, [trapeza.Record({u"Name": u"Sam"})], output, "csv",
+                                      write_header=False)
+            with open(resumed.output_path, "rb") as output:
+                self.assertEqual(output.read(), "Name\r\nTim\r\nSam\r\n")
+
+            self.assertIsNone(trapeza.checkpoint.Checkpoint(path, "other").load())
+            resumed.remove()
+            self.assertEqual(os.listdir(directory), ["incoming.csv"])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_offsets(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "master.csv")
+            with open(path, "wb") as master_file:
+                master_file.write(u"ID,Name\r\n1,Tim\r\n\r\n2,\"Mary\nSmith\"\r\n3,Εὐθύφρων\n4,Sam".encode("utf-8"))
+
+            with open(path, "rb") as master_file:
+                indexed = trapeza.offsets.OffsetIndexedSource(master_file, "csv", u"ID")
+                self.assertTrue(indexed.built)
+                self.assertEqual(indexed.headers(), [u"ID", u"Name"])
+                self.assertEqual(indexed.get_record_with_id(u"2").values, {u"ID": u"2", u"Name": u"Mary\nSmith"})
+                self.assertEqual(indexed.get_record_with_id(u"3").values[u"Name"], u"Εὐθύφρων")
+                self.assertEqual(indexed.get_record_with_id(u"4").record_id(), u"4")
+                self.assertIsNone(indexed.get_record_with_id(u"5"))
+                self.assertTrue(indexed.contains_record(trapeza.Record({u"ID": u"1"})))
+                self.assertFalse(indexed.contains_record(trapeza.Record({u"ID": u"5"})))
+                indexed.close()
+
+                # The index is reused until the file changes.
+                self.assertFalse(trapeza.offsets.OffsetIndexedSource(master_file, "csv", u"ID").built)
+
+            with open(path, "ab") as master_file:
+                master_file.write("\n5,Ken\n")
+            with open(path, "rb") as master_file:
+                indexed = trapeza.offsets.OffsetIndexedSource(master_file, "csv", u"ID")
+                self.assertTrue(indexed.built)
+                self.assertEqual(indexed.get_record_with_id(u"5").values[u"Name"], u"Ken")
+
+                with self.assertRaises(Exception):
+                    trapeza.offsets.OffsetIndexedSource(master_file, "csv", u"Missing")
+        finally:
+            shutil.rmtree(directory)
+
 
 class TestMatch(unittest.TestCase):
     def test_mapping(self):
@@ -160,6 +348,7 @@ class TestMatch(unittest.TestCase):
         
         self.assertEqual(p.compare_records(ra, rb), 0)
         self.assertEqual(p.compare_records(ra, rc), 1)
+        self.assertEqual(p.columns(), [u"Name", u"Address"])
         
         sa = trapeza.Source(ra.values.keys())
         sa.add_record(ra)
@@ -205,6 +394,850 @@ class TestMatch(unittest.TestCase):
         r_prime = p.compare_sources(sa, sb, 0)
         self.assertEqual(r, r_prime)
 
+        # Changing the candidates returned does not change the index.
+        matches = pc.matches(a, ra)
+        matches.append(1)
+        self.assertEqual(list(pc.matches(a, ra)), [0])
+
+    def test_processed_pickle(self):
+        master = trapeza.Source([u"ID", u"Name", u"Notes"], u"ID")
+        master.add_record(trapeza.Record({u"ID": u"1", u"Name": u"Timothy", u"Notes": u"A note about Timothy"}))
+        master.add_record(trapeza.Record({u"ID": u"2", u"Name": u"Tim", u"Notes": u""}))
+
+        incoming = trapeza.Source([u"Name", u"Notes"])
+        incoming.add_record(trapeza.Record({u"Name": u"Tim", u"Notes": u"A note about Timothy"}))
+
+        p = trapeza.match.Profile(mappings=[trapeza.match.Mapping(u"Name", u"Name", trapeza.match.COMPARE_PREFIX, 1),
+                                            trapeza.match.Mapping(u"Notes", u"Notes", trapeza.match.COMPARE_FUZZY, 1)])
+        pc = trapeza.match.ProcessedSource(master, True, p)
+        pc.process()
+
+        self.assertEqual(list(pc.matches(p.mappings[0], incoming.records()[0])), [0])
+
+        restored = cPickle.loads(cPickle.dumps(pc, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(list(restored.matches(p.mappings[0], incoming.records()[0])), [0])
+        self.assertEqual(restored.digest(u"Notes", 0), pc.digest(u"Notes", 0))
+
+        r = p.compare_sources(pc, incoming, 0)
+        self.assertEqual(len(r), 1)
+        self.assertEqual(r[0].master, master.records()[0])
+        self.assertEqual(r[0].score, 2)
+        self.assertEqual([(x.master.record_id(), x.score)
+                          for x in restored.profile.compare_sources(restored, incoming, 0)], [(u"1", 2)])
+
+    def test_process_parallel(self):
+        source = trapeza.Source([u"ID", u"Name", u"Notes"], u"ID")
+        for i in range(2500):
+            source.add_record(trapeza.Record({u"ID": unicode(i),
+                                              u"Name": [u"Tim", u"Timothy", u"Sam", u""][i % 4],
+                                              u"Notes": u"note {} about {}".format(i % 7, i % 11)}))
+
+        p = trapeza.match.Profile(mappings=[trapeza.match.Mapping(u"Name", u"Name", trapeza.match.COMPARE_EXACT, 1),
+                                            trapeza.match.Mapping(u"Name", u"Name", trapeza.match.COMPARE_PREFIX, 1),
+                                            trapeza.match.Mapping(u"Notes", u"Notes", trapeza.match.COMPARE_FUZZY, 1),
+                                            trapeza.match.Mapping(u"Notes", u"Notes", trapeza.match.COMPARE_TOKENS, 1)])
+        serial = trapeza.match.ProcessedSource(source, True, p)
+        serial.process()
+        parallel = trapeza.match.ProcessedSource(source, True, p)
+        parallel.process(jobs=2)
+
+        for name in trapeza.match.ProcessedSource.INDEXES + ["digests", "signatures", "statistics"]:
+            self.assertEqual(getattr(serial, name), getattr(parallel, name))
+
+    def test_plan(self):
+        master = trapeza.Source([u"ID", u"Name", u"State"], u"ID")
+        for (i, name) in enumerate([u"Tim", u"Mary", u"Sam", u"Tim", u"Ken", u"Mary"]):
+            master.add_record(trapeza.Record({u"ID": unicode(i), u"Name": name, u"State": u"VA"}))
+        master.add_record(trapeza.Record({u"ID": u"6", u"Name": u"Tim", u"State": u"MD"}))
+
+        incoming = trapeza.Source([u"Name", u"State"])
+        incoming.add_record(trapeza.Record({u"Name": u"Tim", u"State": u"VA"}))
+        incoming.add_record(trapeza.Record({u"Name": u"Dave", u"State": u"VA"}))
+
+        p = trapeza.match.Profile(mappings=[trapeza.match.Mapping(u"State", u"State", trapeza.match.COMPARE_EXACT, 1),
+                                            trapeza.match.Mapping(u"Name", u"Name", trapeza.match.COMPARE_EXACT, 2)])
+        pc = trapeza.match.ProcessedSource(master, True, p)
+        pc.process()
+
+        self.assertEqual(pc.expected_candidates(p.mappings[0]), 3.5)
+        self.assertEqual(p.plan(pc, 0), ([1, 0], []))
+        self.assertEqual(p.plan(pc, 2), ([1], [0]))
+
+        def summarize(results):
+            return sorted([(r.incoming.values[u"Name"], r.master.record_id(), r.score) for r in results])
+
+        for cutoff in [0, 1, 2, 3]:
+            self.assertEqual(summarize(p.compare_sources(pc, incoming, cutoff)),
+                             summarize(p.compare_sources(master, incoming, max(cutoff, 1))))
+
+    def test_stop_values(self):
+        master = trapeza.Source([u"ID", u"Name", u"State"], u"ID")
+        for (i, name) in enumerate([u"Tim", u"Mary", u"Sam", u"Tim", u"Ken", u"Mary"]):
+            master.add_record(trapeza.Record({u"ID": unicode(i), u"Name": name, u"State": u"VA"}))
+
+        incoming = trapeza.Source([u"Name", u"State"])
+        incoming.add_record(trapeza.Record({u"Name": u"Sam", u"State": u"VA"}))
+
+        p = trapeza.match.Profile(mappings=[trapeza.match.Mapping(u"State", u"State", trapeza.match.COMPARE_EXACT, 1),
+                                            trapeza.match.Mapping(u"Name", u"Name", trapeza.match.COMPARE_EXACT, 1)])
+        pc = trapeza.match.ProcessedSource(master, True, p, stop_value_limit=3)
+        pc.process()
+
+        self.assertTrue(pc.is_stop_value(u"State", u"VA"))
+        self.assertEqual(pc.frequency(u"State", u"VA"), 6)
+        self.assertEqual(pc.matches(p.mappings[0], incoming.records()[0]), [])
+
+        # The stop value generates no candidates of its own, but still scores Sam's record.
+        r = p.compare_sources(pc, incoming, 0)
+        self.assertEqual(len(r), 1)
+        self.assertEqual(r[0].master.record_id(), u"2")
+        self.assertEqual(r[0].score, 2)
+
+        # State is unselective, for all that its one value is a stop value, so it only scores; Sam's record is still
+        # found at any cutoff it reaches, whichever mappings generate candidates.
+        p.mappings[0].points = 2
+        pc = trapeza.match.ProcessedSource(master, True, p, stop_value_limit=3)
+        pc.process()
+        self.assertEqual(p.plan(pc, 3), ([1], [0]))
+        for cutoff in [0, 2, 3]:
+            self.assertEqual([(r.master.record_id(), r.score) for r in p.compare_sources(pc, incoming, cutoff)],
+                             [(u"2", 3)])
+        self.assertEqual(p.compare_sources(pc, incoming, 4), [])
+        # Even a plan generating only from the stop value's mapping finds it.
+        self.assertEqual(p._score_record(pc, incoming.records()[0], ([0], [1]), 3), {2: 3})
+
+    def test_idf(self):
+        master = trapeza.Source([u"ID", u"Name"], u"ID")
+        for (i, name) in enumerate([u"Tim", u"Tim", u"Tim", u"Sam"]):
+            master.add_record(trapeza.Record({u"ID": unicode(i), u"Name": name}))
+
+        incoming = trapeza.Source([u"Name"])
+        incoming.add_record(trapeza.Record({u"Name": u"Tim"}))
+        incoming.add_record(trapeza.Record({u"Name": u"Sam"}))
+
+        p = trapeza.match.Profile(mappings=[trapeza.match.Mapping(u"Name", u"Name", trapeza.match.COMPARE_EXACT, 10,
+                                                                  idf=True)])
+        pc = trapeza.match.ProcessedSource(master, True, p)
+        pc.process()
+
+        scores = dict((r.master.record_id(), r.score) for r in p.compare_sources(pc, incoming, 0))
+        self.assertEqual(scores, dict((r.master.record_id(), r.score)
+                                      for r in p.compare_sources(master, incoming, 0, p.value_frequencies(master))))
+        self.assertEqual(scores[u"3"], 10)
+        self.assertLess(scores[u"0"], 10)
+        self.assertGreater(scores[u"0"], 0)
+
+        unprocessed = dict((r.master.record_id(), r.score) for r in p.compare_sources(master, incoming, 0))
+        self.assertEqual(scores, unprocessed)
+
+    def test_phonetic(self):
+        self.assertEqual(trapeza.phonetic.soundex(u"Robert"), u"R163")
+        self.assertEqual(trapeza.phonetic.soundex(u"Rupert"), u"R163")
+        self.assertEqual(trapeza.phonetic.soundex(u"Ashcraft"), u"A261")
+        self.assertEqual(trapeza.phonetic.soundex(u"Tymczak"), u"T522")
+        self.assertEqual(trapeza.phonetic.soundex(u"Lee"), u"L000")
+        self.assertEqual(trapeza.phonetic.phonetic_key(u"Zoë Smith-Jones"), u"Z000 S530 J520")
+
+        master = trapeza.Source([u"ID", u"Name", u"City"], u"ID")
+        for (i, name, city) in [(u"1", u"Jon Smith", u"Boston"), (u"2", u"Mary Smyth", u"Boston"),
+                                (u"3", u"John Smythe", u"Austin"), (u"4", u"", u"Boston")]:
+            master.add_record(trapeza.Record({u"ID": i, u"Name": name, u"City": city}))
+
+        incoming = trapeza.Source([u"Name", u"City"])
+        incoming.add_record(trapeza.Record({u"Name": u"John Smith", u"City": u"Boston"}))
+
+        p = trapeza.match.Profile(mappings=[trapeza.match.Mapping(u"Name", u"Name", trapeza.match.COMPARE_PHONETIC, 2),
+                                            trapeza.match.Mapping(u"City", u"City", trapeza.match.COMPARE_EXACT, 1)])
+        pc = trapeza.match.ProcessedSource(master, True, p)
+        pc.process()
+
+        for cutoff in [0, 2, 3]:
+            processed = sorted((r.master.record_id(), r.score) for r in p.compare_sources(pc, incoming, cutoff))
+            unprocessed = sorted((r.master.record_id(), r.score) for r in p.compare_sources(master, incoming, cutoff))
+            self.assertEqual(processed, unprocessed)
+
+        self.assertEqual(sorted((r.master.record_id(), r.score) for r in p.compare_sources(pc, incoming, 0)),
+                         [(u"1", 3), (u"2", 1), (u"3", 2), (u"4", 1)])
+
+    def test_edit(self):
+        self.assertEqual(trapeza.match._bounded_levenshtein(u"kitten", u"sitting", 3), 3)
+        self.assertEqual(trapeza.match._bounded_levenshtein(u"kitten", u"sitting", 1), 2)
+        self.assertEqual(trapeza.match._bounded_levenshtein(u"abc", u"abc", 0), 0)
+
+        master = trapeza.Source([u"ID", u"Postcode"], u"ID")
+        for (i, postcode) in [(u"1", u"SW1A 1AA"), (u"2", u"SW1A 1AB"), (u"3", u"SW1A 2BB"), (u"4", u"EC1A 1BB")]:
+            master.add_record(trapeza.Record({u"ID": i, u"Postcode": postcode}))
+
+        incoming = trapeza.Source([u"Postcode"])
+        incoming.add_record(trapeza.Record({u"Postcode": u"SW1A 1A"}))
+        incoming.add_record(trapeza.Record({u"Postcode": u"EC1A 1BB"}))
+
+        for distance in [1, 2]:
+            p = trapeza.match.Profile(mappings=[trapeza.match.Mapping(u"Postcode", u"Postcode",
+                                                                      trapeza.match.COMPARE_EDIT, 1,
+                                                                      max_distance=distance)])
+            pc = trapeza.match.ProcessedSource(master, True, p)
+            pc.process()
+
+            processed = sorted((r.incoming.input_line(), r.master.record_id())
+                               for r in p.compare_sources(pc, incoming, 1))
+            unprocessed = sorted((r.incoming.input_line(), r.master.record_id())
+                                 for r in p.compare_sources(master, incoming, 1))
+            self.assertEqual(processed, unprocessed)
+
+        self.assertEqual([master_id for (line, master_id) in processed], [u"1", u"2", u"4"])
+
+    def test_tokens(self):
+        a = trapeza.Record({u"Name": u"First Baptist Church of Springfield"})
+        b = trapeza.Record({u"Name": u"Springfield First Baptist"})
+        m = trapeza.match.Mapping(u"Name", u"Name", trapeza.match.COMPARE_TOKENS, 10)
+        self.assertEqual(m.compare_records(a, b), 6)
+        self.assertEqual(m.compare_records(a, trapeza.Record({u"Name": u""})), 0)
+
+        master = trapeza.Source([u"ID", u"Name"], u"ID")
+        for (i, name) in [(u"1", u"First Baptist Church of Springfield"), (u"2", u"Springfield Public Library"),
+                          (u"3", u"Shelbyville First Baptist Church")]:
+            master.add_record(trapeza.Record({u"ID": i, u"Name": name}))
+
+        incoming = trapeza.Source([u"Name"])
+        incoming.add_record(trapeza.Record({u"Name": u"Springfield First Baptist Church"}))
+
+        p = trapeza.match.Profile(mappings=[m])
+        pc = trapeza.match.ProcessedSource(master, True, p)
+        pc.process()
+
+        # Scores are estimated from MinHash signatures, so allow some error.
+        processed = dict((r.master.record_id(), r.score) for r in p.compare_sources(pc, incoming, 0))
+        unprocessed = dict((r.master.record_id(), r.score) for r in p.compare_sources(master, incoming, 0))
+        self.assertIn(u"1", processed)
+        self.assertNotIn(u"2", processed)
+        for master_id in processed:
+            self.assertAlmostEqual(processed[master_id], unprocessed[master_id], delta=2)
+
+        restored = cPickle.loads(cPickle.dumps(pc, 2))
+        self.assertEqual(restored.signature(u"Name", 1), pc.signature(u"Name", 1))
+
+    def test_range(self):
+        m = trapeza.match.Mapping(u"Amount", u"Amount", trapeza.match.COMPARE_RANGE, 10, tolerance=1, relative=True)
+        self.assertEqual(m.compare_records(trapeza.Record({u"Amount": u"1,000"}), trapeza.Record({u"Amount": u"1000"})),
+                         10)
+        self.assertEqual(m.compare_records(trapeza.Record({u"Amount": u"1005"}), trapeza.Record({u"Amount": u"1000"})),
+                         7.5)
+        self.assertEqual(m.compare_records(trapeza.Record({u"Amount": u"1011"}), trapeza.Record({u"Amount": u"1000"})),
+                         0)
+        self.assertEqual(m.compare_records(trapeza.Record({u"Amount": u"n/a"}), trapeza.Record({u"Amount": u"1000"})),
+                         0)
+
+        master = trapeza.Source([u"ID", u"Amount", u"Date"], u"ID")
+        for (i, amount, date) in [(u"1", u"100", u"2014-01-01"), (u"2", u"101", u"2014-01-05"),
+                                  (u"3", u"250", u"2013-12-30"), (u"4", u"", u"01/02/2014"),
+                                  (u"5", u"99.5", u"2014-02-01")]:
+            master.add_record(trapeza.Record({u"ID": i, u"Amount": amount, u"Date": date}))
+
+        incoming = trapeza.Source([u"Amount", u"Date"])
+        incoming.add_record(trapeza.Record({u"Amount": u"100", u"Date": u"2014/01/02"}))
+
+        p = trapeza.match.Profile(mappings=[
+            trapeza.match.Mapping(u"Amount", u"Amount", trapeza.match.COMPARE_RANGE, 2, tolerance=1),
+            trapeza.match.Mapping(u"Date", u"Date", trapeza.match.COMPARE_RANGE, 4, tolerance=3)])
+        pc = trapeza.match.ProcessedSource(master, True, p)
+        pc.process()
+        restored = cPickle.loads(cPickle.dumps(pc, 2))
+
+        processed = dict((r.master.record_id(), r.score) for r in p.compare_sources(pc, incoming, 0))
+        self.assertEqual(dict((r.master.record_id(), r.score)
+                              for r in restored.profile.compare_sources(restored, incoming, 0)), processed)
+        unprocessed = dict((r.master.record_id(), r.score) for r in p.compare_sources(master, incoming, 0))
+        self.assertEqual(processed, unprocessed)
+        self.assertEqual(processed, {u"1": 2 + 4 * (1 - 1.0 / 6), u"2": 2 * 0.5 + 4 * 0.5, u"3": 4 * 0.5, u"4": 4,
+                                     u"5": 2 * 0.75})
+
+    def test_deduplicate(self):
+        source = trapeza.Source([u"ID", u"Name", u"Email"], u"ID")
+        for (i, name, email) in [(u"1", u"Tim", u"tim@example.com"),
+                                 (u"2", u"Dave", u"dave@example.com"),
+                                 (u"3", u"Tim", u"tim@example.org"),
+                                 (u"4", u"Timothy", u"tim@example.org"),
+                                 (u"5", u"Tim", u"")]:
+            source.add_record(trapeza.Record({u"ID": i, u"Name": name, u"Email": email}))
+
+        p = trapeza.match.Profile(mappings=[trapeza.match.Mapping(u"Name", u"Name", trapeza.match.COMPARE_EXACT, 1),
+                                            trapeza.match.Mapping(u"Email", u"Email", trapeza.match.COMPARE_EXACT, 1)])
+        pc = trapeza.match.ProcessedSource(source, True, p)
+        pc.process()
+
+        # 1 and 3 share a name, and 3 and 4 an email address; 5 matches 1 and 3 on name alone.
+        self.assertEqual(p.deduplicate(pc, 1), [0, 1, 0, 0, 0])
+        self.assertEqual(p.deduplicate(pc, 2), [0, 1, 2, 3, 4])
+
+        # Prefix matching is not symmetric, but clusters do not depend on the order of the records.
+        p = trapeza.match.Profile(mappings=[trapeza.match.Mapping(u"Name", u"Name", trapeza.match.COMPARE_PREFIX, 1)])
+        for names in [[u"Tima", u"Tim"], [u"Tim", u"Tima"]]:
+            source = trapeza.Source([u"ID", u"Name"], u"ID")
+            for (i, name) in enumerate(names):
+                source.add_record(trapeza.Record({u"ID": unicode(i), u"Name": name}))
+            pc = trapeza.match.ProcessedSource(source, True, p)
+            pc.process()
+            self.assertEqual(p.deduplicate(pc, 1), [0, 0])
+
+    def test_assign(self):
+        # Greedy assignment takes a-x first, leaving b with nothing; the optimal assignment gives a-y and b-x.
+        pairs = [(u"a", u"x", 10), (u"a", u"y", 9), (u"b", u"x", 8), (u"c", u"z", 1), (u"c", u"z", 2)]
+        self.assertEqual(trapeza.match.assign(pairs), [0, 4])
+        self.assertEqual(trapeza.match.assign(pairs, trapeza.match.ASSIGN_OPTIMAL), [1, 2, 4])
+        # Components too large for the optimal assignment are assigned greedily.
+        self.assertEqual(trapeza.match.assign(pairs, trapeza.match.ASSIGN_OPTIMAL, optimal_limit=1), [0, 4])
+
+        # Rectangular components, either way round.
+        pairs = [(u"a", u"x", 1), (u"a", u"y", 3), (u"a", u"z", 2), (u"b", u"y", 2)]
+        self.assertEqual(trapeza.match.assign(pairs, trapeza.match.ASSIGN_OPTIMAL), [2, 3])
+        swapped = [(master, incoming, score) for (incoming, master, score) in pairs]
+        self.assertEqual(trapeza.match.assign(swapped, trapeza.match.ASSIGN_OPTIMAL), [2, 3])
+        self.assertEqual(trapeza.match.assign([]), [])
+
+        # Negative scores are never worth choosing, even over leaving a key unassigned.
+        pairs = [(u"a", u"x", 5), (u"b", u"x", 4), (u"b", u"y", -10)]
+        self.assertEqual(trapeza.match.assign(pairs, trapeza.match.ASSIGN_OPTIMAL), [0])
+        pairs = [(u"a", u"x", -1), (u"a", u"y", 2), (u"b", u"x", 3), (u"b", u"y", -4)]
+        self.assertEqual(trapeza.match.assign(pairs, trapeza.match.ASSIGN_OPTIMAL), [1, 2])
+        self.assertEqual(trapeza.match.assign([(u"a", u"x", -1), (u"b", u"y", 1)], trapeza.match.ASSIGN_OPTIMAL), [1])
+
+    def test_service(self):
+        master = trapeza.Source([u"ID", u"Name"], u"ID")
+        for (i, name) in enumerate([u"Tim", u"Mary", u"Tim"]):
+            master.add_record(trapeza.Record({u"ID": unicode(i), u"Name": name}))
+
+        incoming = trapeza.Source([u"Name"])
+        incoming.add_record(trapeza.Record({u"Name": u"Tim"}, inputline=1))
+        incoming.add_record(trapeza.Record({u"Name": u"Εὐθύφρων"}, inputline=2))
+        incoming.add_record(trapeza.Record({u"Name": u"Mary"}, inputline=3))
+
+        p = trapeza.match.Profile(mappings=[trapeza.match.Mapping(u"Name", u"Name", trapeza.match.COMPARE_EXACT, 1)])
+        pc = trapeza.match.ProcessedSource(master, True, p)
+        pc.process()
+
+        directory = tempfile.mkdtemp()
+        address = os.path.join(directory, "socket")
+        started = threading.Event()
+        servers = []
+
+        def ready(server):
+            servers.append(server)
+            started.set()
+
+        thread = threading.Thread(target=trapeza.service.serve, args=(pc, address, ready))
+        thread.daemon = True
+        thread.start()
+        started.wait(5)
+
+        try:
+            results = list(trapeza.service.match_remote(address, incoming.headers(), incoming.records(), 1,
+                                                        batch_size=2))
+        finally:
+            servers[0].shutdown()
+            thread.join(5)
+            shutil.rmtree(directory)
+
+        self.assertEqual(sorted(results), [(1, u"0", 1), (1, u"2", 1), (3, u"1", 1)])
+        self.assertEqual(sorted(results),
+                         sorted((r.incoming.input_line(), r.master.record_id(), r.score)
+                                for r in p.compare_sources(pc, incoming, 1)))
+
+        # Records with the same values share their scores across the requests of a batch.
+        service = trapeza.service.MatchService(pc)
+        scored = {}
+        self.assertEqual(service.match(incoming.records()[:1], 1, scored), [(1, u"0", 1), (1, u"2", 1)])
+        self.assertEqual(service.match([trapeza.Record({u"Name": u"Tim"}, inputline=9)], 1, scored),
+                         [(9, u"0", 1), (9, u"2", 1)])
+        self.assertEqual(len(scored), 1)
+
+        self.assertEqual(trapeza.service.parse_address("localhost:8000"), (socket.AF_INET, ("127.0.0.1", 8000)))
+        self.assertEqual(trapeza.service.parse_address(":8000"), (socket.AF_INET, ("127.0.0.1", 8000)))
+        self.assertEqual(trapeza.service.parse_address("/tmp/a:1"), (socket.AF_UNIX, "/tmp/a:1"))
+        self.assertEqual(trapeza.service.parse_address("match:socket"), (socket.AF_UNIX, "match:socket"))
+        with self.assertRaises(Exception):
+            trapeza.service.parse_address("example.com:8000")
+
+    def test_cache(self):
+        master_file = StringIO.StringIO("ID,Name\n1,Tim\n2,Mary\n")
+        profile_file = StringIO.StringIO("key,master-key,points,strip,compare\nName,Name,1,1,exact\n")
+
+        directory = tempfile.mkdtemp()
+        try:
+            cache = trapeza.cache.ProcessedCache(directory)
+            fingerprint = cache.fingerprint(master_file, "csv", profile_file, "csv", u"ID", "utf-8")
+            self.assertEqual(master_file.tell(), 0)
+            self.assertEqual(fingerprint, cache.fingerprint(master_file, "csv", profile_file, "csv", u"ID", "utf-8"))
+            self.assertNotEqual(fingerprint, cache.fingerprint(master_file, "csv", profile_file, "csv", u"Name",
+                                                               "utf-8"))
+            self.assertNotEqual(fingerprint, cache.fingerprint(master_file, "tsv", profile_file, "csv", u"ID",
+                                                               "utf-8"))
+            self.assertNotEqual(fingerprint, cache.fingerprint(master_file, "csv", profile_file, "csv", u"ID",
+                                                               "latin-1"))
+            self.assertIsNone(cache.get(fingerprint))
+
+            p = trapeza.match.Profile(source=trapeza.load_source(profile_file, "csv"))
+            master = trapeza.load_source(master_file, "csv")
+            master.set_primary_key(u"ID")
+            pc = trapeza.match.ProcessedSource(master, True, p)
+            pc.process()
+            cache.put(fingerprint, pc)
+
+            cached = cache.get(fingerprint)
+            self.assertEqual(cached.exact, pc.exact)
+            self.assertEqual(os.listdir(directory), [fingerprint + trapeza.cache.ProcessedCache.SUFFIX])
+
+            # A second entry pushes the cache over its limit, evicting the older.
+            cache.max_bytes = os.path.getsize(cache.path(fingerprint)) + 1
+            os.utime(cache.path(fingerprint), (0, 0))
+            cache.put("other", pc)
+            self.assertEqual(os.listdir(directory), ["other" + trapeza.cache.ProcessedCache.SUFFIX])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_shards(self):
+        master = trapeza.Source([u"ID", u"Name", u"State"], u"ID")
+        for (i, name) in enumerate([u"Tim", u"Mary", u"Sam", u"Tim", u"Ken", u"Mary", u"Tim", u"Jo"]):
+            master.add_record(trapeza.Record({u"ID": unicode(i), u"Name": name, u"State": u"VA"}))
+
+        incoming = trapeza.Source([u"Name", u"State"])
+        for (i, name) in enumerate([u"Tim", u"Mary", u"Sam", u"Ann"]):
+            incoming.add_record(trapeza.Record({u"Name": name, u"State": u"VA"}, inputline=i + 1))
+
+        p = trapeza.match.Profile(mappings=[trapeza.match.Mapping(u"State", u"State", trapeza.match.COMPARE_EXACT, 1),
+                                            trapeza.match.Mapping(u"Name", u"Name", trapeza.match.COMPARE_EXACT, 10,
+                                                                  idf=True)])
+        pc = trapeza.match.ProcessedSource(master, True, p, stop_value_limit=3)
+        pc.process()
+        expected = [(r.incoming.input_line(), r.master.record_id(), r.score)
+                    for r in p.compare_sources(pc, incoming, 2)]
+
+        shards = list(trapeza.shards.process_shards(master, p, 3, stop_value_limit=3))
+        self.assertEqual(sum(len(shard.source.records()) for shard in shards), len(master.records()))
+        for shard in shards:
+            # Stop values and frequencies are those of the whole master.
+            self.assertEqual(shard.frequency(u"State", u"VA"), 8)
+            for record in shard.source.records():
+                self.assertEqual(shard.frequency(u"Name", record.values[u"Name"]),
+                                 pc.frequency(u"Name", record.values[u"Name"]))
+
+        directory = tempfile.mkdtemp()
+        try:
+            paths = []
+            for (number, shard) in enumerate(shards):
+                paths.append(os.path.join(directory, str(number)))
+                with open(paths[-1], "wb") as shard_file:
+                    cPickle.dump(shard, shard_file, cPickle.HIGHEST_PROTOCOL)
+
+            pool = trapeza.shards.ShardPool(paths)
+            try:
+                results = list(pool.match(incoming.records(), 2, batch_size=3))
+            finally:
+                pool.close()
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(sorted(results), sorted(expected))
+        # Results are merged in incoming order.
+        self.assertEqual([result[0] for result in results], sorted(result[0] for result in results))
+
+    def test_stats(self):
+        ra = trapeza.Record({u"Name": u"Tim", u"Address": u"130 Main St."})
+        rb = trapeza.Record({u"Name": u"Tim", u"Address": u"2345 Sycamore Ln."})
+
+        p = trapeza.match.Profile(mappings=[trapeza.match.Mapping(u"Name", u"Name", trapeza.match.COMPARE_EXACT, 1)])
+
+        sa = trapeza.Source(ra.values.keys())
+        sa.add_record(ra)
+        sa.add_record(rb)
+
+        s = trapeza.stats.enable()
+        try:
+            with s.stage("match"):
+                pc = trapeza.match.ProcessedSource(sa, True, p)
+                pc.process()
+                p.compare_sources(pc, sa, 0)
+        finally:
+            trapeza.stats.disable()
+
+        self.assertEqual([stage["name"] for stage in s.stages], ["match"])
+        self.assertEqual(s.counters[u"index.exact.Name.values"], 1)
+        self.assertEqual(s.counters[u"index.exact.Name.entries"], 2)
+        self.assertEqual(s.counters[u"candidates.Name.Name.exact"], 4)
+        self.assertEqual(s.counters["rows.match"], 2)
+
+        out = StringIO.StringIO()
+        s.write(out)
+        self.assertIn("candidates.Name.Name.exact", out.getvalue())
+        self.assertFalse(trapeza.stats.current.enabled)
+
+
+class ScriptTestCase(unittest.TestCase):
+    # Runs scripts in a temporary directory.
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, "wb") as each_file:
+            each_file.write(data)
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name), "rb") as each_file:
+            return each_file.read()
+
+    @staticmethod
+    def rows(output):
+        return [row.split(",") for row in output.splitlines()]
+
+
+class TestMatchScript(ScriptTestCase):
+    def setUp(self):
+        ScriptTestCase.setUp(self)
+        self.write("master.csv", "ID,Name,City\n1,Tim,Boston\n2,Mary,Denver\n3,Sam,Boston\n")
+        self.write("profile.csv", "key,master-key,compare,points,strip\nName,Name,exact,10,1\nCity,City,exact,5,1\n")
+
+    def match(self, *arguments, **kwargs):
+        return run_script("trapeza-match.py", ["-m", "master.csv", "-p", "profile.csv", "--primary-key", "ID"] +
+                          list(arguments), kwargs.get("stdin"), self.directory)
+
+    def test_incoming_files(self):
+        self.write("a/x.csv", "Name,City\nTim,Boston\n")
+        self.write("b/y.csv", "Name,City\nMary,Denver\nSam,Miami\n")
+
+        (status, out, err) = self.match("-c", "10", "-n", "a/x.csv", "b/y.csv")
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.rows(out), [["Input Line", "Unique ID", "Match Score", "Source File"],
+                                          ["1", "1", "15", "a/x.csv"],
+                                          ["1", "2", "15", "b/y.csv"],
+                                          ["2", "3", "10", "b/y.csv"]])
+
+        # Standard input is read like any other file.
+        (status, out, err) = self.match("-c", "10", "-n", "a/x.csv", "-", stdin="Name,City\nSam,Boston\n")
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.rows(out)[2], ["1", "3", "15", "-"])
+
+        os.mkdir(os.path.join(self.directory, "out"))
+        (status, out, err) = self.match("-c", "10", "-n", "a/*.csv", "b/*.csv", "--output-directory", "out")
+        self.assertEqual(status, 0, err)
+        self.assertEqual(out, "")
+        self.assertEqual(self.rows(self.read("out/x-matches.csv")),
+                         [["Input Line", "Unique ID", "Match Score"], ["1", "1", "15"]])
+        self.assertEqual(len(self.rows(self.read("out/y-matches.csv"))), 3)
+
+        # Files that would be written to the same output are refused.
+        self.write("b/x.csv", "Name,City\nSam,Boston\n")
+        (status, out, err) = self.match("-n", "a/x.csv", "b/x.csv", "--output-directory", "out")
+        self.assertEqual(status, 1)
+        self.assertIn("would both be written", err)
+
+    def test_dedupe(self):
+        (status, out, err) = self.match("-c", "5", "--dedupe")
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.rows(out), [["Unique ID", "Cluster ID"], ["1", "1"], ["2", "2"], ["3", "1"]])
+
+        (status, out, err) = self.match("--dedupe", "--one-to-one", "optimal")
+        self.assertEqual(status, 1)
+        self.assertIn("--one-to-one", err)
+
+    def test_jobs(self):
+        self.write("a.csv", "Name,City\n" + "Tim,Boston\nMary,Denver\nSam,Miami\n" * 50)
+
+        (status, out, err) = self.match("-c", "10", "-n", "a.csv")
+        self.assertEqual(status, 0, err)
+        for jobs in ["1", "2"]:
+            (status, pipelined_out, err) = self.match("-c", "10", "-n", "a.csv", "--pipeline", "-j", jobs)
+            self.assertEqual(status, 0, err)
+            self.assertEqual(pipelined_out, out)
+
+    def test_checkpoint_resume(self):
+        self.write("a.csv", "Name\nTim\nMary\nBad\nSam\n")
+        paths = [os.path.join(self.directory, "a.csv")]
+        checkpoint = os.path.join(self.directory, "checkpoint")
+        matched = []
+        interrupt = [True]
+
+        def match(incoming):
+            for record in incoming.records():
+                if record.values[u"Name"] == u"Bad" and interrupt[0]:
+                    # Fail only once the writer has saved a checkpoint.
+                    for attempt in xrange(500):
+                        if os.path.exists(checkpoint):
+                            break
+                        time.sleep(0.01)
+                    raise Exception("Interrupted")
+                matched.append(record.values[u"Name"])
+                yield (record.input_line(), record.values[u"Name"], 1)
+
+        for expected in [1, 0]:
+            with open(os.path.join(self.directory, "out.csv"), "wb") as output:
+                args = argparse.Namespace(checkpoint=checkpoint, checkpoint_interval=0, output=output,
+                                          output_format="csv", output_directory=None, input_format="csv",
+                                          input_encoding="utf-8", output_encoding="utf-8", master=None, profile=None,
+                                          processed_master=None, match_cutoff=0, primary_key="ID", server=None,
+                                          cache=False)
+                self.assertEqual(match_script.run_pipelined(args, match, paths, batch_size=1), expected)
+
+            if expected == 1:
+                # The interrupted run leaves its checkpoint, and no output.
+                self.assertTrue(os.path.exists(checkpoint))
+                self.assertEqual(self.read("out.csv"), "")
+                self.assertEqual(matched, [u"Tim", u"Mary"])
+                # Results still queued for writing when the run failed are not in the checkpoint.
+                with open(checkpoint, "rb") as state_file:
+                    (index, line) = json.load(state_file)["position"]
+                interrupt[0] = False
+                del matched[:]
+
+        # The resumed run starts where the checkpoint left off, and every result is written once.
+        self.assertEqual(matched, [u"Tim", u"Mary", u"Bad", u"Sam"][line:])
+        self.assertEqual(self.rows(self.read("out.csv")),
+                         [["Input Line", "Unique ID", "Match Score"], ["1", "Tim", "1"], ["2", "Mary", "1"],
+                          ["3", "Bad", "1"], ["4", "Sam", "1"]])
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_cache(self):
+        self.write("a.csv", "Name,City\nTim,Boston\n")
+
+        # The cache is used only when asked for.
+        (status, out, err) = self.match("-c", "10", "-n", "a.csv", "--cache-directory", "cache")
+        self.assertEqual(status, 0, err)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "cache")))
+
+        for run in range(2):
+            (status, cached_out, err) = self.match("-c", "10", "-n", "a.csv", "--cache-directory", "cache", "--cache",
+                                                   "--stats", "stats.json")
+            self.assertEqual(status, 0, err)
+            self.assertEqual(cached_out, out)
+            self.assertEqual(len(os.listdir(os.path.join(self.directory, "cache"))), 1)
+            self.assertIn("cache.misses" if run == 0 else "cache.hits", self.read("stats.json"))
+
+        # A different input encoding makes a new entry.
+        (status, cached_out, err) = self.match("-c", "10", "-n", "a.csv", "--cache-directory", "cache", "--cache",
+                                               "--input-encoding", "latin-1")
+        self.assertEqual(status, 0, err)
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, "cache"))), 2)
+
+
+class TestSheet(ScriptTestCase):
+    def sheet(self, *arguments, **kwargs):
+        return run_script("trapeza-sheet.py", list(arguments), kwargs.get("stdin"), self.directory)
+
+    @staticmethod
+    def source(rows):
+        source = trapeza.Source([u"ID", u"Name"], u"ID")
+        for (i, name) in rows:
+            source.add_record(trapeza.Record({u"ID": i, u"Name": name}))
+
+        return source
+
+    def test_merge_presorted(self):
+        rows = [[(u"1", u"Tim"), (u"3", u"Sam"), (u"5", u"Ken")],
+                [(u"2", u"Mary"), (u"3", u"Samuel"), (u"5", u"Ken")],
+                [(u"3", u"Sam"), (u"4", u"Jo"), (u"5", u"Kenneth")]]
+
+        for (merge, action) in [(sheet.merge_union, sheet.action_union),
+                                (sheet.merge_intersect, sheet.action_intersect),
+                                (sheet.merge_xor, sheet.action_xor),
+                                (sheet.merge_subtract, sheet.action_subtract)]:
+            merged = [record.values for record in merge([self.source(each).records() for each in rows], u"ID")]
+            expected = [record.values for record in action([self.source(each) for each in rows]).records()]
+            self.assertEqual(merged, sorted(expected, key=lambda values: values[u"ID"]))
+
+        unsorted = self.source([(u"2", u"Mary"), (u"1", u"Tim")])
+        with self.assertRaises(Exception):
+            list(sheet.merge_union([unsorted.records()], u"ID"))
+
+        duplicated = [trapeza.Record({u"ID": u"1", u"Name": name}) for name in [u"Tim", u"Timothy"]]
+        with self.assertRaises(Exception):
+            list(sheet.merge_union([duplicated], u"ID"))
+
+    def test_presorted(self):
+        self.write("a.csv", "ID,Name\n1,Tim\n3,Sam\n5,Ken\n")
+        self.write("b.csv", "ID,Email\n2,m@example.com\n3,s@example.com\n")
+        self.write("unsorted.csv", "ID,Name\n3,Sam\n1,Tim\n")
+
+        for verb in ["--union", "--intersect", "--xor", "--subtract"]:
+            (status, presorted, err) = self.sheet("--presorted", verb, "--primary-key", "ID", "a.csv", "b.csv")
+            self.assertEqual(status, 0, err)
+            (status, loaded, err) = self.sheet(verb, "--primary-key", "ID", "a.csv", "b.csv")
+            self.assertEqual(status, 0, err)
+
+            # Output is in key order, with the columns of every source.
+            self.assertEqual(self.rows(presorted)[0], ["ID", "Name", "Email"])
+            keys = [row[0] for row in self.rows(presorted)[1:]]
+            self.assertEqual(keys, sorted(keys))
+            self.assertEqual(sorted(sorted(zip(self.rows(presorted)[0], row)) for row in self.rows(presorted)[1:]),
+                             sorted(sorted(zip(self.rows(loaded)[0], row)) for row in self.rows(loaded)[1:]))
+
+        (status, out, err) = self.sheet("--presorted", "--union", "--primary-key", "ID", "a.csv", "unsorted.csv")
+        self.assertEqual(status, 1)
+        self.assertIn("not sorted", err)
+
+        (status, out, err) = self.sheet("--presorted", "--union", "a.csv", "b.csv")
+        self.assertEqual(status, 1)
+
+
+    def test_pushdown(self):
+        self.assertEqual(sheet.filter_columns('record["Name"] == "Tim" and record["ID"] > "1"'), ["Name", "ID"])
+        self.assertIsNone(sheet.filter_columns('len(record) > 2'))
+        self.assertIsNone(sheet.filter_columns('record.get("Name") == "Tim"'))
+
+        def arguments(**kwargs):
+            args = argparse.Namespace(input_encoding="utf-8", drop=None, add=None, union=False, intersect=False,
+                                      subtract=False, xor=False, primary_key=None, keep_duplicates=False,
+                                      infile=[None, None])
+            args.__dict__.update(kwargs)
+            return args
+
+        self.assertEqual(sheet.pushdown_sources(arguments(union=True), ["Name"]), [0, 1])
+        self.assertEqual(sheet.pushdown_sources(arguments(union=True), None), [])
+        self.assertEqual(sheet.pushdown_sources(arguments(subtract=True), ["Name"]), [0])
+        self.assertEqual(sheet.pushdown_sources(arguments(intersect=True), ["Name"]), [])
+        self.assertEqual(sheet.pushdown_sources(arguments(xor=True), ["Name"]), [])
+        self.assertEqual(sheet.pushdown_sources(arguments(union=True, drop="Name"), ["Name"]), [])
+        self.assertEqual(sheet.pushdown_sources(arguments(union=True, add=["Name", "x"]), ["Name"]), [])
+        self.assertEqual(sheet.pushdown_sources(arguments(union=True, primary_key="ID"), ["ID"]), [])
+        self.assertEqual(sheet.pushdown_sources(arguments(union=True, primary_key="ID", keep_duplicates=True),
+                                                ["Name"]), [0, 1])
+
+        self.write("a.csv", "ID,Name\n1,Tim\n2,Mary\n3,Sam\n")
+        self.write("b.csv", "ID,Name\n3,Samuel\n4,Ken\n4,Kenneth\n")
+        for verb in ["--union", "--subtract", "--intersect", "--xor"]:
+            (status, filtered, err) = self.sheet(verb, "--filter", 'record["Name"] != "Mary"', "a.csv", "b.csv")
+            self.assertEqual(status, 0, err)
+            self.assertNotIn("Mary", filtered)
+
+        # Filtering out a duplicate key does not hide it.
+        for verb in ["--union", "--subtract"]:
+            (status, out, err) = self.sheet(verb, "--primary-key", "ID", "--filter", 'record["Name"] != "Kenneth"',
+                                            "b.csv", "a.csv")
+            self.assertEqual(status, 1)
+            self.assertIn("primary key", err)
+
+
+    def test_join(self):
+        self.write("people.csv", "ID,Name,City\n1,Tim,Boston\n2,Mary,Denver\n3,Sam,Boston\n4,Jo,Miami\n5,Ken,\n")
+        self.write("cities.csv", "City,State\nBoston,MA\nDenver,CO\nAustin,TX\n")
+
+        expected = [["1", "Tim", "Boston", "MA"], ["2", "Mary", "Denver", "CO"], ["3", "Sam", "Boston", "MA"]]
+        unmatched = [["4", "Jo", "Miami", ""], ["5", "Ken", "", ""]]
+
+        # In memory, and partitioned into temporary files; with either source the smaller.
+        for memory in ["1000", "1"]:
+            for (verb, rows) in [("--join", expected), ("--left-join", expected + unmatched)]:
+                (status, out, err) = self.sheet(verb, "City", "--join-memory", memory, "people.csv", "cities.csv")
+                self.assertEqual(status, 0, err)
+                self.assertEqual(self.rows(out)[0], ["ID", "Name", "City", "State"])
+                self.assertEqual(sorted(self.rows(out)[1:]), sorted(rows))
+                if memory == "1000":
+                    # The larger source's order is kept.
+                    self.assertEqual(self.rows(out)[1:], rows)
+
+            (status, out, err) = self.sheet("--join", "City", "--join-memory", memory, "cities.csv", "people.csv")
+            self.assertEqual(status, 0, err)
+            self.assertEqual(self.rows(out)[0], ["City", "State", "ID", "Name"])
+            self.assertEqual(sorted(self.rows(out)[1:]),
+                             sorted([row[2:] + row[:2] for row in expected]))
+
+            (status, out, err) = self.sheet("--left-join", "City", "--join-memory", memory, "cities.csv",
+                                            "people.csv")
+            self.assertEqual(status, 0, err)
+            self.assertIn(["Austin", "TX", "", ""], self.rows(out))
+
+        (status, out, err) = self.sheet("--join", "State", "people.csv", "cities.csv")
+        self.assertEqual(status, 1)
+
+        table = sheet.build_table(trapeza.iterate_source(StringIO.StringIO(self.read("cities.csv")), "csv")[1],
+                                  u"City")
+        self.assertEqual(sorted(table.keys()), [u"Austin", u"Boston", u"Denver"])
+
+
+    def test_group(self):
+        self.write("gifts.csv", "Region,Donor,Amount\nEast,Tim,10\nWest,Mary,2.5\nEast,Sam,\nNorth,Jo,7\n"
+                                "East,Tim,5\nWest,Ken,4\n")
+        aggregates = ["--agg", "count", "--agg", "count:Amount", "--agg", "sum:Amount", "--agg", "avg:Amount",
+                      "--agg", "min:Amount", "--agg", "max:Amount"]
+        header = ["Region", "count", "count:Amount", "sum:Amount", "avg:Amount", "min:Amount", "max:Amount"]
+        # Blank amounts are counted as rows, but not as values.
+        groups = [["East", "3", "2", "15", "7.5", "5", "10"],
+                  ["West", "2", "2", "6.5", "3.25", "2.5", "4"],
+                  ["North", "1", "1", "7", "7", "7", "7"]]
+
+        (status, out, err) = self.sheet("--group-by", "Region", "gifts.csv", *aggregates)
+        self.assertEqual(status, 0, err)
+        # Groups are in order of first appearance.
+        self.assertEqual(self.rows(out), [header] + groups)
+
+        for memory in ["1000", "2"]:
+            (status, out, err) = self.sheet("--group-by", "Region", "--group-mode", "sort", "--group-memory", memory,
+                                            "gifts.csv", *aggregates)
+            self.assertEqual(status, 0, err)
+            # Groups are in key order.
+            self.assertEqual(self.rows(out), [header] + sorted(groups))
+
+        (status, out, err) = self.sheet("--group-by", "Region", "--group-by", "Donor", "--agg", "sum:Amount",
+                                        "--group-mode", "sort", "--group-memory", "1", "gifts.csv")
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.rows(out)[:3], [["Region", "Donor", "sum:Amount"], ["East", "Sam", ""],
+                                              ["East", "Tim", "15"]])
+
+        # Combined sources are grouped after loading.
+        (status, out, err) = self.sheet("--union", "--group-by", "Region", "--agg", "count", "gifts.csv", "gifts.csv")
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.rows(out)[1], ["East", "3"])
+
+        self.write("bad.csv", "Region,Amount\nEast,ten\n")
+        for mode in ["hash", "sort"]:
+            (status, out, err) = self.sheet("--group-by", "Region", "--agg", "sum:Amount", "--group-mode", mode,
+                                            "bad.csv")
+            self.assertEqual(status, 1)
+
+        (status, out, err) = self.sheet("--group-by", "Region", "--agg", "median:Amount", "gifts.csv")
+        self.assertEqual(status, 1)
+        (status, out, err) = self.sheet("--group-by", "Missing", "gifts.csv")
+        self.assertEqual(status, 1)
+
+
+    def test_diff(self):
+        self.write("old.csv", "ID,Name,City\n1,Tim,Boston\n2,Mary,Denver\n3,Sam,Miami\n")
+        # Phone is a new column, which does not make every row a change.
+        self.write("new.csv", "ID,Name,City,Phone\n1,Tim,Boston,555\n2,Mary,Austin,\n4,Jo,Reno,1\n")
+
+        (status, out, err) = self.sheet("--diff", "--primary-key", "ID", "old.csv", "new.csv")
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.rows(out), [["ID", "Name", "City", "Phone", "Diff Status", "Changed Columns"],
+                                          ["2", "Mary", "Austin", "", "changed", "City"],
+                                          ["4", "Jo", "Reno", "1", "added", ""],
+                                          ["3", "Sam", "Miami", "", "removed", ""]])
+
+        # Likewise a column that has been dropped.
+        (status, out, err) = self.sheet("--diff", "--primary-key", "ID", "new.csv", "old.csv")
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.rows(out), [["ID", "Name", "City", "Phone", "Diff Status", "Changed Columns"],
+                                          ["2", "Mary", "Denver", "", "changed", "City"],
+                                          ["3", "Sam", "Miami", "", "added", ""],
+                                          ["4", "Jo", "Reno", "1", "removed", ""]])
+
+        # An old snapshot from standard input cannot be read again, so only the keys of removed rows are known.
+        (status, out, err) = self.sheet("--diff", "--primary-key", "ID", "-", "new.csv", stdin=self.read("old.csv"))
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.rows(out)[1:], [["2", "Mary", "Austin", "", "changed", "City"],
+                                              ["4", "Jo", "Reno", "1", "added", ""],
+                                              ["3", "", "", "", "removed", ""]])
+
+        self.write("same.csv", "ID,Name,City\n1,Tim,Boston\n1,Tim,Boston\n")
+        (status, out, err) = self.sheet("--diff", "--primary-key", "ID", "old.csv", "same.csv")
+        self.assertEqual(status, 1)
+        (status, out, err) = self.sheet("--diff", "old.csv", "new.csv")
+        self.assertEqual(status, 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -17,13 +17,37 @@
 #              strip is true if whitespace and quotes ought to be removed from both comparands
 #              compare is one of 'exact' (equality);
 #                                'prefix' (either value is a prefix of the other);
-#                                'fuzzy' (assign a percentage of available points based on similarity).
+#                                'fuzzy' (assign a percentage of available points based on similarity);
+#                                'phonetic' (the words of each value sound alike, by Soundex);
+#                                'edit' (the values are within a small Levenshtein distance of one another);
+#                                'tokens' (assign a percentage of available points based on the words shared);
+#                                'range' (numbers or dates within a tolerance of one another, assigning points
+#                                         that fall to half at the limit of the tolerance).
+#
+# An optional column, idf, may be set to true for exact comparisons to scale points by the inverse frequency
+# of the matched value in the master, so that agreement on rare values counts for more.
+#
+# An optional column, distance, gives the greatest edit distance (default 1) at which edit comparisons match.
+#
+# An optional column, tolerance, gives the greatest difference (default 0) at which range comparisons match: either
+# an absolute amount (in days, for dates), or with a trailing %, a percentage of the incoming value.
 
 import argparse
+import contextlib
+import glob
+import itertools
+import os
+import shutil
 import sys
 import pickle
 from trapeza.match import *
 from trapeza import *
+from trapeza import stats
+from trapeza import service
+from trapeza.cache import ProcessedCache
+from trapeza.checkpoint import Checkpoint
+from trapeza.shards import ShardManifest, ShardPool
+from trapeza.pipeline import pipeline, process_pool, parallel_map, batches
 
 
 def main():
@@ -67,11 +91,19 @@ def main():
                         "--processed-master",
                         type=argparse.FileType('rb'),
                         help="Specify a processed master sheet. The profile information contained within the file will "
-                             "be used and any profile specified on the command line will be ignored.")
+                             "be used and any profile specified on the command line will be ignored. If it is the "
+                             "manifest of a sharded master, each shard is matched in a separate worker process.")
     parser.add_argument("-n", 
                         "--incoming", 
-                        type=argparse.FileType('rb'),
-                        help="Specify the incoming spreadsheet")
+                        nargs="+",
+                        metavar="INCOMING",
+                        help="Specify the incoming spreadsheet. Several files, or glob patterns, may be given; the "
+                             "master is loaded once and each file matched in turn. Unless --output-directory is "
+                             "specified, results for all files are written to one output with a Source File column.")
+    parser.add_argument("--output-directory",
+                        help="When matching several incoming files, write each file's results to a separate file "
+                             "in this directory, named after the incoming file. Incoming files with the same name "
+                             "in different directories cannot be matched together this way.")
     parser.add_argument("-c",
                         "--match-cutoff",
                         type=int,
@@ -79,44 +111,502 @@ def main():
                         help="The minimum number of points required for a match to appear in the results list.")
     parser.add_argument("--primary-key", 
                         help="Set the column name in the master sheet where unique identifiers are stored.")
+    parser.add_argument("-s",
+                        "--server",
+                        nargs="+",
+                        metavar="ADDRESS",
+                        help="Send incoming records to a running trapeza-serve at the given address (a Unix socket "
+                             "path or localhost host:port) instead of loading a master locally. No master, profile "
+                             "or primary key need be specified. If several addresses are given, each serving one "
+                             "shard of a master, records are sent to all of them and the results merged.")
+    parser.add_argument("--dedupe",
+                        action="store_true",
+                        default=False,
+                        help="Instead of matching an incoming sheet, find duplicates within the master. Each master "
+                             "record is looked up once against the master's own index, and records matching at or "
+                             "above the cutoff are grouped into clusters. Output lists the cluster of each record.")
+    parser.add_argument("--one-to-one",
+                        choices=[ASSIGN_GREEDY, ASSIGN_OPTIMAL],
+                        help="Keep at most one match for each incoming record and each master record. 'greedy' takes "
+                             "the highest-scoring remaining match first; 'optimal' maximises the total score of each "
+                             "small group of competing matches (and is greedy for large ones).")
+    parser.add_argument("--pipeline",
+                        action="store_true",
+                        default=False,
+                        help="Read incoming files, match records and write results concurrently, streaming incoming "
+                             "records in batches rather than loading each file before matching it.")
+    parser.add_argument("-j",
+                        "--jobs",
+                        type=int,
+                        default=1,
+                        help="With --pipeline, match against a local master in this many worker processes "
+                             "(default 1).")
+    parser.add_argument("--checkpoint",
+                        metavar="FILE",
+                        help="Record progress in this file, together with the output written so far, so that if the "
+                             "run is interrupted, repeating it resumes from the last checkpoint. Implies --pipeline. "
+                             "Output is written to the --output file only once the run is complete.")
+    parser.add_argument("--checkpoint-interval",
+                        type=int,
+                        default=60,
+                        metavar="SECONDS",
+                        help="Update the checkpoint at most this often (default 60 seconds).")
+
+    parser.add_argument("--cache-directory",
+                        default=os.environ.get("TRAPEZA_CACHE") or os.path.join(os.path.expanduser("~"), ".cache",
+                                                                                "trapeza"),
+                        help="With --cache, keep processed masters in this directory (default $TRAPEZA_CACHE, or "
+                             "~/.cache/trapeza). An entry is reused while the master and profile files, their "
+                             "formats, the input encoding, the primary key and the trapeza version are unchanged.")
+    parser.add_argument("--cache",
+                        action="store_true",
+                        default=False,
+                        help="When a master and profile are given, process the master and keep it in the cache "
+                             "directory for later runs. Note that, as with --processed-master, a processed master is "
+                             "compared only with the master records its indexes find for each incoming record, so "
+                             "results can differ from those of the full comparison made without --cache.")
+    parser.add_argument("--cache-size",
+                        type=int,
+                        default=1024,
+                        metavar="MB",
+                        help="Evict the least recently used processed masters once the cache exceeds this size "
+                             "(default 1024 MB).")
+
+    parser.add_argument("--stats",
+                        type=argparse.FileType('w'),
+                        help="Write per-stage timings, peak memory use and counters to the given file as JSON.")
+    parser.add_argument("--progress",
+                        action="store_true",
+                        default=False,
+                        help="Report progress in rows per second on standard error.")
 
     args = parser.parse_args()
-    
-    if args.incoming is None or args.primary_key is None or \
+
+    if args.stats or args.progress:
+        stats.enable(progress=args.progress)
+
+    result = run(args)
+
+    if args.stats:
+        stats.current.write(args.stats)
+
+    return result
+
+
+def run(args):
+    if args.server is not None:
+        return run_client(args)
+
+    if (args.incoming is None and not args.dedupe) or args.primary_key is None or \
             ((args.profile is None or args.master is None) and args.processed_master is None):
         sys.stderr.write("{}: you must specify a master, incoming, and profile sheet (or an incoming sheet and "
                          "processed master), and a primary key column.\n".format(sys.argv[0]))
         exit(1)
+
+    if args.dedupe and args.one_to_one is not None:
+        sys.stderr.write("{}: --one-to-one assigns incoming records to master records, and cannot be used with "
+                         "--dedupe.\n".format(sys.argv[0]))
+        return 1
+    
+    cached = None
+    if args.processed_master is None and args.cache:
+        cached = load_cached(args)
     
     try:
-        incoming = load_source(args.incoming, get_format(args.incoming.name, args.input_format), args.input_encoding)
-        if args.processed_master:
-            processed_master = pickle.load(args.processed_master)
-            profile = processed_master.profile
-            master = processed_master.source
-        else:
-            processed_master = None
-            profile = Profile(source=load_source(args.profile, get_format(args.profile.name, args.input_format),
-                                                 args.input_encoding))
-            master = load_source(args.master, get_format(args.master.name, args.input_format), args.input_encoding)
+        with stats.current.stage("load"):
+            if args.processed_master:
+                processed_master = pickle.load(args.processed_master)
+                profile = processed_master.profile
+                if not isinstance(processed_master, ShardManifest):
+                    master = processed_master.source
+            elif cached is not None:
+                (cache, fingerprint, processed_master) = cached
+                if processed_master is not None:
+                    profile = processed_master.profile
+                    master = processed_master.source
+                else:
+                    profile = Profile(source=load_source(args.profile,
+                                                         get_format(args.profile.name, args.input_format),
+                                                         args.input_encoding))
+                    # Cache the columns needed for deduplication too, so that one entry serves both.
+                    primary_key = args.primary_key.decode(args.input_encoding)
+                    master = load_source(args.master, get_format(args.master.name, args.input_format),
+                                         encoding=args.input_encoding,
+                                         columns=[primary_key] + profile.columns(True) + profile.columns(False))
+                    master.set_primary_key(primary_key)
+            else:
+                processed_master = None
+                profile = Profile(source=load_source(args.profile, get_format(args.profile.name, args.input_format),
+                                                     args.input_encoding))
+                # Load only the columns that matching will use.
+                columns = [args.primary_key.decode(args.input_encoding)] + profile.columns(True)
+                if args.dedupe:
+                    columns += profile.columns(False)
+                master = load_source(args.master, get_format(args.master.name, args.input_format),
+                                     encoding=args.input_encoding, columns=columns)
     except Exception:
         sys.stderr.write("{}: an error occured while loading input files.\n".format(sys.argv[0]))
         return 1
+
+    if isinstance(processed_master, ShardManifest):
+        return run_sharded(args, processed_master)
     
+    if cached is not None and processed_master is None:
+        with stats.current.stage("process"):
+            processed_master = ProcessedSource(master, True, profile)
+            processed_master.process()
+
+        try:
+            with stats.current.stage("cache"):
+                cache.put(fingerprint, processed_master)
+        except (IOError, OSError) as e:
+            sys.stderr.write("{}: could not cache the processed master: {}\n".format(sys.argv[0], e))
+
     if processed_master is None:
         master.set_primary_key(args.primary_key.decode(args.input_encoding))
-    
-    results = profile.compare_sources(processed_master or master, incoming, args.match_cutoff)
-    output_source = Source(headers=[u"Input Line", u"Unique ID", u"Match Score"])
-    
-    for result in results:
-        output_source.add_record(Record({u"Input Line": str(result.incoming.input_line()),
-                                         u"Unique ID": result.master.record_id(),
-                                         u"Match Score": str(result.score)}))
-        
+
+    if args.dedupe:
+        return run_dedupe(args, profile, master, processed_master)
+
+    # Incoming records are matched in batches (or per file); count the master's values for IDF weights only once.
+    frequencies = profile.value_frequencies(master) if processed_master is None else None
+
+    def match(incoming):
+        for result in profile.compare_sources(processed_master or master, incoming, args.match_cutoff, frequencies):
+            yield (result.incoming.input_line(), result.master.record_id(), result.score)
+
+    return run_incoming(args, match, profile.columns(False), args.jobs)
+
+
+def load_cached(args):
+    # Returns (cache, fingerprint, processed master or None), or None if the cache cannot be used.
+    try:
+        with stats.current.stage("cache"):
+            cache = ProcessedCache(args.cache_directory, args.cache_size * 1024 * 1024)
+            fingerprint = cache.fingerprint(args.master, get_format(args.master.name, args.input_format), args.profile,
+                                            get_format(args.profile.name, args.input_format),
+                                            args.primary_key.decode(args.input_encoding), args.input_encoding)
+            processed_master = cache.get(fingerprint)
+    except (IOError, OSError) as e:
+        # For example, an unwritable directory or an unseekable input.
+        sys.stderr.write("{}: not using the processed master cache: {}\n".format(sys.argv[0], e))
+        return None
+
+    stats.current.count("cache.hits" if processed_master is not None else "cache.misses")
+
+    return (cache, fingerprint, processed_master)
+
+
+def run_client(args):
+    if args.incoming is None:
+        sys.stderr.write("{}: you must specify an incoming sheet.\n".format(sys.argv[0]))
+        return 1
+
+    def match(incoming):
+        if len(args.server) > 1:
+            return service.match_shards(args.server, incoming.headers(), incoming.records(), args.match_cutoff)
+
+        return service.match_remote(args.server[0], incoming.headers(), incoming.records(), args.match_cutoff)
+
+    return run_incoming(args, match)
+
+
+def run_sharded(args, manifest):
+    if args.dedupe:
+        sys.stderr.write("{}: a sharded master cannot be deduplicated.\n".format(sys.argv[0]))
+        return 1
+
+    pool = ShardPool(manifest.resolve(args.processed_master.name))
+
+    try:
+        return run_incoming(args, lambda incoming: pool.match(incoming.records(), args.match_cutoff),
+                            manifest.profile.columns(False))
+    finally:
+        pool.close()
+
+
+def incoming_paths(patterns):
+    paths = []
+
+    for pattern in patterns:
+        # Patterns that match nothing are kept as-is, so that a missing file is reported when opened.
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if path not in paths:
+                paths.append(path)
+
+    return paths
+
+
+@contextlib.contextmanager
+def open_incoming(path):
+    # Unlike the files it opens, this leaves standard input open.
+    if path == "-":
+        yield sys.stdin
+    else:
+        with open(path, "rb") as infile:
+            yield infile
+
+
+def run_incoming(args, match, columns=None, jobs=1):
+    # Match each incoming file in turn. match is a function taking an incoming Source and returning
+    # (input line, unique id, score) tuples. If given, only columns are loaded from incoming files.
+    paths = incoming_paths(args.incoming)
+    if args.output_directory is not None:
+        outputs = {}
+        for path in paths:
+            if output_path(args, path) in outputs:
+                sys.stderr.write("{}: the results for {} and {} would both be written to {}.\n"
+                                 .format(sys.argv[0], outputs[output_path(args, path)], path, output_path(args, path)))
+                return 1
+            outputs[output_path(args, path)] = path
+
+    if args.pipeline or args.checkpoint is not None:
+        if args.one_to_one is not None:
+            sys.stderr.write("{}: --one-to-one needs every result at once, and cannot be used with --pipeline or "
+                             "--checkpoint.\n".format(sys.argv[0]))
+            return 1
+
+        return run_pipelined(args, match, paths, columns, jobs)
+
+    source_file_column = len(paths) > 1 and args.output_directory is None
+    # (path, result) tuples for the current output.
+    results = []
+
+    for path in paths:
+        try:
+            with stats.current.stage("load"):
+                with open_incoming(path) as infile:
+                    incoming = load_source(infile, get_format(path, args.input_format), encoding=args.input_encoding,
+                                           columns=columns)
+        except Exception:
+            sys.stderr.write("{}: an error occured while loading input file {}.\n".format(sys.argv[0], path))
+            return 1
+
+        if args.output_directory is not None:
+            results = []
+
+        try:
+            with stats.current.stage("match"):
+                for result in match(incoming):
+                    results.append((path, result))
+        except Exception as e:
+            sys.stderr.write("{}: an error occured while matching {}: {}\n".format(sys.argv[0], path, e))
+            return 1
+
+        if args.output_directory is not None:
+            try:
+                with open(output_path(args, path), "wb") as outfile:
+                    if write_matches(args, results, False, outfile) != 0:
+                        return 1
+            except IOError as e:
+                sys.stderr.write("{}: an error occured while writing output: {}\n".format(sys.argv[0], e))
+                return 1
+
+    if args.output_directory is None:
+        return write_matches(args, results, source_file_column)
+
+    return 0
+
+
+def write_matches(args, results, source_file_column, outfile=None):
+    # Writes a list of (path, result) tuples, keeping only a one-to-one assignment of them if requested.
+    if args.one_to_one is not None:
+        with stats.current.stage("assign"):
+            chosen = assign([((path, input_line), record_id, score)
+                             for (path, (input_line, record_id, score)) in results], args.one_to_one)
+            stats.current.count("assign.dropped", len(results) - len(chosen))
+            results = [results[index] for index in chosen]
+
+    output_source = Source(headers=[u"Input Line", u"Unique ID", u"Match Score"] +
+                           ([u"Source File"] if source_file_column else []))
+    for (path, result) in results:
+        output_source.add_record(result_record(result, path if source_file_column else None))
+
+    return write_output(args, output_source, outfile)
+
+
+def run_pipelined(args, match, paths, columns=None, jobs=1, batch_size=100):
+    # As run_incoming(), but incoming files are read in a separate thread and streamed in batches to match (run in
+    # jobs worker processes, if more than one), whose results are written as they arrive by a third.
+    headers = [u"Input Line", u"Unique ID", u"Match Score"]
+    source_file_column = len(paths) > 1 and args.output_directory is None
+    if source_file_column:
+        headers.append(u"Source File")
+
+    checkpoint = None
+    resume = None
+    if args.checkpoint is not None:
+        checkpoint = open_checkpoint(args, paths)
+        if checkpoint is None:
+            return 1
+        resume = checkpoint.load()
+
+    def read():
+        # Yields (file number, path, headers, batch of records), skipping those before any resumed position.
+        for (index, path) in enumerate(paths):
+            if resume is not None and index < resume[0][0]:
+                continue
+
+            try:
+                with open_incoming(path) as infile:
+                    (incoming_headers, records) = iterate_source(infile, get_format(path, args.input_format),
+                                                                 encoding=args.input_encoding, columns=columns)
+                    if resume is not None and index == resume[0][0]:
+                        records = (record for record in records if record.input_line() > resume[0][1])
+
+                    # An empty batch, so that results (if none) are still written for an empty file.
+                    yield (index, path, incoming_headers, [])
+                    for batch in batches(records, batch_size):
+                        yield (index, path, incoming_headers, batch)
+            except Exception:
+                raise Exception("an error occured while loading input file {}.".format(path))
+
+    def match_batch(item):
+        # Returns (file number, path, results, input line of the last record matched, if any).
+        (index, path, incoming_headers, batch) = item
+        incoming = Source(incoming_headers)
+        for record in batch:
+            incoming.add_record(record)
+
+        try:
+            return (index, path, list(match(incoming)), batch[-1].input_line() if len(batch) > 0 else None)
+        except Exception as e:
+            raise Exception("an error occured while matching {}: {}".format(path, e))
+
+    def transform(items):
+        if pool is not None:
+            return parallel_map(pool, items, 2 * jobs)
+
+        return itertools.imap(match_batch, items)
+
+    def write(results):
+        try:
+            if checkpoint is not None:
+                write_checkpointed(args, checkpoint, resume, headers, results, source_file_column)
+            elif args.output_directory is None:
+                write_records(headers, (result_record(result, path if source_file_column else None)
+                                        for (index, path, path_results, line) in results for result in path_results),
+                              args.output, get_format(args.output.name, args.output_format),
+                              encoding=args.output_encoding)
+            else:
+                for (path, path_results) in itertools.groupby(results, lambda item: item[1]):
+                    with open(output_path(args, path), "wb") as outfile:
+                        write_records(headers, (result_record(result) for (index, each_path, each_results, line)
+                                                in path_results for result in each_results),
+                                      outfile, get_format(outfile.name, args.output_format),
+                                      encoding=args.output_encoding)
+        except (IOError, OSError) as e:
+            raise Exception("an error occured while writing output: {}".format(e))
+
+    # The workers must be forked before pipeline() starts its threads.
+    pool = process_pool(match_batch, jobs) if jobs > 1 else None
+    try:
+        with stats.current.stage("pipeline"):
+            pipeline(read(), transform, write)
+    except Exception as e:
+        sys.stderr.write("{}: {}\n".format(sys.argv[0], e))
+        return 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    return 0
+
+
+def open_checkpoint(args, paths):
+    # Returns a Checkpoint for this run, or None (having reported why) if it cannot be checkpointed.
+    output_format = get_format(args.output.name, args.output_format)
+
+    if args.output_directory is not None or "-" in paths:
+        sys.stderr.write("{}: --checkpoint cannot be used with --output-directory or standard input.\n"
+                         .format(sys.argv[0]))
+        return None
+    if not formats.exporters_for_format(output_format)[0].appendable:
+        sys.stderr.write("{}: --checkpoint cannot be used with {} output.\n".format(sys.argv[0], output_format))
+        return None
+
+    # The run must be repeated exactly for a checkpoint to be resumed.
+    inputs = [each_file.name for each_file in [args.master, args.profile, args.processed_master]
+              if each_file is not None] + paths
+    settings = [args.match_cutoff, args.primary_key, args.server, args.cache, args.input_format,
+                args.input_encoding, output_format, args.output_encoding]
+
+    try:
+        return Checkpoint(args.checkpoint, Checkpoint.fingerprint_of(inputs, settings), args.checkpoint_interval)
+    except OSError as e:
+        sys.stderr.write("{}: an error occured while loading input files: {}\n".format(sys.argv[0], e))
+        return None
+
+
+def write_checkpointed(args, checkpoint, resume, headers, results, source_file_column):
+    # Writes results to the checkpoint's output, one batch at a time so that the output always ends at a batch
+    # boundary when the checkpoint is saved. Once complete, copies it to the real output and removes the checkpoint.
+    # If the run fails, iterating over results raises an exception (see pipeline()), and the checkpoint is kept.
+    output_format = get_format(args.output.name, args.output_format)
+    (position, offset) = resume or ([0, 0], 0)
+
+    with checkpoint.open_output(offset) as output:
+        if offset == 0:
+            write_records(headers, [], output, output_format, encoding=args.output_encoding)
+
+        for (index, path, path_results, line) in results:
+            write_records(headers, [result_record(result, path if source_file_column else None)
+                                    for result in path_results],
+                          output, output_format, encoding=args.output_encoding, write_header=False)
+            if line is not None:
+                position = [index, line]
+            elif index > position[0]:
+                position = [index, 0]
+
+            checkpoint.save(position, output)
+
+    with open(checkpoint.output_path, "rb") as output:
+        shutil.copyfileobj(output, args.output)
+    checkpoint.remove()
+
+
+def result_record(result, path=None):
+    # The output record for an (input line, unique id, score) tuple, with a Source File column if path is given.
+    (input_line, record_id, score) = result
+    values = {u"Input Line": str(input_line), u"Unique ID": record_id, u"Match Score": str(score)}
+    if path is not None:
+        values[u"Source File"] = path.decode(sys.getfilesystemencoding() or "utf-8")
+
+    return Record(values)
+
+
+def output_path(args, path):
+    output_name = "{}-matches.{}".format(os.path.splitext(os.path.basename(path))[0], args.output_format)
+
+    return os.path.join(args.output_directory, output_name)
+
+
+def run_dedupe(args, profile, master, processed_master):
+    if processed_master is None:
+        with stats.current.stage("process"):
+            processed_master = ProcessedSource(master, True, profile)
+            processed_master.process()
+
+    with stats.current.stage("dedupe"):
+        clusters = profile.deduplicate(processed_master, args.match_cutoff)
+
+    output_source = Source(headers=[u"Unique ID", u"Cluster ID"])
+
+    for (record, cluster) in zip(master.records(), clusters):
+        output_source.add_record(Record({u"Unique ID": record.record_id(),
+                                         u"Cluster ID": unicode(cluster + 1)}))
+
+    return write_output(args, output_source)
+
+
+def write_output(args, output_source, outfile=None):
+    outfile = outfile or args.output
+
     try:
-        output_format = get_format(args.output.name, args.output_format) 
-        write_source(output_source, args.output, output_format, encoding=args.output_encoding)
+        with stats.current.stage("write"):
+            output_format = get_format(outfile.name, args.output_format)
+            write_source(output_source, outfile, output_format, encoding=args.output_encoding)
     except IOError as e:
         sys.stderr.write("{}: an error occured while writing output: {}\n".format(sys.argv[0], e))
         return 1
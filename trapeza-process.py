@@ -8,10 +8,13 @@
 #
 
 import argparse
+import os
 import sys
 import cPickle
 from trapeza import *
 from trapeza.match import *
+from trapeza import stats
+from trapeza.shards import *
 
 
 def main():
@@ -42,33 +45,111 @@ def main():
                         help="Specify the master spreadsheet")
     parser.add_argument("--primary-key", 
                         help="Set the column name in the master sheet where unique identifiers are stored.")
+    parser.add_argument("--stop-value-limit",
+                        type=int,
+                        help="Treat values shared by more than this many master records as stop values, which do not "
+                             "generate match candidates (but still score candidates found by other mappings).")
+    parser.add_argument("-j",
+                        "--jobs",
+                        type=int,
+                        default=1,
+                        help="Build indexes using this many worker processes (default 1).")
+    parser.add_argument("--shards",
+                        type=int,
+                        default=1,
+                        help="Partition the master by primary key into this many shards, each processed separately "
+                             "and written to a file named after the output with the shard number appended. The "
+                             "output then holds a manifest of the shards, which trapeza-match can use in place of a "
+                             "processed master, or each shard can be served by trapeza-serve.")
+
+    parser.add_argument("--stats",
+                        type=argparse.FileType('w'),
+                        help="Write per-stage timings, peak memory use and counters to the given file as JSON.")
+    parser.add_argument("--progress",
+                        action="store_true",
+                        default=False,
+                        help="Report progress in rows per second on standard error.")
 
     args = parser.parse_args()
-    
+
+    if args.stats or args.progress:
+        stats.enable(progress=args.progress)
+
+    result = run(args)
+
+    if args.stats:
+        stats.current.write(args.stats)
+
+    return result
+
+
+def run(args):
     if args.profile is None or args.master is None or args.primary_key is None:
         sys.stderr.write("{}: you must specify a master and profile sheet and a primary key column.\n"
                          .format(sys.argv[0]))
         exit(1)
     try:
-        profile = Profile(source=load_source(args.profile, get_format(args.profile.name, args.input_format),
-                                             args.input_encoding))
-        master = load_source(args.master, get_format(args.master.name, args.input_format), args.input_encoding)
+        with stats.current.stage("load"):
+            profile = Profile(source=load_source(args.profile, get_format(args.profile.name, args.input_format),
+                                                 args.input_encoding))
+            # Load only the columns that matching (or deduplication) will use.
+            primary_key = args.primary_key.decode(args.input_encoding)
+            master = load_source(args.master, get_format(args.master.name, args.input_format),
+                                 encoding=args.input_encoding,
+                                 columns=[primary_key] + profile.columns(True) + profile.columns(False))
     except Exception:
         sys.stderr.write("{}: an error occured while loading input files.\n".format(sys.argv[0]))
         return 1
     
-    master.set_primary_key(args.primary_key.decode(args.input_encoding))
+    master.set_primary_key(primary_key)
+
+    if args.shards > 1:
+        return run_shards(args, master, profile)
 
-    pm = ProcessedSource(master, True, profile)
-    pm.process()
+    with stats.current.stage("process"):
+        pm = ProcessedSource(master, True, profile, args.stop_value_limit)
+        pm.process(args.jobs)
 
     try:
-        cPickle.dump(pm, args.output, protocol=cPickle.HIGHEST_PROTOCOL)
+        with stats.current.stage("write"):
+            cPickle.dump(pm, args.output, protocol=cPickle.HIGHEST_PROTOCOL)
     except Exception as e:
         sys.stderr.write("{}: an error occured while writing output: {}\n".format(sys.argv[0], e))
         return 1
         
     return 0
 
+
+def run_shards(args, master, profile):
+    if args.output is sys.stdout:
+        sys.stderr.write("{}: you must specify an output file to write shards.\n".format(sys.argv[0]))
+        return 1
+
+    shards = process_shards(master, profile, args.shards, args.stop_value_limit, args.jobs)
+    paths = []
+
+    for number in range(args.shards):
+        with stats.current.stage("process"):
+            shard = next(shards)
+
+        try:
+            with stats.current.stage("write"):
+                path = "{}.{}".format(args.output.name, number)
+                with open(path, "wb") as shard_file:
+                    cPickle.dump(shard, shard_file, protocol=cPickle.HIGHEST_PROTOCOL)
+                paths.append(os.path.basename(path))
+        except Exception as e:
+            sys.stderr.write("{}: an error occured while writing output: {}\n".format(sys.argv[0], e))
+            return 1
+
+    try:
+        with stats.current.stage("write"):
+            cPickle.dump(ShardManifest(paths, profile), args.output, protocol=cPickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        sys.stderr.write("{}: an error occured while writing output: {}\n".format(sys.argv[0], e))
+        return 1
+
+    return 0
+
 if __name__ == '__main__':
     exit(main())
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  trapeza-serve.py
+#  
+#  Copyright 2013-2014 David Reed <david@ktema.org>
+#  This file is available under the terms of the MIT License.
+#
+
+import argparse
+import signal
+import sys
+import cPickle
+from trapeza import *
+from trapeza.match import *
+from trapeza import stats
+from trapeza import service
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manipulate and combine tabular data files. Use this utility to "
+                                                 "hold a processed master data set in memory and answer match "
+                                                 "requests from trapeza-match --server.")
+    parser.add_argument("-M",
+                        "--processed-master",
+                        type=argparse.FileType('rb'),
+                        help="Specify a processed master sheet, as output by trapeza-process.")
+    parser.add_argument("-l",
+                        "--listen",
+                        default="127.0.0.1:7447",
+                        help="The address to listen on: either the path of a Unix socket or a localhost host:port "
+                             "pair (the service is unauthenticated, so other hosts are refused). Default is "
+                             "127.0.0.1:7447.")
+    parser.add_argument("--stats",
+                        type=argparse.FileType('w'),
+                        help="On exit, write per-stage timings, peak memory use and counters to the given file "
+                             "as JSON.")
+
+    args = parser.parse_args()
+
+    if args.processed_master is None:
+        sys.stderr.write("{}: you must specify a processed master.\n".format(sys.argv[0]))
+        return 1
+
+    if args.stats:
+        stats.enable()
+
+    try:
+        with stats.current.stage("load"):
+            processed_master = cPickle.load(args.processed_master)
+    except Exception:
+        sys.stderr.write("{}: an error occured while loading input files.\n".format(sys.argv[0]))
+        return 1
+
+    # Exit cleanly (removing any Unix socket) when terminated.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        service.serve(processed_master, args.listen,
+                      lambda server: sys.stderr.write("{}: listening on {}.\n".format(sys.argv[0], args.listen)))
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        sys.stderr.write("{}: an error occured while serving: {}\n".format(sys.argv[0], e))
+        return 1
+    finally:
+        if args.stats:
+            stats.current.write(args.stats)
+
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -8,9 +8,19 @@
 #
 
 import argparse
+import array
+import ast
 import copy
+import cPickle
+import heapq
+import itertools
+import os
 import sys
+import tempfile
+import zlib
 from trapeza import *
+from trapeza import stats
+from trapeza.offsets import OffsetIndexedSource
 
 
 class SortAction(argparse.Action):
@@ -76,6 +86,683 @@ def action_subtract(sources, keep_duplicates=False):
     return first
 
 
+def presorted_records(records, primary_key, index):
+    # Check sortedness as we go; tag each record with its key and source index for the merge.
+    last_key = None
+
+    for record in records:
+        key = record.values.get(primary_key)
+        if key is None:
+            raise Exception("Record {} is missing the primary key {}.".format(record, primary_key))
+
+        if last_key is not None and key <= last_key:
+            if key == last_key:
+                raise Exception("Source contains records with the same primary key.")
+
+            raise Exception("Source {} is not sorted by the primary key {} (input line {})."
+                            .format(index + 1, primary_key, record.input_line()))
+
+        last_key = key
+        record.primary_key = primary_key
+        yield (key, index, record)
+
+
+def merge_presorted(streams, primary_key):
+    # k-way merge of record streams sorted by primary key. Yields, for each key, a list of (source index, record)
+    # pairs in source order. Keys are unique within a source, so records themselves are never compared.
+    merged = heapq.merge(*[presorted_records(records, primary_key, index) for (index, records) in enumerate(streams)])
+
+    for (key, group) in itertools.groupby(merged, key=lambda entry: entry[0]):
+        yield [(index, record) for (_, index, record) in group]
+
+
+def merge_union(streams, primary_key):
+    for group in merge_presorted(streams, primary_key):
+        yield group[0][1]
+
+
+def merge_intersect(streams, primary_key):
+    for group in merge_presorted(streams, primary_key):
+        if len(group) == len(streams):
+            yield group[0][1]
+
+
+def merge_xor(streams, primary_key):
+    for group in merge_presorted(streams, primary_key):
+        if len(group) == 1:
+            yield group[0][1]
+
+
+def merge_subtract(streams, primary_key):
+    for group in merge_presorted(streams, primary_key):
+        if len(group) == 1 and group[0][0] == 0:
+            yield group[0][1]
+
+
+def fill_columns(records, headers):
+    # The streaming equivalent of unify_sources() for a single source's records.
+    for record in records:
+        for header in headers:
+            record.values[header] = u""
+
+        yield record
+
+
+def transform_records(records, drop=None, add=None, record_filter=None):
+    for record in records:
+        if drop is not None:
+            del record.values[drop]
+        if add is not None:
+            record.values[add[0]] = add[1]
+        if record_filter is None or record_filter(record):
+            yield record
+
+
+def joined_record(left, right, headers):
+    # Shared columns take the left source's value, as earlier sources take precedence in a union.
+    values = dict.fromkeys(headers, u"")
+    if right is not None:
+        values.update(right.values)
+    values.update(left.values)
+
+    return Record(values)
+
+
+def probe_table(table, probe, key, build_left, left_join, headers):
+    # Streams the probe records through a hash table of build records, keyed by the join column.
+    matched = set()
+
+    for record in probe:
+        matches = table.get(record.values[key], [])
+
+        if build_left:
+            for left in matches:
+                yield joined_record(left, record, headers)
+            if left_join and len(matches) > 0:
+                matched.add(record.values[key])
+        elif len(matches) > 0:
+            for right in matches:
+                yield joined_record(record, right, headers)
+        elif left_join:
+            yield joined_record(record, None, headers)
+
+    if build_left and left_join:
+        unmatched = [left for (value, lefts) in table.iteritems() if value not in matched for left in lefts]
+        for left in sorted(unmatched, key=lambda rec: rec.input_line()):
+            yield joined_record(left, None, headers)
+
+
+def build_table(records, key):
+    table = {}
+    for record in records:
+        table.setdefault(record.values[key], []).append(record)
+
+    return table
+
+
+def spill_partitions(records, key, partitions):
+    files = [tempfile.TemporaryFile() for i in range(partitions)]
+
+    for record in records:
+        partition = zlib.crc32(record.values[key].encode("utf-8")) % partitions
+        cPickle.dump((record.values, record.input_line()), files[partition], cPickle.HIGHEST_PROTOCOL)
+
+    return files
+
+
+def read_partition(spill_file):
+    spill_file.seek(0)
+
+    try:
+        while True:
+            (values, input_line) = cPickle.load(spill_file)
+            yield Record(values, inputline=input_line)
+    except EOFError:
+        pass
+    finally:
+        spill_file.close()
+
+
+def hash_join(build, probe, key, build_left, left_join, headers, budget, partitions=64):
+    # Joins the build and probe record streams on key, holding the build side in memory. Once more than budget
+    # build records have been read, both sides are instead partitioned by key into temporary files, and each
+    # pair of partitions is joined in turn; rows are then output partition by partition, not in probe order.
+    table = {}
+    rows = 0
+    build = iter(build)
+
+    for record in build:
+        table.setdefault(record.values[key], []).append(record)
+        rows += 1
+
+        if rows > budget:
+            stats.current.count("join.spilled_partitions", partitions)
+            held = (held_record for held_records in table.itervalues() for held_record in held_records)
+            build_files = spill_partitions(itertools.chain(held, build), key, partitions)
+            table = None
+            probe_files = spill_partitions(probe, key, partitions)
+
+            for (build_file, probe_file) in zip(build_files, probe_files):
+                for result in probe_table(build_table(read_partition(build_file), key), read_partition(probe_file),
+                                          key, build_left, left_join, headers):
+                    yield result
+            return
+
+    for result in probe_table(table, probe, key, build_left, left_join, headers):
+        yield result
+
+
+def file_size(infile):
+    try:
+        return os.fstat(infile.fileno()).st_size
+    except (AttributeError, OSError):
+        return float("inf")
+
+
+def run_join(args):
+    if len(args.infile) != 2:
+        sys.stderr.write("{}: --join and --left-join require exactly two sources.\n".format(sys.argv[0]))
+        return 1
+
+    left_join = args.left_join is not None
+    key = (args.left_join if left_join else args.join).decode(args.input_encoding)
+    ((left_headers, left_records), (right_headers, right_records)) = \
+        [iterate_source(each_file, get_format(each_file.name, args.input_format), encoding=args.input_encoding)
+         for each_file in args.infile]
+
+    if key not in left_headers or key not in right_headers:
+        sys.stderr.write("{}: the join column is missing from one or more sources.\n".format(sys.argv[0]))
+        return 1
+
+    # Headers are unified as by unify_sources().
+    headers = left_headers + [header for header in right_headers if header not in left_headers]
+
+    # Build the hash table on the smaller file.
+    build_left = file_size(args.infile[0]) < file_size(args.infile[1])
+    if build_left:
+        output = hash_join(left_records, right_records, key, True, left_join, headers, args.join_memory)
+    else:
+        output = hash_join(right_records, left_records, key, False, left_join, headers, args.join_memory)
+
+    return write_streamed(args, headers, output)
+
+
+DIFF_STATUS = u"Diff Status"
+DIFF_CHANGED_COLUMNS = u"Changed Columns"
+
+
+def row_hashes(record, columns):
+    # A CRC-32 of each column's value, packed into a string of four bytes per column. A column missing from the
+    # record compares as blank, as unify_sources() would fill it.
+    return array.array("I", [zlib.crc32(record.values.get(column, u"").encode("utf-8")) & 0xffffffff
+                             for column in columns]).tostring()
+
+
+def diff_record(record, columns, status, changed=()):
+    values = dict((column, record.values.get(column, u"")) for column in columns)
+    values[DIFF_STATUS] = status
+    values[DIFF_CHANGED_COLUMNS] = u", ".join(changed)
+
+    return Record(values, inputline=record.input_line())
+
+
+def diff_snapshots(old, new, key, columns, compared, reread_old=None):
+    # Streams the new snapshot's records against a table of the old snapshot's row hashes, keyed by key. Yields
+    # added and changed records in the new snapshot's order, then removed records, with the given columns. Records
+    # have changed if they differ in any of the compared columns. Only hashes of old rows are held,
+    # so removed records are read again from reread_old(), which returns the old records or None if they cannot be
+    # read twice; in that case only their keys are output.
+    table = {}
+    for record in old:
+        if record.values[key] in table:
+            raise Exception("Source contains records with the same primary key.")
+        table[record.values[key]] = row_hashes(record, compared)
+
+    # A key's entry is set to None once it is seen in the new snapshot.
+    for record in new:
+        old_hashes = table.get(record.values[key], False)
+        if old_hashes is None:
+            raise Exception("Source contains records with the same primary key.")
+        table[record.values[key]] = None
+
+        if old_hashes is False:
+            stats.current.count("diff.added")
+            yield diff_record(record, columns, u"added")
+        else:
+            new_hashes = row_hashes(record, compared)
+            if new_hashes != old_hashes:
+                changed = [column for (column, old_hash, new_hash)
+                           in zip(compared, array.array("I", old_hashes), array.array("I", new_hashes))
+                           if old_hash != new_hash]
+                stats.current.count("diff.changed")
+                yield diff_record(record, columns, u"changed", changed)
+
+    removed = set(record_key for (record_key, hashes) in table.iteritems() if hashes is not None)
+    table = None
+    stats.current.count("diff.removed", len(removed))
+
+    old = reread_old() if reread_old is not None and len(removed) > 0 else None
+    if old is not None:
+        for record in old:
+            if record.values[key] in removed:
+                yield diff_record(record, columns, u"removed")
+    else:
+        for record_key in sorted(removed):
+            yield diff_record(Record({key: record_key}), columns, u"removed")
+
+
+def run_diff(args):
+    if len(args.infile) != 2 or not args.primary_key:
+        sys.stderr.write("{}: --diff requires exactly two sources (the old snapshot, then the new) and --primary-key.\n"
+                         .format(sys.argv[0]))
+        return 1
+
+    key = args.primary_key.decode(args.input_encoding)
+    (old_file, new_file) = args.infile
+    ((old_headers, old_records), (new_headers, new_records)) = \
+        [iterate_source(each_file, get_format(each_file.name, args.input_format), encoding=args.input_encoding)
+         for each_file in args.infile]
+
+    if key not in old_headers or key not in new_headers:
+        sys.stderr.write("{}: one or more records is missing the specified primary key.\n".format(sys.argv[0]))
+        return 1
+
+    columns = new_headers + [header for header in old_headers if header not in new_headers]
+    # A column added or dropped between the snapshots would otherwise make every row a change.
+    compared = [header for header in new_headers if header in old_headers]
+
+    def reread_old():
+        # The old snapshot can be read again only if it is a regular file.
+        try:
+            old_file.seek(0)
+        except (AttributeError, IOError):
+            return None
+
+        return iterate_source(old_file, get_format(old_file.name, args.input_format),
+                              encoding=args.input_encoding)[1]
+
+    output = diff_snapshots(old_records, new_records, key, columns, compared, reread_old)
+
+    return write_streamed(args, columns + [DIFF_STATUS, DIFF_CHANGED_COLUMNS], output, key, "snapshots")
+
+
+def indexed_records(records, references, primary_key, intersect):
+    # Streams records of the first source, keeping those present in every reference (for an intersection) or in
+    # none (for a subtraction).
+    seen = set()
+
+    for record in records:
+        key = record.values.get(primary_key)
+        if key is None:
+            raise Exception("Record {} is missing the primary key {}.".format(record, primary_key))
+        if key in seen:
+            raise Exception("Source contains records with the same primary key.")
+        seen.add(key)
+
+        present = [reference.contains_record(record) for reference in references]
+        if (intersect and all(present)) or (not intersect and not any(present)):
+            record.primary_key = primary_key
+            yield record
+
+
+def run_indexed(args):
+    if not args.primary_key or args.keep_duplicates or not (args.intersect or args.subtract) \
+            or len(args.infile) < 2:
+        sys.stderr.write("{}: --indexed requires --intersect or --subtract, at least two sources and --primary-key, "
+                         "and cannot be used with --keep-duplicates.\n".format(sys.argv[0]))
+        return 1
+
+    primary_key = args.primary_key.decode(args.input_encoding)
+    each_file = args.infile[0]
+    (headers, records) = iterate_source(each_file, get_format(each_file.name, args.input_format),
+                                        encoding=args.input_encoding)
+
+    try:
+        references = [OffsetIndexedSource(reference_file, get_format(reference_file.name, args.input_format),
+                                          primary_key, args.input_encoding)
+                      for reference_file in args.infile[1:]]
+    except Exception as e:
+        sys.stderr.write("{}: unable to index sources: {}\n".format(sys.argv[0], e))
+        return 1
+
+    stats.current.count("indexes.built", len([reference for reference in references if reference.built]))
+    all_headers = [headers] + [reference.headers() for reference in references]
+
+    if args.require_consistency:
+        if not all(set(source_headers) == set(headers) for source_headers in all_headers):
+            sys.stderr.write(
+                "{}: sources are not consistent and --require-consistency was specified.\n".format(sys.argv[0]))
+            return 1
+
+    if primary_key not in headers:
+        sys.stderr.write("{}: one or more records is missing the specified primary key.\n".format(sys.argv[0]))
+        return 1
+
+    # Headers are unified as by unify_sources(), though every row output comes from the first source.
+    missing = []
+    for each_header in [header for source_headers in all_headers[1:] for header in source_headers]:
+        if each_header not in headers and each_header not in missing:
+            missing.append(each_header)
+
+    output = indexed_records(records, references, primary_key, args.intersect)
+    if missing:
+        output = fill_columns(output, missing)
+
+    return write_streamed(args, headers + missing, output, primary_key, "indexed sources")
+
+
+AGGREGATES = ["sum", "count", "min", "max", "avg"]
+
+
+def parse_aggregates(specifications, encoding):
+    # Parses --agg FUNCTION[:COLUMN] options into (function, column, output header) tuples.
+    aggregates = []
+
+    for specification in specifications:
+        (function, _, column) = specification.decode(encoding).partition(u":")
+        function = function.lower()
+        if function not in AGGREGATES:
+            raise Exception("Invalid aggregate function {}.".format(function))
+        if len(column) == 0 and function != "count":
+            raise Exception("Aggregate function {} requires a column.".format(function))
+
+        aggregates.append((function, column or None, u"{}:{}".format(function, column) if column else function))
+
+    return aggregates
+
+
+def aggregate_rows(records, group_columns, aggregates):
+    # Reduces each record to (group key, inputs), where inputs holds what each aggregate needs from it.
+    # Each numeric column is parsed once per row, however many aggregates use it.
+    numeric = set(column for (function, column, header) in aggregates if column is not None and function != "count")
+
+    for record in records:
+        numbers = {}
+        for column in numeric:
+            value = record.values[column].strip()
+            # Blank values are ignored, as SQL ignores nulls.
+            numbers[column] = float(value) if len(value) > 0 else None
+
+        yield (tuple(record.values[column] for column in group_columns),
+               tuple(numbers[column] if function != "count"
+                     else (column is None or len(record.values[column].strip()) > 0)
+                     for (function, column, header) in aggregates))
+
+
+def update_aggregates(state, aggregates, inputs):
+    # state holds a [value, count] pair per aggregate.
+    for ((function, column, header), each_state, value) in zip(aggregates, state, inputs):
+        if function == "count":
+            if value:
+                each_state[1] += 1
+        elif value is not None:
+            if each_state[1] == 0:
+                each_state[0] = value
+            elif function == "sum" or function == "avg":
+                each_state[0] += value
+            elif function == "min":
+                each_state[0] = min(each_state[0], value)
+            elif function == "max":
+                each_state[0] = max(each_state[0], value)
+            each_state[1] += 1
+
+
+def aggregate_hash(rows, aggregates):
+    # Yields (group key, state) pairs in order of each group's first appearance.
+    groups = {}
+    order = []
+
+    for (key, inputs) in rows:
+        state = groups.get(key)
+        if state is None:
+            state = groups[key] = [[None, 0] for aggregate in aggregates]
+            order.append(key)
+        update_aggregates(state, aggregates, inputs)
+
+    for key in order:
+        yield (key, groups[key])
+
+
+def sorted_runs(rows, run_size):
+    # Sorts rows into runs of run_size, spilling each to a temporary file if there is more than one.
+    runs = []
+
+    for run in iter(lambda: list(itertools.islice(rows, run_size)), []):
+        run.sort()
+        if len(runs) == 0 and len(run) < run_size:
+            return [iter(run)]
+
+        run_file = tempfile.TemporaryFile()
+        for row in run:
+            cPickle.dump(row, run_file, cPickle.HIGHEST_PROTOCOL)
+        runs.append(read_run(run_file))
+
+    return runs
+
+
+def read_run(run_file):
+    run_file.seek(0)
+
+    try:
+        while True:
+            yield cPickle.load(run_file)
+    except EOFError:
+        pass
+    finally:
+        run_file.close()
+
+
+def aggregate_sorted(rows, aggregates, run_size):
+    # Yields (group key, state) pairs in key order, holding one group's state at a time. Rows are sorted by
+    # an external merge sort, so memory use is bounded by run_size however many groups there are.
+    for (key, group) in itertools.groupby(heapq.merge(*sorted_runs(rows, run_size)), key=lambda row: row[0]):
+        state = [[None, 0] for aggregate in aggregates]
+        for (_, inputs) in group:
+            update_aggregates(state, aggregates, inputs)
+
+        yield (key, state)
+
+
+def format_number(value):
+    if value == int(value) and abs(value) < 1e15:
+        return unicode(int(value))
+
+    return unicode(value)
+
+
+def group_records(args, headers, records):
+    # Aggregates records by the --group-by columns, returning a Source with a row for each group.
+    group_columns = [column.decode(args.input_encoding) for column in args.group_by]
+    aggregates = parse_aggregates(args.agg or [], args.input_encoding)
+
+    for column in group_columns + [column for (function, column, header) in aggregates if column is not None]:
+        if column not in headers:
+            raise Exception(u"Column {} does not exist.".format(column))
+    rows = aggregate_rows(records, group_columns, aggregates)
+
+    if args.group_mode == "sort":
+        groups = aggregate_sorted(rows, aggregates, args.group_memory)
+    else:
+        groups = aggregate_hash(rows, aggregates)
+
+    output = Source(group_columns + [header for (function, column, header) in aggregates])
+    for (key, state) in groups:
+        values = dict(zip(group_columns, key))
+        for ((function, column, header), (value, count)) in zip(aggregates, state):
+            if function == "count":
+                values[header] = unicode(count)
+            elif count == 0:
+                values[header] = u""
+            else:
+                values[header] = format_number(value / count if function == "avg" else value)
+        output.add_record(Record(values))
+
+    stats.current.count("groups", len(output.records()))
+
+    return output
+
+
+def run_grouped(args):
+    # Group a single source as it is read.
+    each_file = args.infile[0]
+    (headers, records) = iterate_source(each_file, get_format(each_file.name, args.input_format),
+                                        encoding=args.input_encoding)
+
+    return write_streamed(args, headers, records)
+
+
+def filter_columns(expression):
+    # The columns read by a filter expression that reads records only as record["column"], or None.
+    tree = ast.parse(expression, mode="eval")
+    columns = []
+    subscripted = []
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == "record" \
+                and isinstance(node.slice, ast.Index) and isinstance(node.slice.value, ast.Str):
+            columns.append(node.slice.value.s)
+            subscripted.append(node.value)
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == "record" and node not in subscripted:
+            return None
+
+    return columns
+
+
+def pushdown_sources(args, columns):
+    # The indices of the sources whose rows can be filtered as they are loaded, without changing the output.
+    if columns is None:
+        return []
+
+    columns = [column.decode(args.input_encoding) if isinstance(column, str) else column for column in columns]
+
+    # --drop and --add run before the filter, and change the columns it sees.
+    if (args.drop and args.drop.decode(args.input_encoding) in columns) \
+            or (args.add and args.add[0].decode(args.input_encoding) in columns):
+        return []
+
+    if args.primary_key and not args.keep_duplicates:
+        # Loading checks that primary keys are unique, and a discarded row could hide a duplicate.
+        return []
+
+    if args.intersect or args.xor:
+        # Whether a row is output depends on rows in other sources, which the filter might discard.
+        return []
+    elif args.subtract:
+        # Rows in later sources remove rows from the first whatever their own values.
+        return [0]
+
+    return range(len(args.infile))
+
+
+def filter_predicate(code):
+    def predicate(record):
+        try:
+            return bool(eval(code, {"record": record.values}))
+        except Exception:
+            # Keep the record and leave the error (e.g. a column this source lacks) to the final filter.
+            return True
+
+    return predicate
+
+
+def run_presorted(args):
+    if not args.primary_key or args.keep_duplicates:
+        sys.stderr.write("{}: --presorted requires --primary-key and cannot be used with --keep-duplicates.\n"
+                         .format(sys.argv[0]))
+        return 1
+
+    primary_key = args.primary_key.decode(args.input_encoding)
+    streams = [iterate_source(each_file, get_format(each_file.name, args.input_format), encoding=args.input_encoding)
+               for each_file in args.infile]
+    all_headers = [headers for (headers, records) in streams]
+
+    if args.require_consistency:
+        if not all(set(headers) == set(all_headers[0]) for headers in all_headers):
+            sys.stderr.write(
+                "{}: sources are not consistent and --require-consistency was specified.\n".format(sys.argv[0]))
+            return 1
+
+    headers = []
+    for each_header in [header for source_headers in all_headers for header in source_headers]:
+        if each_header not in headers:
+            headers.append(each_header)
+
+    if not all(primary_key in source_headers for source_headers in all_headers):
+        sys.stderr.write("{}: one or more records is missing the specified primary key.\n".format(sys.argv[0]))
+        return 1
+
+    record_streams = []
+    for (source_headers, records) in streams:
+        missing = [header for header in headers if header not in source_headers]
+        record_streams.append(fill_columns(records, missing) if missing else records)
+
+    if args.union:
+        output = merge_union(record_streams, primary_key)
+    elif args.intersect:
+        output = merge_intersect(record_streams, primary_key)
+    elif args.subtract:
+        output = merge_subtract(record_streams, primary_key)
+    elif args.xor:
+        output = merge_xor(record_streams, primary_key)
+    else:
+        if len(record_streams) > 1:
+            sys.stderr.write(
+                "{}: more than one source was provided, but no combining operator (--union, --intersect, --subtract, "
+                "--xor) was specified.\n".format(sys.argv[0]))
+            return 1
+
+        # With a single source, this still checks the sort order.
+        output = merge_union(record_streams, primary_key)
+
+    return write_streamed(args, headers, output, primary_key, "presorted sources")
+
+
+def write_streamed(args, headers, output, primary_key=None, description="sources"):
+    # Applies --drop, --add, --filter and --sort to a stream of records with the given headers, and writes them.
+    drop = None
+    add = None
+    record_filter = None
+
+    if args.drop:
+        drop = args.drop.decode(args.input_encoding)
+        if drop == primary_key:
+            sys.stderr.write("{}: cannot remove the column containing the primary key.\n".format(sys.argv[0]))
+            return 1
+        headers.remove(drop)
+    if args.add:
+        add = (args.add[0].decode(args.input_encoding), args.add[1].decode(args.input_encoding))
+        headers.append(add[0])
+    if args.filter:
+        record_filter = lambda rec: bool(eval(args.filter, {"record": rec.values}))
+
+    output = stats.current.track("write", transform_records(output, drop, add, record_filter))
+
+    try:
+        output_format = get_format(args.output.name, args.output_format)
+
+        if args.group_by:
+            source = group_records(args, headers, output)
+            if args.sort:
+                source.sort_records(args.sort)
+            write_source(source, args.output, output_format, encoding=args.output_encoding)
+        elif args.sort:
+            # Sorting needs every record in hand.
+            source = Source(headers)
+            for record in output:
+                source.add_record(record)
+            source.sort_records(args.sort)
+            write_source(source, args.output, output_format, encoding=args.output_encoding)
+        else:
+            write_records(headers, output, args.output, output_format, encoding=args.output_encoding)
+    except Exception as e:
+        sys.stderr.write("{}: an error occured while processing {}: {}\n".format(sys.argv[0], description, e))
+        return 1
+
+    return 0
+
+
 def main():
     parser = argparse.ArgumentParser(description="Manipulate and combine tabular data files.")
     parser.add_argument("--require-consistency",
@@ -112,7 +799,9 @@ def main():
     parser.add_argument("--filter",
                         help="Filter records using the Boolean-valued Python expression provided. "
                              "Each record is provided as a dictionary called 'record'. If specified together with a "
-                             "combining operation or --add/--drop, filter is run last.")
+                             "combining operation or --add/--drop, filter is run last. (Filters that read only "
+                             "record[\"column\"] are also run as sources are loaded, where this cannot change "
+                             "the output.)")
     parser.add_argument("--sort",
                         nargs=2,
                         action=SortAction,
@@ -139,6 +828,31 @@ def main():
                         help="Add a column with the name given and pre-fill the supplied value "
                              "(which may be the empty string).")
 
+    parser.add_argument("--group-by",
+                        action="append",
+                        metavar="COLUMN",
+                        help="Output one row for each distinct value of this column (which may be specified multiple "
+                             "times), with the aggregates given by --agg. Grouping is run after combining operations, "
+                             "--add/--drop and --filter, and before sorting.")
+    parser.add_argument("--agg",
+                        action="append",
+                        metavar="FUNCTION[:COLUMN]",
+                        help="With --group-by, add a column aggregating each group. FUNCTION is one of sum, count, "
+                             "min, max or avg, and applies to the numbers in COLUMN; blank values are ignored. "
+                             "count without a column counts rows. May be specified multiple times.")
+    parser.add_argument("--group-mode",
+                        choices=["hash", "sort"],
+                        default="hash",
+                        help="Aggregate groups in a hash table (the default; groups are output in order of first "
+                             "appearance), or by sorting rows on the group columns, which bounds memory use for very "
+                             "many groups (groups are output in order).")
+    parser.add_argument("--group-memory",
+                        type=int,
+                        default=1000000,
+                        metavar="ROWS",
+                        help="With --group-mode sort, the number of rows to sort in memory before spilling to a "
+                             "temporary file.")
+
     parser.add_argument("--primary-key",
                         help="Set the column name where primary record identifiers are stored. If this column is not "
                              "present in all sources, an error will occur. This option is ignored if "
@@ -147,6 +861,27 @@ def main():
                         action="store_true",
                         default=False,
                         help="When performing a union or subtract operation, retain duplicate records")
+    parser.add_argument("--join-memory",
+                        type=int,
+                        default=1000000,
+                        metavar="ROWS",
+                        help="With --join or --left-join, the number of rows of the smaller source to hold in memory. "
+                             "Beyond this, both sources are partitioned into temporary files and joined a partition "
+                             "at a time, and rows are output grouped by partition rather than in source order.")
+    parser.add_argument("--indexed",
+                        action="store_true",
+                        default=False,
+                        help="With --intersect or --subtract and --primary-key, stream the first source and look up "
+                             "its rows in the later sources by primary key, rather than loading them. Each later "
+                             "source must be an uncompressed delimited file, and is indexed by the byte offset of "
+                             "each row in a file beside it (with .tidx appended to its name), which is reused until "
+                             "the source changes.")
+    parser.add_argument("--presorted",
+                        action="store_true",
+                        default=False,
+                        help="Treat all inputs as already sorted (as strings) by --primary-key and perform combining "
+                             "operations as a streaming merge, using constant memory per input. Sortedness is "
+                             "checked as records are read. Output is in primary key order.")
 
     verbs = parser.add_mutually_exclusive_group()
     verbs.add_argument("--union",
@@ -166,6 +901,31 @@ def main():
                        action="store_true",
                        help="Output rows present in one and only one source. Identity semantics as in --union. "
                             "Does not retain duplicates")
+    verbs.add_argument("--join",
+                       metavar="COLUMN",
+                       help="Join two sources, outputting a row for each pair of rows with the same value in the "
+                            "given column. Columns present in both sources take the first source's values. "
+                            "Output follows the order of the larger source, unless --join-memory is exceeded, in "
+                            "which case the order is unspecified.")
+    verbs.add_argument("--left-join",
+                       metavar="COLUMN",
+                       help="As --join, but also output rows of the first source with no match in the second, "
+                            "leaving the second source's columns blank.")
+    verbs.add_argument("--diff",
+                       action="store_true",
+                       help="Compare two snapshots of a sheet, the old and then the new, by --primary-key. Outputs "
+                            "each added, removed or changed row, with a Diff Status column and a Changed Columns "
+                            "column listing the columns that differ; only columns present in both snapshots are "
+                            "compared. Only a hash of each old row is held in memory; removed rows are read again "
+                            "from the old snapshot, or give only their key if it is standard input.")
+
+    parser.add_argument("--stats",
+                        type=argparse.FileType('w'),
+                        help="Write per-stage timings, peak memory use and counters to the given file as JSON.")
+    parser.add_argument("--progress",
+                        action="store_true",
+                        default=False,
+                        help="Report progress in rows per second on standard error.")
 
     parser.add_argument("infile",
                         nargs="*",
@@ -174,6 +934,18 @@ def main():
 
     args = parser.parse_args()
 
+    if args.stats or args.progress:
+        stats.enable(progress=args.progress)
+
+    result = run(args)
+
+    if args.stats:
+        stats.current.write(args.stats)
+
+    return result
+
+
+def run(args):
     # Load all sources
     sources = []
 
@@ -181,74 +953,114 @@ def main():
         sys.stderr.write("{}: no sources were specified.\n".format(sys.argv[0]))
         return 1
 
-    for each_file in args.infile:
-        sources.append(load_source(each_file, get_format(each_file.name, args.input_format), args.input_encoding))
+    if args.presorted:
+        with stats.current.stage("merge"):
+            return run_presorted(args)
+
+    if args.indexed:
+        with stats.current.stage("lookup"):
+            return run_indexed(args)
+
+    if args.join is not None or args.left_join is not None:
+        with stats.current.stage("join"):
+            return run_join(args)
+
+    if args.diff:
+        with stats.current.stage("diff"):
+            return run_diff(args)
+
+    if args.group_by and len(args.infile) == 1 and not (args.union or args.intersect or args.subtract or args.xor):
+        with stats.current.stage("group"):
+            return run_grouped(args)
+
+    filter_code = compile(args.filter, "--filter", "eval") if args.filter else None
+
+    with stats.current.stage("load"):
+        pushdown = pushdown_sources(args, filter_columns(args.filter)) if args.filter else []
+
+        for (index, each_file) in enumerate(args.infile):
+            sources.append(load_source(each_file, get_format(each_file.name, args.input_format),
+                                       encoding=args.input_encoding,
+                                       predicate=filter_predicate(filter_code) if index in pushdown else None))
 
     # If we are ensuring consistency, quit if the files don't have the same column-set.
     # If not, unify them by adding missing columns.
-    if args.require_consistency:
-        if not sources_consistent(sources):
-            sys.stderr.write(
-                "{}: sources are not consistent and --require-consistency was specified.\n".format(sys.argv[0]))
-            return 1
-    else:
-        sources = unify_sources(sources)
+    with stats.current.stage("unify"):
+        if args.require_consistency:
+            if not sources_consistent(sources):
+                sys.stderr.write(
+                    "{}: sources are not consistent and --require-consistency was specified.\n".format(sys.argv[0]))
+                return 1
+        else:
+            sources = unify_sources(sources)
 
-    # If a primary key was provided, ensure that all records have a primary key.
+        # If a primary key was provided, ensure that all records have a primary key.
 
-    if args.primary_key and not args.keep_duplicates:
-        for source in sources:
-            try:
-                source.set_primary_key(args.primary_key.decode(args.input_encoding))
-            except KeyError:
-                sys.stderr.write("{}: one or more records is missing the specified primary key.\n".format(sys.argv[0]))
-                return 1
+        if args.primary_key and not args.keep_duplicates:
+            for source in sources:
+                try:
+                    source.set_primary_key(args.primary_key.decode(args.input_encoding))
+                except KeyError:
+                    sys.stderr.write("{}: one or more records is missing the specified primary key.\n"
+                                     .format(sys.argv[0]))
+                    return 1
 
     # Determine operation and ensure appropriate inputs are provided
 
-    if args.union:
-        output = action_union(sources, args.keep_duplicates)
-    elif args.intersect:
-        output = action_intersect(sources)
-    elif args.subtract:
-        output = action_subtract(sources, args.keep_duplicates)
-    elif args.xor:
-        output = action_xor(sources)
-    else:
-        if len(sources) > 1:
-            sys.stderr.write(
-                "{}: more than one source was provided, but no combining operator (--union, --intersect, --subtract, "
-                "--xor) was specified.\n".format(sys.argv[0]))
-            return 1
+    with stats.current.stage("combine"):
+        if args.union:
+            output = action_union(sources, args.keep_duplicates)
+        elif args.intersect:
+            output = action_intersect(sources)
+        elif args.subtract:
+            output = action_subtract(sources, args.keep_duplicates)
+        elif args.xor:
+            output = action_xor(sources)
         else:
-            # We're operating on a single file.
-            output = sources[0]
+            if len(sources) > 1:
+                sys.stderr.write(
+                    "{}: more than one source was provided, but no combining operator (--union, --intersect, "
+                    "--subtract, --xor) was specified.\n".format(sys.argv[0]))
+                return 1
+            else:
+                # We're operating on a single file.
+                output = sources[0]
 
     # Run drop, add, and filter after the combination operations have completed.
 
-    if args.drop:
-        output.drop_column(args.drop.decode(args.input_encoding))
-    if args.add:
-        output.add_column(args.add[0].decode(args.input_encoding), args.add[1].decode(args.input_encoding))
-    if args.filter:
-        # This is incredibly fucking dangerous and if you run it on a server you're an idiot.
-        output.filter_records(lambda rec: bool(eval(args.filter, {"record": rec.values})))
+    with stats.current.stage("filter"):
+        if args.drop:
+            output.drop_column(args.drop.decode(args.input_encoding))
+        if args.add:
+            output.add_column(args.add[0].decode(args.input_encoding), args.add[1].decode(args.input_encoding))
+        if args.filter:
+            # This is incredibly fucking dangerous and if you run it on a server you're an idiot.
+            output.filter_records(lambda rec: bool(eval(filter_code, {"record": rec.values})))
+
+    if args.group_by:
+        try:
+            with stats.current.stage("group"):
+                output = group_records(args, output.headers(), output.records())
+        except Exception as e:
+            sys.stderr.write("{}: an error occured while grouping records: {}\n".format(sys.argv[0], e))
+            return 1
 
     # Sort the final records
 
     if args.sort:
         # FIXME: need Unicode support
-        output.sort_records(args.sort)
+        with stats.current.stage("sort"):
+            output.sort_records(args.sort)
 
     try:
-        output_format = get_format(args.output.name, args.output_format)
-        write_source(output, args.output, output_format, encoding=args.output_encoding)
+        with stats.current.stage("write"):
+            output_format = get_format(args.output.name, args.output_format)
+            write_source(output, args.output, output_format, encoding=args.output_encoding)
     except Exception as e:
         sys.stderr.write("{}: an error occured while writing output: {}\n".format(sys.argv[0], e))
         return 1
 
     return 0
 
-
 if __name__ == '__main__':
     exit(main())
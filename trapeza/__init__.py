@@ -1 +1,2 @@
-from .trapeza import *
\ No newline at end of file
+from .trapeza import *
+from .trapeza import __version__
\ No newline at end of file
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+#  trapeza/cache.py
+#  
+#  Copyright 2013-2014 David Reed <david@ktema.org>
+#  This file is available under the terms of the MIT License.
+#
+
+# A directory of pickled ProcessedSources, named by a fingerprint of the master and profile files they were built
+# from, and of everything else that decides how those files are read. Entries are written under a temporary name
+# and renamed into place, so readers never see a partial file, and the least recently used are evicted once the
+# directory grows past its size limit.
+
+import cPickle
+import hashlib
+import os
+import tempfile
+from trapeza import __version__
+
+__all__ = ["ProcessedCache"]
+
+
+class ProcessedCache(object):
+    SUFFIX = ".processed"
+    # Bump whenever the pickled form of a ProcessedSource changes, so that stale entries are not reused.
+    FORMAT_VERSION = 3
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def fingerprint(master_file, master_format, profile_file, profile_format, primary_key, encoding):
+        # Hashes the contents of the (seekable) master and profile files, which are rewound afterwards, together with
+        # their formats, the input encoding, the primary key and the trapeza version.
+        sha = hashlib.sha1()
+        for setting in [str(ProcessedCache.FORMAT_VERSION), __version__, master_format, profile_format, encoding,
+                        primary_key.encode("utf-8")]:
+            sha.update(setting + "\0")
+
+        for each_file in [master_file, profile_file]:
+            # Fails (with IOError) before anything is consumed if the file cannot be rewound.
+            each_file.seek(0)
+            for chunk in iter(lambda: each_file.read(65536), ""):
+                sha.update(chunk)
+            sha.update("\0{}\0".format(each_file.tell()))
+            each_file.seek(0)
+
+        return sha.hexdigest()
+
+    def path(self, fingerprint):
+        return os.path.join(self.directory, fingerprint + ProcessedCache.SUFFIX)
+
+    def get(self, fingerprint):
+        # Returns the cached ProcessedSource, or None.
+        path = self.path(fingerprint)
+
+        try:
+            with open(path, "rb") as cache_file:
+                processed = cPickle.load(cache_file)
+        except IOError:
+            return None
+        except Exception:
+            # A corrupt or incompatible entry; drop it and rebuild.
+            self.remove(path)
+            return None
+
+        # Mark the entry as recently used.
+        os.utime(path, None)
+
+        return processed
+
+    def put(self, fingerprint, processed):
+        (handle, temporary_path) = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+
+        try:
+            with os.fdopen(handle, "wb") as cache_file:
+                cPickle.dump(processed, cache_file, cPickle.HIGHEST_PROTOCOL)
+
+            if os.name == "nt" and os.path.exists(self.path(fingerprint)):
+                # Windows cannot rename over an existing file.
+                os.remove(self.path(fingerprint))
+            os.rename(temporary_path, self.path(fingerprint))
+        except Exception:
+            self.remove(temporary_path)
+            raise
+
+        self.evict(keep=self.path(fingerprint))
+
+    def entries(self):
+        # Returns a list of (path, size, last use) tuples, least recently used first.
+        entries = []
+
+        for name in os.listdir(self.directory):
+            if name.endswith(ProcessedCache.SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, status.st_size, status.st_mtime))
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self, keep=None):
+        if self.max_bytes is None:
+            return
+
+        entries = self.entries()
+        total = sum(size for (path, size, last_use) in entries)
+
+        for (path, size, last_use) in entries:
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                self.remove(path)
+                total -= size
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+#  trapeza/checkpoint.py
+#
+#  Copyright 2013-2014 David Reed <david@ktema.org>
+#  This file is available under the terms of the MIT License.
+#
+
+# Records the progress of a long run, so that it can resume where it left off. A checkpoint is a JSON state file
+# and, beside it, the output written so far (the state file's path with ".output" appended). The state gives a
+# fingerprint of the run's inputs and settings, a position in its input, and the length of the output accounting
+# for every record up to that position. Output beyond that length was written after the state was saved, and is
+# discarded on resuming.
+
+import hashlib
+import json
+import os
+import time
+
+__all__ = ["Checkpoint"]
+
+
+class Checkpoint(object):
+    def __init__(self, path, fingerprint, interval=60):
+        self.path = path
+        self.output_path = path + ".output"
+        self.fingerprint = fingerprint
+        self.interval = interval
+        self.saved = time.time()
+
+    @staticmethod
+    def fingerprint_of(paths, settings):
+        # Input files are identified by their path, size and modification time, rather than read in full.
+        sha = hashlib.sha1()
+        sha.update(json.dumps(settings))
+
+        for path in paths:
+            status = os.stat(path)
+            sha.update("\0{}\0{}\0{}".format(os.path.abspath(path), status.st_size, status.st_mtime))
+
+        return sha.hexdigest()
+
+    def load(self):
+        # Returns the (position, output length) saved for a run with this fingerprint, or None.
+        try:
+            with open(self.path, "rb") as state_file:
+                state = json.load(state_file)
+        except (IOError, ValueError):
+            return None
+
+        if state.get("fingerprint") != self.fingerprint or not os.path.exists(self.output_path) \
+                or os.path.getsize(self.output_path) < state["offset"]:
+            return None
+
+        return (state["position"], state["offset"])
+
+    def open_output(self, offset=0):
+        # Opens the output for writing, discarding anything after offset.
+        output = open(self.output_path, "r+b" if offset > 0 else "wb")
+        output.truncate(offset)
+        output.seek(offset)
+
+        return output
+
+    def save(self, position, output, force=False):
+        # Records that output accounts for every record up to position, if interval seconds have passed since
+        # the last save (or if force is set).
+        now = time.time()
+        if not force and now - self.saved < self.interval:
+            return
+
+        output.flush()
+        os.fsync(output.fileno())
+
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "wb") as state_file:
+            json.dump({"fingerprint": self.fingerprint, "position": position, "offset": output.tell()}, state_file)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+
+        if os.name == "nt" and os.path.exists(self.path):
+            # Windows cannot rename over an existing file.
+            os.remove(self.path)
+        os.rename(temporary_path, self.path)
+
+        self.saved = now
+
+    def remove(self):
+        for path in [self.path, self.output_path]:
+            if os.path.exists(path):
+                os.remove(path)
@@ -8,5 +8,7 @@
 
 import delimited
 from plugins import importers_for_format, exporters_for_format, available_input_formats, available_output_formats
+from compression import split_format, CompressedReader, CompressedWriter
 
-__all__ = ["importers_for_format", "exporters_for_format", "available_input_formats", "available_output_formats"]
+__all__ = ["importers_for_format", "exporters_for_format", "available_input_formats", "available_output_formats",
+           "split_format", "CompressedReader", "CompressedWriter"]
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#
+#  trapeza/formats/compression.py
+#
+#  Copyright 2013-2014 David Reed <david@ktema.org>
+#  This file is available under the terms of the MIT License.
+#
+
+# Streaming compression around the format plugins. A compressed file has a compound format, such as csv.gz: the
+# plugins read and write the inner format through a CompressedReader or CompressedWriter, which (de)compress in
+# chunks as data passes through, optionally in a thread of their own so that compression overlaps with parsing.
+# Concatenated compressed streams, as produced by appending to a compressed file, are read as one.
+
+import Queue
+import bz2
+import sys
+import threading
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+__all__ = ["COMPRESSIONS", "available_compressions", "split_format", "CompressedReader", "CompressedWriter"]
+
+# The file extensions recognised as compression, whether or not the module each needs is installed.
+COMPRESSIONS = ["gz", "bz2", "xz"]
+
+_DONE = object()
+
+
+def available_compressions():
+    return [compression for compression in COMPRESSIONS if compression != "xz" or lzma is not None]
+
+
+def split_format(a_format):
+    # Returns a tuple (format, compression), where compression is None for an uncompressed format.
+    (inner, dot, compression) = a_format.rpartition(".")
+    if len(inner) > 0 and compression in COMPRESSIONS:
+        return (inner, compression)
+
+    return (a_format, None)
+
+
+def _codec(compression):
+    # Returns functions making a compressor and a decompressor for compression.
+    if compression == "gz":
+        return (lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+                lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+    elif compression == "bz2":
+        return (bz2.BZ2Compressor, bz2.BZ2Decompressor)
+    elif compression == "xz":
+        if lzma is None:
+            raise Exception("Reading or writing xz files requires the lzma module (backports.lzma).")
+        return (lzma.LZMACompressor, lzma.LZMADecompressor)
+
+    raise Exception("Unknown compression {}.".format(compression))
+
+
+def _finished(decompressor):
+    # Returns True if decompressor has reached the end of its stream. Python 2's zlib and bz2 decompressors have no
+    # eof attribute, but once finished they set aside any further input as unused_data, or raise EOFError.
+    if hasattr(decompressor, "eof"):
+        return decompressor.eof
+
+    try:
+        decompressor.decompress("\0")
+    except EOFError:
+        return True
+    except Exception:
+        return False
+
+    return len(decompressor.unused_data) > 0
+
+
+def _decompress(file_like_object, make_decompressor, chunk_size):
+    decompressor = make_decompressor()
+    empty = True
+
+    for chunk in iter(lambda: file_like_object.read(chunk_size), ""):
+        empty = False
+        while len(chunk) > 0:
+            try:
+                data = decompressor.decompress(chunk)
+            except EOFError:
+                # The last stream ended exactly at the end of the previous chunk; this one starts another.
+                decompressor = make_decompressor()
+                continue
+
+            if len(data) > 0:
+                yield data
+
+            chunk = decompressor.unused_data
+            if len(chunk) > 0:
+                decompressor = make_decompressor()
+
+    # A truncated file can end at a row boundary, and so otherwise parse without error. An empty file is taken to be
+    # empty, not truncated. (Check before flush(), which can end the decompressor.)
+    if not empty and not _finished(decompressor):
+        raise Exception("Compressed data ends in the middle of a stream; {} may be truncated.".format(
+            getattr(file_like_object, "name", "the file")))
+
+    if hasattr(decompressor, "flush"):
+        data = decompressor.flush()
+        if len(data) > 0:
+            yield data
+
+
+def _run_ahead(chunks, depth):
+    # Produces chunks in a separate thread, at most depth ahead of the consumer.
+    queue = Queue.Queue(depth)
+
+    def produce():
+        try:
+            for chunk in chunks:
+                queue.put(chunk)
+        except BaseException:
+            # The failure ends the chunks.
+            queue.put(sys.exc_info())
+            return
+        queue.put(_DONE)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    for chunk in iter(queue.get, _DONE):
+        if isinstance(chunk, tuple):
+            # Let the thread finish first: one still running when the interpreter exits can crash it.
+            thread.join()
+            raise chunk[0], chunk[1], chunk[2]
+        yield chunk
+
+
+class CompressedReader(object):
+    # A readable file-like object returning the decompressed contents of file_like_object.
+    def __init__(self, file_like_object, compression, threaded=True, chunk_size=65536, depth=4):
+        self.name = getattr(file_like_object, "name", None)
+        self.chunks = _decompress(file_like_object, _codec(compression)[1], chunk_size)
+        if threaded:
+            self.chunks = _run_ahead(self.chunks, depth)
+        self.buffer = ""
+
+    def read(self, size=-1):
+        pieces = [self.buffer]
+        length = len(self.buffer)
+
+        while size < 0 or length < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            pieces.append(chunk)
+            length += len(chunk)
+
+        data = "".join(pieces)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+
+        return data[:size]
+
+
+class CompressedWriter(object):
+    # A writable file-like object compressing what is written to it into file_like_object. close() completes the
+    # compressed stream, but does not close file_like_object.
+    def __init__(self, file_like_object, compression, threaded=True, depth=4):
+        self.name = getattr(file_like_object, "name", None)
+        self.file_like_object = file_like_object
+        self.compressor = _codec(compression)[0]()
+        self.queue = None
+        self.error = None
+
+        if threaded:
+            self.queue = Queue.Queue(depth)
+            self.thread = threading.Thread(target=self.__run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, data):
+        if self.queue is None:
+            self.__compress(data)
+        else:
+            self.__check()
+            self.queue.put(data)
+
+    def close(self):
+        if self.queue is not None:
+            self.queue.put(_DONE)
+            self.thread.join()
+            self.__check()
+
+        self.file_like_object.write(self.compressor.flush())
+        self.file_like_object.flush()
+
+    def __compress(self, data):
+        compressed = self.compressor.compress(data)
+        if len(compressed) > 0:
+            self.file_like_object.write(compressed)
+
+    def __run(self):
+        for data in iter(self.queue.get, _DONE):
+            # After a failure, keep draining the queue so that writers do not block.
+            if self.error is None:
+                try:
+                    self.__compress(data)
+                except BaseException:
+                    self.error = sys.exc_info()
+
+    def __check(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
@@ -5,47 +5,160 @@
 #  Copyright 2013-2014 David Reed <david@ktema.org>
 #  This file is available under the terms of the MIT License.
 
-import csv, trapeza, plugins, io
+import csv, trapeza, plugins, io, codecs
 
 __all__ = [ "DelimitedImporter", "DelimitedExporter" ]
 
 
+def _split_lines(file_like_object, encoding = "utf-8", chunk_size = 65536):
+    # Python's csv module chokes on mixed/foreign newlines (which Excel is prone to outputting).
+    # Split the input ourselves as it is read, honoring \r, \n and \r\n just like str.splitlines().
+    decoder = codecs.getincrementaldecoder(encoding)() if encoding != "utf-8" else None
+    pending = ""
+
+    while True:
+        chunk = file_like_object.read(chunk_size)
+        if decoder is not None:
+            # Python's csv module is (mostly) 8-bit clean and will deal with UTF-8
+            chunk = decoder.decode(chunk, len(chunk) == 0).encode("utf-8")
+
+        if len(chunk) == 0:
+            break
+
+        lines = (pending + chunk).splitlines(True)
+        # The last line may be incomplete (or a \r whose \n is in the next chunk); hold it back.
+        pending = lines.pop()
+
+        for line in lines:
+            yield line.rstrip("\r\n")
+
+    if len(pending) > 0:
+        yield pending.rstrip("\r\n")
+
+
+def _buffer_lines(buffer, offset):
+    # Lines of buffer from offset, with their line endings. Unlike mmap.readline(), this leaves the mmap's position
+    # alone. Only \n (and \r\n) line endings are recognised.
+    while offset < len(buffer):
+        end = buffer.find("\n", offset)
+        end = len(buffer) if end < 0 else end + 1
+        yield buffer[offset:end]
+        offset = end
+
+
 class DelimitedImporter(plugins.Importer):
     formats = ["csv", "tsv", "chr"]
+    indexable = True
 
-    def read(self, file_like_object, file_format = "csv", sheet_name = None, encoding = "utf-8"):
-        data = file_like_object.read()
-        
-        if encoding != "utf-8":
-            # Python's csv module is (mostly) 8-bit clean and will deal with UTF-8
-            data = data.decode(encoding).encode("utf-8")
-                    
-        # However, it chokes on mixed/foreign newlines (which Excel is prone to outputting).
-        # Use .splitlines() to address this
-        reader = csv.DictReader(data.splitlines(), dialect=("excel" if file_format == "csv" else "excel-tab"))
-        source = trapeza.Source([fieldname.decode("utf-8") for fieldname in reader.fieldnames])
-    
-        for (index, rec) in enumerate(reader):
-            source.add_record(trapeza.Record({k.decode("utf-8"): v.decode("utf-8") for k, v in rec.iteritems()}, inputline = index + 1))
+    def read(self, file_like_object, file_format = "csv", sheet_name = None, encoding = "utf-8", columns = None):
+        (headers, records) = self.iterate(file_like_object, file_format, sheet_name, encoding, columns)
+        source = trapeza.Source(headers)
+
+        for record in trapeza.stats.current.track("load", records):
+            source.add_record(record)
 
         return source
 
-        
+    def iterate(self, file_like_object, file_format = "csv", sheet_name = None, encoding = "utf-8", columns = None):
+        reader = csv.reader(_split_lines(file_like_object, encoding),
+                            dialect=("excel" if file_format == "csv" else "excel-tab"))
+        fieldnames = [fieldname.decode("utf-8") for fieldname in next(reader, [])]
+
+        # Only the projected columns are decoded and stored.
+        indices = [index for (index, fieldname) in enumerate(fieldnames) if columns is None or fieldname in columns]
+        headers = [fieldnames[index] for index in indices]
+
+        return (headers, self.__records(reader, fieldnames, indices))
+
+    def index(self, buffer, file_format = "csv", primary_key = None, encoding = "utf-8"):
+        # A single pass with no decoding but of the primary key. The csv module consumes exactly the lines making up
+        # each row, so a row starts where the last one ended. The encoding must be ASCII-compatible.
+        lines = _buffer_lines(buffer, 0)
+        position = [0]
+
+        def tracked():
+            for line in lines:
+                position[0] += len(line)
+                yield line
+
+        reader = csv.reader(tracked(), dialect=("excel" if file_format == "csv" else "excel-tab"))
+        fieldnames = [fieldname.decode(encoding) for fieldname in next(reader, [])]
+        if primary_key not in fieldnames:
+            raise Exception("Primary key {} does not exist in source.".format(primary_key))
+
+        key_index = fieldnames.index(primary_key)
+        offsets = {}
+        line = 0
+        start = position[0]
+
+        for row in reader:
+            if len(row) > 0:
+                line += 1
+                if len(row) != len(fieldnames):
+                    raise Exception("Line {} has {} fields, but there are {} columns.".format(
+                        line, len(row), len(fieldnames)))
+
+                key = row[key_index].decode(encoding)
+                if key in offsets:
+                    raise Exception("Source contains records with the same primary key.")
+                offsets[key] = start
+
+            start = position[0]
+
+        return (fieldnames, offsets)
+
+    def read_record(self, buffer, offset, file_format = "csv", headers = None, encoding = "utf-8"):
+        reader = csv.reader(_buffer_lines(buffer, offset), dialect=("excel" if file_format == "csv" else "excel-tab"))
+
+        return trapeza.Record(dict(zip(headers, [value.decode(encoding) for value in next(reader)])))
+
+    @staticmethod
+    def __records(reader, fieldnames, indices):
+        line = 0
+
+        for row in reader:
+            # Like csv.DictReader, skip blank lines.
+            if len(row) == 0:
+                continue
+
+            line += 1
+            if len(row) != len(fieldnames):
+                raise Exception("Line {} has {} fields, but there are {} columns.".format(
+                    line, len(row), len(fieldnames)))
+
+            yield trapeza.Record({fieldnames[index]: row[index].decode("utf-8") for index in indices}, inputline = line)
+
+
 class DelimitedExporter(plugins.Exporter):
-    formats = ["csv", "tsv", "chr"]            
-    
+    formats = ["csv", "tsv", "chr"]
+    appendable = True
+
     def write(self, source, file_like_object, file_format = "csv", sheet_name = None, encoding = "utf-8", line_endings = "\r\n"):
-        
+        self.write_records(source.headers(), source.records(), file_like_object, file_format, sheet_name, encoding,
+                           line_endings)
+
+    def write_records(self, headers, records, file_like_object, file_format = "csv", sheet_name = None,
+                      encoding = "utf-8", line_endings = "\r\n", buffer_size = 65536, write_header = True):
         temp_out = io.BytesIO()
-        
+
         writer = csv.DictWriter(temp_out,
-                                [header.encode("utf-8") for header in source.headers()],
+                                [header.encode("utf-8") for header in headers],
                                 dialect=("excel" if file_format == "csv" else "excel-tab"),
                                 lineterminator = line_endings if line_endings in ["\r\n", "\r", "\n"] else "\r\n")
-    
-        writer.writeheader()
-        writer.writerows([{k.encode("utf-8"): v.encode("utf-8") for k, v in record.values.iteritems()} for record in source.records()])
-        
-        temp_out.seek(0)
-        file_like_object.write(temp_out.read().decode("utf-8").encode(encoding))
 
+        if write_header:
+            writer.writeheader()
+
+        for record in records:
+            writer.writerow({k.encode("utf-8"): v.encode("utf-8") for k, v in record.values.iteritems()})
+
+            if temp_out.tell() >= buffer_size:
+                self.__flush(temp_out, file_like_object, encoding)
+
+        self.__flush(temp_out, file_like_object, encoding)
+
+    @staticmethod
+    def __flush(temp_out, file_like_object, encoding):
+        file_like_object.write(temp_out.getvalue().decode("utf-8").encode(encoding))
+        temp_out.seek(0)
+        temp_out.truncate()
@@ -6,6 +6,9 @@
 #  This file is available under the terms of the MIT License.
 #  
 
+import trapeza
+import compression
+
 __all__ = ["Importer", "Exporter", "importers_for_format", "exporters_for_format", "available_output_formats", "available_input_formats"]
 
 _importer_registry = {}
@@ -26,34 +29,53 @@ def register_exporter(cls, formats):
         _exporter_registry[each_format].append(cls)
 
 
+def _with_compression(formats):
+    return formats + ["{}.{}".format(each_format, each_compression)
+                      for each_compression in compression.available_compressions() for each_format in formats]
+
 def available_input_formats():
-    return _importer_registry.keys()
+    return _with_compression(_importer_registry.keys())
     
 def available_output_formats():
-    return _exporter_registry.keys()
+    return _with_compression(_exporter_registry.keys())
 
+# Compressed formats, such as csv.gz, are handled by the plugins for the inner format (see compression.py).
 def importers_for_format(a_format):
-    return _importer_registry.get(a_format) or []
+    return _importer_registry.get(compression.split_format(a_format)[0]) or []
     
 def exporters_for_format(a_format):
-    return _exporter_registry.get(a_format) or []
+    return _exporter_registry.get(compression.split_format(a_format)[0]) or []
 
 class Importer(object):
     
     formats = []
+    # True if the importer can read single records by byte offset, through two further methods:
+    # index(buffer, file_format, primary_key, encoding) returns a tuple (headers, offsets), where offsets maps the
+    # primary key of each record in buffer (a string or mmap holding the whole file) to the byte offset at which the
+    # record starts; read_record(buffer, offset, file_format, headers, encoding) parses the record at that offset.
+    indexable = False
     
     class __metaclass__(type):
         def __init__(cls, name, bases, dict):
             type.__init__(cls, name, bases, dict)
             register_importer(cls, dict["formats"])
                             
-    def read(self, file_like_object, file_format, sheet_name = None):
+    def read(self, file_like_object, file_format, sheet_name = None, encoding = "utf-8", columns = None):
+        # If columns is given, only those columns need be loaded.
         raise NotImplementedError
+
+    def iterate(self, file_like_object, file_format, sheet_name = None, encoding = "utf-8", columns = None):
+        # Importers that can parse incrementally should override this; by default, load everything.
+        source = self.read(file_like_object, file_format, sheet_name, encoding, columns)
+
+        return (source.headers(), iter(source.records()))
     
 
 class Exporter(object):
     
     formats = []
+    # True if write_records() accepts write_header = False, to append records to output it wrote earlier.
+    appendable = False
     
     class __metaclass__(type):
         def __init__(cls, name, bases, dict):
@@ -63,5 +85,14 @@ class Exporter(object):
             
     def write(self, source, file_like_object, file_format, sheet_name = None):
         raise NotImplementedError
+
+    def write_records(self, headers, records, file_like_object, file_format, sheet_name = None, encoding = "utf-8",
+                      **kwd):
+        # Exporters that can write incrementally should override this; by default, collect everything.
+        source = trapeza.Source(list(headers))
+        for record in records:
+            source.add_record(record)
+
+        self.write(source, file_like_object, file_format, sheet_name, encoding, **kwd)
     
 
@@ -6,25 +6,70 @@
 #  This file is available under the terms of the MIT License.
 #
 
+import array
+import bisect
+import datetime
+import heapq
+import math
+import multiprocessing
 import nilsimsa
+import phonetic
+import random
+import re
+import stats
+import zlib
 
-__all__ = ["COMPARE_EXACT", "COMPARE_PREFIX", "COMPARE_FUZZY", "ProcessedSource", "Result", "Mapping", "Profile"]
+__all__ = ["COMPARE_EXACT", "COMPARE_PREFIX", "COMPARE_FUZZY", "COMPARE_PHONETIC", "COMPARE_EDIT", "COMPARE_TOKENS",
+           "COMPARE_RANGE", "ASSIGN_GREEDY", "ASSIGN_OPTIMAL", "ProcessedSource", "Result", "Mapping", "Profile",
+           "ValueFrequencies", "assign"]
 
 COMPARE_EXACT = u"exact"
 COMPARE_PREFIX = u"prefix"
 COMPARE_FUZZY = u"fuzzy"    
+COMPARE_PHONETIC = u"phonetic"
+COMPARE_EDIT = u"edit"
+COMPARE_TOKENS = u"tokens"
+COMPARE_RANGE = u"range"
+
+ASSIGN_GREEDY = "greedy"
+ASSIGN_OPTIMAL = "optimal"
 
 
 class AdditiveDict(dict):            
+    # Posting lists of row ordinals, stored compactly as arrays of unsigned ints.
     def append(self, key, value):
-        self.setdefault(key, []).append(value)     
+        try:
+            self[key].append(value)
+        except KeyError:
+            self[key] = array.array("I", [value])
+
+
+class ValueFrequencies(dict):
+    def __init__(self, total=0):
+        dict.__init__(self)
+        self.total = total
+
+    def add(self, value):
+        self[value] = self.get(value, 0) + 1
+        self.total += 1
+
+    def weight(self, value):
+        return _idf(self.get(value, 1), self.total)
 
 
 class ProcessedSource(object):
     
     NILSIMSA_DISTANCE_BASE = nilsimsa.Nilsimsa(u"b4se str1ng 4 c0mparison with NILSIMSA hash!".encode("utf-8")).digest()
+    DIGEST_LENGTH = 32
+    # MinHash signatures are split into bands of MINHASH_LENGTH / MINHASH_BANDS rows. Values become candidates
+    # if they agree on every row of any band, which is likely for token sets with Jaccard similarity over about
+    # (1 / MINHASH_BANDS) ** (MINHASH_BANDS / MINHASH_LENGTH), i.e. one half.
+    MINHASH_LENGTH = 64
+    MINHASH_BANDS = 16
+    MINIMUM_CHUNK_SIZE = 1000
+    INDEXES = ["exact", "prefix", "fuzzy", "phonetic", "edit", "tokens"]
     
-    def __init__(self, source, master=True, profile=None):
+    def __init__(self, source, master=True, profile=None, stop_value_limit=None):
         self.source = source
         self.master = master
         self.profile = profile
@@ -32,16 +77,48 @@ class ProcessedSource(object):
         self.exact = {}
         self.prefix = {}
         self.fuzzy = {}
+        # Posting lists keyed by the phonetic codes (see trapeza.phonetic) of each value.
+        self.phonetic = {}
+        # Every variant of each value with up to edit_distances[key] characters deleted. Two values within
+        # edit distance k of one another share a variant with at most k deletions from each.
+        self.edit = {}
+        self.edit_distances = {}
+        # LSH tables over the MinHash signatures of each tokens key, and the signatures themselves, packed into
+        # one array and addressed by row ordinal.
+        self.tokens = {}
+        self.signatures = {}
+        # Nilsimsa digests for each fuzzy key, packed into one buffer and addressed by row ordinal.
+        self.digests = {}
+        # The number (or date, as a day number) parsed from each range key, addressed by row ordinal, with NaN
+        # for values that do not parse. Each range index is a pair of arrays, these numbers in sorted order and
+        # the ordinal of each, searched by bisection.
+        self.numbers = {}
+        self.ranges = {}
         self.strip_keys = []
+        self.statistics = {}
+        # Exact values shared by more than stop_value_limit records are too common to generate candidates.
+        # Their buckets are discarded and only their frequencies kept.
+        self.stop_value_limit = stop_value_limit
+        self.stop_values = {}
+        # If this source is one shard of a larger master (see trapeza.shards), the number of records in the whole
+        # master and the frequencies there of each exact value, so that stop values and IDF weights are the same
+        # in every shard as in the master. Only the frequencies of values in this shard are kept once processed.
+        self.total_records = None
+        self.total_frequencies = None
 
-    def process(self):
+    def process(self, jobs=1):
+        # If jobs is greater than one, records are indexed by a pool of that many processes.
         exact_keys = []
         prefix_keys = []
         fuzzy_keys = []
+        phonetic_keys = []
+        edit_keys = []
+        token_keys = []
+        range_keys = []
         
         if self.profile is not None:
             for mapping in self.profile.mappings:
-                key = mapping.master_key if self.master else mapping.key
+                key = self.key(mapping)
                 if mapping.compare == COMPARE_EXACT or mapping.compare == COMPARE_PREFIX:
                     # We use the exact dictionaries with COMPARE_PREFIX mapping too.
                     if key not in exact_keys:
@@ -52,57 +129,206 @@ class ProcessedSource(object):
                 elif mapping.compare == COMPARE_FUZZY:
                     if key not in fuzzy_keys:
                         fuzzy_keys.append(key)
+                elif mapping.compare == COMPARE_PHONETIC:
+                    if key not in phonetic_keys:
+                        phonetic_keys.append(key)
+                elif mapping.compare == COMPARE_EDIT:
+                    if key not in edit_keys:
+                        edit_keys.append(key)
+                    self.edit_distances[key] = max(self.edit_distances.get(key, 0), mapping.max_distance)
+                elif mapping.compare == COMPARE_TOKENS:
+                    if key not in token_keys:
+                        token_keys.append(key)
+                elif mapping.compare == COMPARE_RANGE:
+                    if key not in range_keys:
+                        range_keys.append(key)
 
                 if mapping.strip:
                     self.strip_keys.append(key)
 
         else:
-            self.strip_keys = exact_keys = prefix_keys = fuzzy_keys = self.source.headers()
+            self.strip_keys = exact_keys = prefix_keys = fuzzy_keys = phonetic_keys = edit_keys = token_keys = \
+                self.source.headers()
+            self.edit_distances = dict((key, 1) for key in edit_keys)
 
-        for key in exact_keys:
-            self.exact[key] = AdditiveDict()
-        for key in prefix_keys:
-            self.prefix[key] = AdditiveDict()
+        layout = {"exact": exact_keys, "prefix": prefix_keys, "fuzzy": fuzzy_keys, "phonetic": phonetic_keys,
+                  "edit": edit_keys, "tokens": token_keys, "range": range_keys, "strip": self.strip_keys,
+                  "edit_distances": self.edit_distances,
+                  "prefix_len": self.profile.prefix_len if self.profile is not None else Profile.prefix_len}
+
+        for name in ProcessedSource.INDEXES:
+            for key in layout[name]:
+                getattr(self, name)[key] = AdditiveDict()
         for key in fuzzy_keys:
-            self.fuzzy[key] = AdditiveDict()
-            
-        for record in self.source.records():
-            for key in exact_keys:
-                value = record.values[key]
-                if key in self.strip_keys:
-                    value = value.strip().strip("\"'")
-
-                if len(value) > 0:
-                    self.exact[key].append(value, record)
-            
-            for key in prefix_keys:
-                val = record.values[key]
-                if key in self.strip_keys:
-                    val = val.strip().strip("\"'")
-
-                if len(val) > self.profile.prefix_len:
-                    for i in range(self.profile.prefix_len, len(val)):
-                        self.prefix[key].append(val[:i], record)
-                        
-            for key in fuzzy_keys:
-                value = record.values[key]
-                if key in self.strip_keys:
-                    value = value.strip().strip("\"'")
-
-                if len(value) > 0:
-                    n = nilsimsa.Nilsimsa(record.values[key].encode("utf-8"))
-                    self.fuzzy[key].append(n.compare(ProcessedSource.NILSIMSA_DISTANCE_BASE), (n.digest(), record))
-                
+            self.digests[key] = bytearray()
+        for key in token_keys:
+            self.signatures[key] = array.array("I")
+        for key in range_keys:
+            self.numbers[key] = array.array("d")
+
+        records = self.source.records()
+        if jobs <= 1 or len(records) < 2 * ProcessedSource.MINIMUM_CHUNK_SIZE:
+            self.__merge(_index_records(layout, 0, (record.values for record in
+                                                    stats.current.track("process", records))))
+        else:
+            # Index ranges of records in worker processes, sending each only the columns it needs, and merge
+            # the partial indexes in order so that posting lists stay sorted by ordinal.
+            needed = set(key for name in ProcessedSource.INDEXES + ["range"] for key in layout[name])
+            chunk_size = max(ProcessedSource.MINIMUM_CHUNK_SIZE, len(records) / (jobs * 4) + 1)
+            tasks = ((layout, chunk_start, [dict((key, record.values[key]) for key in needed)
+                                            for record in records[chunk_start:chunk_start + chunk_size]])
+                     for chunk_start in xrange(0, len(records), chunk_size))
+
+            pool = multiprocessing.Pool(jobs)
+            try:
+                for partial in pool.imap(_index_records_packed, tasks):
+                    self.__merge(_unpack_indexes(partial))
+            finally:
+                pool.close()
+                pool.join()
+
+            stats.current.count("rows.process", len(records))
+
+        for key in range_keys:
+            numbers = self.numbers[key]
+            order = sorted((ordinal for ordinal in xrange(len(numbers)) if not math.isnan(numbers[ordinal])),
+                           key=numbers.__getitem__)
+            self.ranges[key] = (array.array("d", (numbers[ordinal] for ordinal in order)), array.array("I", order))
+
+        # Selectivity statistics for each index, used by Profile.plan(). These are taken before stop values are
+        # removed, so that a key with common values is seen to be unselective.
+        for name in ProcessedSource.INDEXES:
+            index = getattr(self, name)
+            self.statistics[name] = {}
+            for key in index:
+                self.statistics[name][key] = {"values": len(index[key]),
+                                              "entries": sum(map(len, index[key].itervalues()))}
+
+                if stats.current.enabled:
+                    for each_statistic in self.statistics[name][key]:
+                        stats.current.set(u"index.{}.{}.{}".format(name, key, each_statistic),
+                                          self.statistics[name][key][each_statistic])
+
+        self.statistics["range"] = {}
+        for (key, (values, ordinals)) in self.ranges.iteritems():
+            self.statistics["range"][key] = {"values": len(set(values)), "entries": len(values)}
+
+        for key in exact_keys:
+            self.stop_values[key] = {}
+            if self.stop_value_limit is not None:
+                for value in [value for value in self.exact[key] if self.frequency(key, value) > self.stop_value_limit]:
+                    self.stop_values[key][value] = self.frequency(key, value)
+                    del self.exact[key][value]
+
+            if stats.current.enabled:
+                stats.current.set(u"index.exact.{}.stop_values".format(key), len(self.stop_values[key]))
+
+        if self.total_frequencies is not None:
+            self.total_frequencies = dict((key, dict((value, self.total_frequencies[key][value])
+                                                     for value in self.exact[key]))
+                                          for key in exact_keys)
+
         self.processed = True
 
+    def __merge(self, partial):
+        # Adds the partial indexes of a range of records following those already indexed.
+        for name in ProcessedSource.INDEXES:
+            for (key, partial_index) in partial[name].iteritems():
+                index = getattr(self, name)[key]
+                for (value, postings) in partial_index.iteritems():
+                    if value in index:
+                        index[value].extend(postings)
+                    else:
+                        index[value] = postings
+
+        for (key, digests) in partial["digests"].iteritems():
+            self.digests[key].extend(digests)
+        for (key, signatures) in partial["signatures"].iteritems():
+            self.signatures[key].extend(signatures)
+        for (key, numbers) in partial["numbers"].iteritems():
+            self.numbers[key].extend(numbers)
+
+    def __getstate__(self):
+        return _pack_indexes(self.__dict__.copy())
+
+    def __setstate__(self, state):
+        self.__dict__.update(_unpack_indexes(state))
+
+    def record(self, ordinal):
+        return self.source.records()[ordinal]
+
+    def key(self, mapping):
+        return mapping.master_key if self.master else mapping.key
+
+    def digest(self, key, ordinal):
+        offset = ordinal * ProcessedSource.DIGEST_LENGTH
+
+        return self.digests[key][offset:offset + ProcessedSource.DIGEST_LENGTH]
+
+    def signature(self, key, ordinal):
+        offset = ordinal * ProcessedSource.MINHASH_LENGTH
+
+        return self.signatures[key][offset:offset + ProcessedSource.MINHASH_LENGTH]
+
+    def number(self, key, ordinal):
+        # The parsed value of a range key for a master record, or None.
+        number = self.numbers[key][ordinal]
+
+        return None if math.isnan(number) else number
+
+    def value(self, key, record):
+        value = record.values[key]
+        if key in self.strip_keys:
+            value = value.strip().strip("\"'")
+
+        return value
+
+    def frequency(self, key, value):
+        if value in self.stop_values.get(key, {}):
+            return self.stop_values[key][value]
+        if self.total_frequencies is not None:
+            return self.total_frequencies[key].get(value, 0)
+
+        return len(self.exact[key].get(value, []))
+
+    def is_stop_value(self, key, value):
+        return value in self.stop_values.get(key, {})
+
+    def weight(self, mapping, value):
+        # The fraction of its points that an exact mapping awards for agreement on value.
+        if not mapping.idf or mapping.compare != COMPARE_EXACT:
+            return 1
+
+        return _idf(self.frequency(self.key(mapping), value),
+                    self.total_records if self.total_records is not None else len(self.source.records()))
+
+    def is_stop_lookup(self, mapping, record):
+        return mapping.compare == COMPARE_EXACT \
+            and self.is_stop_value(self.key(mapping), self.incoming_value(mapping, record))
+
+    def expected_candidates(self, mapping):
+        # The average bucket size of the index consulted for this mapping.
+        index_statistics = self.statistics.get(mapping.compare, {}).get(self.key(mapping))
+
+        if not index_statistics or index_statistics["values"] == 0:
+            return 0
+
+        return float(index_statistics["entries"]) / index_statistics["values"]
+
+    def incoming_value(self, mapping, record):
+        value = record.values[mapping.master_key if not self.master else mapping.key]
+        if mapping.strip:
+            value = value.strip().strip("\"'")
+
+        return value
+
     def matches(self, mapping, record):
+        # Returns the ordinals of candidate master records. Use record() to resolve them.
         if not self.processed:
             raise Exception("Please process this source before attempting a match.")
         
-        key = mapping.master_key if self.master else mapping.key
-        value = record.values[mapping.master_key if not self.master else mapping.key]
-        if mapping.strip:
-            value = value.strip().strip("\"'")
+        key = self.key(mapping)
+        value = self.incoming_value(mapping, record)
         
         if len(value) == 0:
             return []
@@ -110,7 +336,8 @@ class ProcessedSource(object):
         results = []
         
         if mapping.compare == COMPARE_EXACT:
-            results.extend(self.exact[key].get(value, []))
+            # Posting lists are copied (cheaply, as arrays), so that callers cannot alter the index.
+            return self.exact[key].get(value, results)[:]
         elif mapping.compare == COMPARE_PREFIX:
             if len(value) >= self.profile.prefix_len:
                 # Find all other records having this value as a prefix.
@@ -125,9 +352,78 @@ class ProcessedSource(object):
                     
         elif mapping.compare == COMPARE_FUZZY:
             nilsimsa_distance = nilsimsa.Nilsimsa(value.encode("utf-8")).compare(ProcessedSource.NILSIMSA_DISTANCE_BASE)
-            results.extend(self.fuzzy[key].get(nilsimsa_distance, []))
+            return self.fuzzy[key].get(nilsimsa_distance, results)[:]
+        elif mapping.compare == COMPARE_PHONETIC:
+            return self.phonetic[key].get(phonetic.phonetic_key(value), results)[:]
+        elif mapping.compare == COMPARE_EDIT:
+            if mapping.max_distance > self.edit_distances[key]:
+                raise Exception("Mapping {} needs an edit index of greater distance than that processed.".format(
+                    mapping))
+
+            # Candidates share a deletion variant; verify each against the real distance.
+            found = set()
+            for variant in _deletions(value, mapping.max_distance):
+                found.update(self.edit[key].get(variant, []))
+
+            return [ordinal for ordinal in sorted(found)
+                    if _bounded_levenshtein(value, self.value(key, self.record(ordinal)), mapping.max_distance)
+                    <= mapping.max_distance]
+        elif mapping.compare == COMPARE_TOKENS:
+            tokens = _tokens(value)
+            if len(tokens) > 0:
+                found = set()
+                for band in _bands(_minhash(tokens)):
+                    found.update(self.tokens[key].get(band, []))
+
+                return sorted(found)
+        elif mapping.compare == COMPARE_RANGE:
+            number = _parse_number(value)
+            if number is not None:
+                (values, ordinals) = self.ranges[key]
+                tolerance = mapping.tolerance_of(number)
+                start = bisect.bisect_left(values, number - tolerance)
+                end = bisect.bisect_right(values, number + tolerance, start)
+
+                # Check against the tolerance exactly as score() does, whatever the rounding of the bounds.
+                return sorted(ordinals[position] for position in xrange(start, end)
+                              if abs(values[position] - number) <= tolerance)
             
         return results
+
+    def score(self, mapping, record, ordinal):
+        # Award the points that the master record would receive were it among matches(mapping, record),
+        # without consulting the index. Fuzzy and tokens mappings cannot be scored this way.
+        key = self.key(mapping)
+        value = self.incoming_value(mapping, record)
+        master_value = self.value(key, self.record(ordinal))
+
+        if len(value) == 0 or len(master_value) == 0:
+            return 0
+
+        if mapping.compare == COMPARE_EXACT:
+            if master_value == value:
+                return mapping.points * self.weight(mapping, value)
+        elif mapping.compare == COMPARE_PREFIX:
+            prefix_len = self.profile.prefix_len
+            if len(value) >= prefix_len:
+                if len(master_value) > len(value) and master_value.startswith(value):
+                    return mapping.points
+                if prefix_len <= len(master_value) < len(value) - 1 and value.startswith(master_value) \
+                        and not self.is_stop_value(key, master_value):
+                    return mapping.points
+        elif mapping.compare == COMPARE_PHONETIC:
+            code = phonetic.phonetic_key(value)
+            if len(code) > 0 and code == phonetic.phonetic_key(master_value):
+                return mapping.points
+        elif mapping.compare == COMPARE_EDIT:
+            if _bounded_levenshtein(value, master_value, mapping.max_distance) <= mapping.max_distance:
+                return mapping.points
+        elif mapping.compare == COMPARE_RANGE:
+            return mapping.range_points(self.number(key, ordinal), _parse_number(value))
+        else:
+            raise Exception("Mapping {} cannot be scored without an index lookup.".format(mapping))
+
+        return 0
             
 
 class Result(object):
@@ -145,13 +441,23 @@ class Result(object):
 
 
 class Mapping(object):
-    def __init__(self, incoming_key, master_key, compare=COMPARE_EXACT, points=1, strip=True, prefix_len=3):
+    def __init__(self, incoming_key, master_key, compare=COMPARE_EXACT, points=1, strip=True, prefix_len=3, idf=False,
+                 max_distance=1, tolerance=0, relative=False):
         self.key = incoming_key
         self.master_key = master_key
         self.compare = compare
         self.points = points
         self.strip = strip
         self.prefix_len = prefix_len
+        # If set, exact matches on common values are worth less: points are scaled by the
+        # inverse frequency of the value in the master.
+        self.idf = idf
+        # The greatest Levenshtein distance at which an edit mapping awards its points.
+        self.max_distance = max_distance
+        # How far apart the numbers (or dates, in days) compared by a range mapping may be. If relative is set,
+        # tolerance is instead a percentage of the incoming value.
+        self.tolerance = tolerance
+        self.relative = relative
         
     def __str__(self):
         return "trapeza.Mapping: {0} to {1} using comparison {2} for {3} points.".format(self.key,
@@ -159,7 +465,7 @@ class Mapping(object):
                                                                                          self.compare,
                                                                                          self.points)
     
-    def compare_records(self, master, incoming):
+    def compare_records(self, master, incoming, frequencies=None):
         if self.master_key not in master.values or self.key not in incoming.values:
             raise Exception("Mapping {0} specifies a key that does not exist in one or more records.".format(self))
         
@@ -172,6 +478,9 @@ class Mapping(object):
             
         if self.compare == COMPARE_EXACT:
             if master_value == incoming_value:
+                if self.idf and frequencies is not None:
+                    return self.points * frequencies.weight(master_value)
+
                 return self.points
         elif self.compare == COMPARE_PREFIX:
             if (master_value.startswith(incoming_value) and len(incoming_value) >= self.prefix_len) \
@@ -181,9 +490,37 @@ class Mapping(object):
             mns = nilsimsa.Nilsimsa(master_value.encode("utf-8"))
             ins = nilsimsa.Nilsimsa(incoming_value.encode("utf-8"))
             return _nilsimsa_ratio_as_percent(ins.digest(), mns) * self.points
+        elif self.compare == COMPARE_PHONETIC:
+            code = phonetic.phonetic_key(incoming_value)
+            if len(code) > 0 and code == phonetic.phonetic_key(master_value):
+                return self.points
+        elif self.compare == COMPARE_EDIT:
+            if _bounded_levenshtein(incoming_value, master_value, self.max_distance) <= self.max_distance:
+                return self.points
+        elif self.compare == COMPARE_TOKENS:
+            return _jaccard(_tokens(master_value), _tokens(incoming_value)) * self.points
+        elif self.compare == COMPARE_RANGE:
+            return self.range_points(_parse_number(master_value), _parse_number(incoming_value))
         
         return 0
 
+    def tolerance_of(self, number):
+        return abs(number) * self.tolerance / 100.0 if self.relative else self.tolerance
+
+    def range_points(self, master_number, number):
+        # Points fall linearly with distance, to half at the limit of the tolerance.
+        if master_number is None or number is None:
+            return 0
+
+        tolerance = self.tolerance_of(number)
+        distance = abs(master_number - number)
+        if distance > tolerance:
+            return 0
+        if tolerance == 0:
+            return self.points
+
+        return self.points * (1 - distance / (2 * tolerance))
+
 
 class Profile(object):
     prefix_len = 3
@@ -210,62 +547,630 @@ class Profile(object):
                 compare = COMPARE_PREFIX
             elif record.values[u"compare"] == u"fuzzy":
                 compare = COMPARE_FUZZY
+            elif record.values[u"compare"] == u"phonetic":
+                compare = COMPARE_PHONETIC
+            elif record.values[u"compare"] == u"edit":
+                compare = COMPARE_EDIT
+            elif record.values[u"compare"] == u"tokens":
+                compare = COMPARE_TOKENS
+            elif record.values[u"compare"] == u"range":
+                compare = COMPARE_RANGE
             else:
                 raise Exception("Invalid compare type {} in profile.".format(record.values[u"compare"]))
+
+            tolerance = record.values.get(u"tolerance", u"").strip()
+            relative = tolerance.endswith(u"%")
         
             maps.append(Mapping(record.values[u"key"],
                                 record.values[u"master-key"],
                                 compare,
                                 int(record.values[u"points"]),
-                                bool(record.values[u"strip"])))
+                                bool(record.values[u"strip"]),
+                                idf=record.values.get(u"idf", u"").strip().lower() in [u"1", u"true", u"yes"],
+                                max_distance=int(record.values.get(u"distance", u"").strip() or 1),
+                                tolerance=float(tolerance.rstrip(u"%") or 0),
+                                relative=relative))
                                 
         return maps
 
-    def compare_records(self, master, incoming):
-        return sum([mapping.compare_records(master, incoming) for mapping in self.mappings])
+    def columns(self, master=True):
+        # The columns that matching reads from master (or incoming) records, e.g. to pass to load_source().
+        columns = []
+        for mapping in self.mappings:
+            key = mapping.master_key if master else mapping.key
+            if key not in columns:
+                columns.append(key)
+
+        return columns
+
+    def compare_records(self, master, incoming, frequencies=None):
+        # frequencies, if provided, maps Mappings using IDF weighting to the ValueFrequencies of their master key.
+        frequencies = frequencies or {}
+
+        return sum([mapping.compare_records(master, incoming, frequencies.get(mapping)) for mapping in self.mappings])
+
+    def value_frequencies(self, master):
+        frequencies = {}
+
+        for mapping in self.mappings:
+            if mapping.idf:
+                frequencies[mapping] = ValueFrequencies()
+                for record in master.records():
+                    value = record.values[mapping.master_key]
+                    frequencies[mapping].add(value.strip().strip("\"'") if mapping.strip else value)
+
+        return frequencies
         
-    def compare_sources(self, master, incoming, cutoff=0):
+    def compare_sources(self, master, incoming, cutoff=0, frequencies=None):
+        # frequencies, if given, is the value_frequencies() of an unprocessed master, so that a caller comparing
+        # many incoming sources with one master need not count its values each time.
         if isinstance(master, ProcessedSource):
             return self._compare_sources_processed(master, incoming, cutoff)
             
         results = []
+        if frequencies is None:
+            frequencies = self.value_frequencies(master)
         
-        for incoming_record in incoming.records():
+        for incoming_record in stats.current.track("match", incoming.records()):
             for master_record in master.records():
-                points = self.compare_records(master_record, incoming_record)
+                points = self.compare_records(master_record, incoming_record, frequencies)
                 if points >= cutoff and points > 0:
                     results.append(Result(incoming_record, master_record, points))
-                    
+
+        if stats.current.enabled:
+            comparisons = len(incoming.records()) * len(master.records())
+            stats.current.count("comparisons", comparisons)
+            stats.current.count("comparisons.fuzzy",
+                                comparisons * len([m for m in self.mappings if m.compare == COMPARE_FUZZY]))
+
         return results
     
-    def _compare_sources_processed(self, master, incoming, cutoff=0):
+    def plan(self, master, cutoff=0):
+        # Returns a tuple (generating, scoring) of lists of mapping indices. Candidates are looked up using the
+        # generating mappings, most selective first. The scoring mappings, those with the highest fan-out, only add
+        # points to candidates already found: this is safe as long as a record matching on them alone could not
+        # reach the cutoff, so results above the cutoff are unchanged. (A generating lookup of a stop value finds
+        # nothing, so for such records _score_record() looks up with the scoring mappings too.)
+        order = sorted(range(len(self.mappings)), key=lambda i: master.expected_candidates(self.mappings[i]))
+        scoring = []
+        scoring_points = 0
+
+        for mapping_index in reversed(order):
+            mapping = self.mappings[mapping_index]
+            if mapping.compare in [COMPARE_EXACT, COMPARE_PREFIX, COMPARE_PHONETIC, COMPARE_EDIT, COMPARE_RANGE] \
+                    and scoring_points + max(mapping.points, 0) < cutoff:
+                scoring.append(mapping_index)
+                scoring_points += max(mapping.points, 0)
+
+        return ([i for i in order if i not in scoring], sorted(scoring))
+
+    def _check_processed(self, master):
         if not master.processed or master.profile not in [self, None]:
             raise Exception("Cannot compare using an unprocessed source or a source processed with the wrong profile.")
+
+    def _compare_sources_processed(self, master, incoming, cutoff=0):
+        self._check_processed(master)
             
         results = []
+        tracker = stats.current
+        candidates = [0] * len(self.mappings) if tracker.enabled else None
+        plan = self.plan(master, cutoff)
         
-        for record in incoming.records():
-            results_this_record = {}
-            
-            for mapping in self.mappings:
-                for master_record in master.matches(mapping, record):
-                    if mapping.compare == COMPARE_EXACT or mapping.compare == COMPARE_PREFIX:
-                        score = results_this_record.get(master_record, 0)
-                        results_this_record[master_record] = score + mapping.points
-                    else:
-                        # for Nilsimsa results the "record" is actually a (digest, record) tuple
-                        (digest, real_record) = master_record
-                        score = results_this_record.get(real_record, 0)
-                        ns = nilsimsa.Nilsimsa(record.values[mapping.key].encode("utf-8"))
-                        results_this_record[real_record] = score + \
-                            _nilsimsa_ratio_as_percent(digest, ns) * mapping.points
-                       
-            for each_result_key in results_this_record:
-                if results_this_record[each_result_key] >= cutoff:
-                    results.append(Result(record, each_result_key, results_this_record[each_result_key]))
-        
+        for record in tracker.track("match", incoming.records()):
+            for (ordinal, score) in self._score_record(master, record, plan, cutoff, candidates).iteritems():
+                results.append(Result(record, master.record(ordinal), score))
+
+        self._report_candidates(candidates, plan)
+
+        return results
+
+    def _score_record(self, master, record, plan, cutoff=0, candidates=None, accept=None):
+        # Returns a dictionary mapping the ordinals of master records scoring at or above cutoff to their scores.
+        # If supplied, candidates accumulates the number of candidates found by each mapping, and accept
+        # restricts the master ordinals considered.
+        (generating, scoring) = plan
+        found = {}
+
+        if any(master.is_stop_lookup(self.mappings[mapping_index], record) for mapping_index in generating):
+            # The plan relies on every generating mapping finding its candidates. Without those of a stop value, a
+            # record matching on it and on the scoring mappings could reach the cutoff unseen, so look up with all.
+            generating = generating + scoring
+
+        for mapping_index in generating:
+            mapping = self.mappings[mapping_index]
+            if master.is_stop_lookup(mapping, record):
+                # Stop values don't generate candidates, but still score those found by other mappings.
+                continue
+
+            matches = master.matches(mapping, record)
+            if accept is not None:
+                matches = [ordinal for ordinal in matches if accept(ordinal)]
+
+            points = found[mapping_index] = {}
+            if candidates is not None:
+                candidates[mapping_index] += len(matches)
+
+            if mapping.compare in [COMPARE_EXACT, COMPARE_PREFIX, COMPARE_PHONETIC, COMPARE_EDIT]:
+                mapping_points = mapping.points
+                if mapping.idf and len(matches) > 0:
+                    mapping_points *= master.weight(mapping, master.incoming_value(mapping, record))
+
+                for ordinal in matches:
+                    points[ordinal] = points.get(ordinal, 0) + mapping_points
+            elif mapping.compare == COMPARE_TOKENS:
+                if len(matches) > 0:
+                    # Estimate the Jaccard similarity from the signatures.
+                    signature = _minhash(_tokens(master.incoming_value(mapping, record)))
+                    key = master.key(mapping)
+                    for ordinal in matches:
+                        points[ordinal] = points.get(ordinal, 0) + \
+                            _signature_similarity(master.signature(key, ordinal), signature) * mapping.points
+            elif mapping.compare == COMPARE_RANGE:
+                if len(matches) > 0:
+                    number = _parse_number(master.incoming_value(mapping, record))
+                    key = master.key(mapping)
+                    for ordinal in matches:
+                        points[ordinal] = points.get(ordinal, 0) + mapping.range_points(master.number(key, ordinal),
+                                                                                        number)
+            elif len(matches) > 0:
+                ns = nilsimsa.Nilsimsa(record.values[mapping.key].encode("utf-8"))
+                key = master.key(mapping)
+                for ordinal in matches:
+                    points[ordinal] = points.get(ordinal, 0) + \
+                        _nilsimsa_ratio_as_percent(master.digest(key, ordinal), ns) * mapping.points
+
+        results = {}
+        for points in found.itervalues():
+            results.update(points)
+
+        # Total the points in profile order, so that scores are exactly those of an unplanned lookup.
+        for ordinal in results.keys():
+            score = 0
+            for (mapping_index, mapping) in enumerate(self.mappings):
+                if mapping_index in found:
+                    score += found[mapping_index].get(ordinal, 0)
+                else:
+                    score += master.score(mapping, record, ordinal)
+
+            if score >= cutoff:
+                results[ordinal] = score
+            else:
+                del results[ordinal]
+
         return results
+
+    def _report_candidates(self, candidates, plan):
+        if candidates is not None:
+            for (mapping, count) in zip(self.mappings, candidates):
+                stats.current.count(u"candidates.{}.{}.{}".format(mapping.key, mapping.master_key, mapping.compare),
+                                    count)
+                if mapping.compare == COMPARE_FUZZY:
+                    stats.current.count("comparisons.fuzzy", count)
+            stats.current.set("mappings.scoring_only", len(plan[1]))
+
+    def deduplicate(self, processed, cutoff=0):
+        # Clusters the records of a single processed source, each looked up once against its own index.
+        # Records are joined (transitively) to every other record they match at or above cutoff. Returns
+        # a list giving the cluster number of each record, in source order, numbering clusters from 0 in
+        # order of first appearance.
+        self._check_processed(processed)
+
+        headers = processed.source.headers()
+        for mapping in self.mappings:
+            if mapping.key not in headers:
+                raise Exception("Mapping {} specifies a key that does not exist in the source.".format(mapping))
+
+        records = processed.source.records()
+        clusters = _DisjointSet(len(records))
+        tracker = stats.current
+        candidates = [0] * len(self.mappings) if tracker.enabled else None
+        plan = self.plan(processed, cutoff)
+        pairs = 0
+
+        for (ordinal, record) in enumerate(tracker.track("dedupe", records)):
+            # Skip ourselves and records already in the same cluster. Earlier records are looked at again, since
+            # matching need not be symmetric (as with prefixes): the cluster check spares most repeated work.
+            root = clusters.find(ordinal)
+            accept = lambda other: other != ordinal and clusters.find(other) != root
+
+            for other in self._score_record(processed, record, plan, cutoff, candidates, accept):
+                clusters.union(ordinal, other)
+                pairs += 1
+
+        self._report_candidates(candidates, plan)
+        tracker.count("dedupe.pairs", pairs)
+
+        return clusters.labels()
+
+
+class _DisjointSet(object):
+    # Union-find over the integers 0..size-1, with union by size and path halving.
+    def __init__(self, size):
+        self.parent = array.array("I", xrange(size))
+        self.size = array.array("I", [1]) * size
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+
+        return item
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a != b:
+            if self.size[a] < self.size[b]:
+                (a, b) = (b, a)
+            self.parent[b] = a
+            self.size[a] += self.size[b]
+
+    def labels(self):
+        numbers = {}
+
+        return [numbers.setdefault(self.find(item), len(numbers)) for item in xrange(len(self.parent))]
                 
 
+def assign(pairs, method=ASSIGN_GREEDY, optimal_limit=64):
+    # Chooses among (incoming key, master key, score) tuples so that each incoming and each master key appears at
+    # most once, e.g. among the results of Profile.compare_sources(). Returns the indices of the chosen pairs, in
+    # order. The pairs are split into connected components, which are assigned independently. ASSIGN_GREEDY takes
+    # the best-scoring remaining pair first (the earliest, among equals); ASSIGN_OPTIMAL maximises the total score
+    # of each component having no more than optimal_limit keys on either side, never choosing a pair that scores
+    # nothing or less, and assigns larger ones greedily.
+    incoming_keys = {}
+    master_keys = {}
+    incoming = array.array("I")
+    master = array.array("I")
+    scores = []
+
+    for (incoming_key, master_key, score) in pairs:
+        incoming.append(incoming_keys.setdefault(incoming_key, len(incoming_keys)))
+        master.append(master_keys.setdefault(master_key, len(master_keys)))
+        scores.append(score)
+
+    # Master keys follow the incoming keys in the disjoint set.
+    components = _DisjointSet(len(incoming_keys) + len(master_keys))
+    for pair in xrange(len(scores)):
+        components.union(incoming[pair], len(incoming_keys) + master[pair])
+
+    members = {}
+    for pair in xrange(len(scores)):
+        members.setdefault(components.find(incoming[pair]), []).append(pair)
+
+    chosen = []
+    for component in members.itervalues():
+        if len(component) == 1:
+            # The optimal assignment leaves out a pair scoring nothing or less, as in _assign_optimal().
+            if method != ASSIGN_OPTIMAL or scores[component[0]] > 0:
+                chosen.extend(component)
+            continue
+
+        rows = sorted(set(incoming[pair] for pair in component))
+        columns = sorted(set(master[pair] for pair in component))
+        if method == ASSIGN_OPTIMAL and max(len(rows), len(columns)) <= optimal_limit:
+            chosen.extend(_assign_optimal(component, rows, columns, incoming, master, scores))
+        else:
+            chosen.extend(_assign_greedy(component, min(len(rows), len(columns)), incoming, master, scores))
+
+    return sorted(chosen)
+
+
+def _assign_greedy(component, size, incoming, master, scores):
+    heap = [(-scores[pair], pair) for pair in component]
+    heapq.heapify(heap)
+    used_incoming = set()
+    used_master = set()
+    chosen = []
+
+    # Stop as soon as one side is used up.
+    while len(heap) > 0 and len(chosen) < size:
+        pair = heapq.heappop(heap)[1]
+        if incoming[pair] not in used_incoming and master[pair] not in used_master:
+            used_incoming.add(incoming[pair])
+            used_master.add(master[pair])
+            chosen.append(pair)
+
+    return chosen
+
+
+def _assign_optimal(component, rows, columns, incoming, master, scores):
+    # The Hungarian algorithm, in the O(n^2 m) shortest augmenting path form, minimising the negated scores over
+    # the smaller side. Missing pairs cost nothing and are dropped from the result. So are pairs scoring nothing or
+    # less, which are left out of the costs: otherwise the solver could prefer missing pairs to a positive score.
+    transpose = len(rows) > len(columns)
+    if transpose:
+        (rows, columns) = (columns, rows)
+        (incoming, master) = (master, incoming)
+
+    row_numbers = dict((key, number) for (number, key) in enumerate(rows, 1))
+    column_numbers = dict((key, number) for (number, key) in enumerate(columns, 1))
+    cost = [[0] * (len(columns) + 1) for row in xrange(len(rows) + 1)]
+    best = {}
+    for pair in component:
+        if scores[pair] <= 0:
+            continue
+
+        (row, column) = (row_numbers[incoming[pair]], column_numbers[master[pair]])
+        # Of several pairs with the same keys, keep the first best.
+        if (row, column) not in best or scores[pair] > scores[best[(row, column)]]:
+            best[(row, column)] = pair
+            cost[row][column] = -scores[pair]
+
+    infinity = float("inf")
+    width = len(columns) + 1
+    row_potential = [0] * (len(rows) + 1)
+    column_potential = [0] * width
+    # The row assigned to each column, and the previous column on the augmenting path.
+    assigned = [0] * width
+    way = [0] * width
+
+    for row in xrange(1, len(rows) + 1):
+        assigned[0] = row
+        column = 0
+        minimum = [infinity] * width
+        used = [False] * width
+
+        while True:
+            used[column] = True
+            current_row = assigned[column]
+            delta = infinity
+            next_column = 0
+            for each_column in xrange(1, width):
+                if not used[each_column]:
+                    reduced = cost[current_row][each_column] - row_potential[current_row] \
+                        - column_potential[each_column]
+                    if reduced < minimum[each_column]:
+                        minimum[each_column] = reduced
+                        way[each_column] = column
+                    if minimum[each_column] < delta:
+                        delta = minimum[each_column]
+                        next_column = each_column
+
+            for each_column in xrange(width):
+                if used[each_column]:
+                    row_potential[assigned[each_column]] += delta
+                    column_potential[each_column] -= delta
+                else:
+                    minimum[each_column] -= delta
+
+            column = next_column
+            if assigned[column] == 0:
+                break
+
+        while column != 0:
+            previous = way[column]
+            assigned[column] = assigned[previous]
+            column = previous
+
+    return [best[(assigned[column], column)] for column in xrange(1, width)
+            if assigned[column] != 0 and (assigned[column], column) in best]
+
+
+def _idf(frequency, total):
+    # Inverse document frequency scaled to [0, 1], so that a value unique to one record keeps all its points.
+    if total <= 1 or frequency <= 1:
+        return 1.0
+
+    return math.log(float(total) / frequency) / math.log(total)
+
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+# Formats in which range mappings recognise dates, after trying to read a value as a number.
+_DATE_FORMATS = ["%Y-%m-%d", "%Y/%m/%d", "%m/%d/%Y"]
+_MINHASH_PRIME = (1 << 31) - 1
+# The universal hash functions (a * h + b) mod p from which MinHash signatures are built. These are seeded,
+# so that signatures are the same in every process and survive pickling.
+_minhash_random = random.Random(1777)
+_MINHASH_COEFFICIENTS = [(_minhash_random.randrange(1, _MINHASH_PRIME), _minhash_random.randrange(0, _MINHASH_PRIME))
+                         for i in range(ProcessedSource.MINHASH_LENGTH)]
+
+
+def _index_records(layout, start, records):
+    # Builds partial indexes over an iterable of record values dictionaries, numbering them from start.
+    # layout gives the keys to index for each index, with the settings from ProcessedSource.process().
+    partial = {"digests": {}, "signatures": {}, "numbers": {}}
+    for name in ProcessedSource.INDEXES:
+        partial[name] = dict((key, AdditiveDict()) for key in layout[name])
+    for key in layout["fuzzy"]:
+        partial["digests"][key] = bytearray()
+    for key in layout["tokens"]:
+        partial["signatures"][key] = array.array("I")
+    for key in layout["range"]:
+        partial["numbers"][key] = array.array("d")
+
+    exact = partial["exact"]
+    prefix = partial["prefix"]
+    fuzzy = partial["fuzzy"]
+    phonetic_index = partial["phonetic"]
+    edit = partial["edit"]
+    tokens_index = partial["tokens"]
+    strip_keys = layout["strip"]
+    prefix_len = layout["prefix_len"]
+    empty_digest = bytearray(ProcessedSource.DIGEST_LENGTH)
+    empty_signature = array.array("I", [0]) * ProcessedSource.MINHASH_LENGTH
+
+    # Indexes refer to records by their ordinal position in the source.
+    for (ordinal, values) in enumerate(records, start):
+        for key in layout["exact"]:
+            value = values[key]
+            if key in strip_keys:
+                value = value.strip().strip("\"'")
+
+            if len(value) > 0:
+                exact[key].append(value, ordinal)
+
+        for key in layout["prefix"]:
+            val = values[key]
+            if key in strip_keys:
+                val = val.strip().strip("\"'")
+
+            if len(val) > prefix_len:
+                for i in range(prefix_len, len(val)):
+                    prefix[key].append(val[:i], ordinal)
+
+        for key in layout["fuzzy"]:
+            value = values[key]
+            if key in strip_keys:
+                value = value.strip().strip("\"'")
+
+            if len(value) > 0:
+                n = nilsimsa.Nilsimsa(values[key].encode("utf-8"))
+                fuzzy[key].append(n.compare(ProcessedSource.NILSIMSA_DISTANCE_BASE), ordinal)
+                partial["digests"][key].extend(n.digest())
+            else:
+                partial["digests"][key].extend(empty_digest)
+
+        for key in layout["phonetic"]:
+            code = phonetic.phonetic_key(values[key])
+            if len(code) > 0:
+                phonetic_index[key].append(code, ordinal)
+
+        for key in layout["edit"]:
+            value = values[key]
+            if key in strip_keys:
+                value = value.strip().strip("\"'")
+
+            if len(value) > 0:
+                for variant in _deletions(value, layout["edit_distances"][key]):
+                    edit[key].append(variant, ordinal)
+
+        for key in layout["tokens"]:
+            tokens = _tokens(values[key])
+            if len(tokens) > 0:
+                signature = _minhash(tokens)
+                partial["signatures"][key].extend(signature)
+                for band in _bands(signature):
+                    tokens_index[key].append(band, ordinal)
+            else:
+                partial["signatures"][key].extend(empty_signature)
+
+        for key in layout["range"]:
+            value = values[key]
+            if key in strip_keys:
+                value = value.strip().strip("\"'")
+
+            number = _parse_number(value)
+            partial["numbers"][key].append(number if number is not None else float("nan"))
+
+    return partial
+
+
+def _index_records_packed(task):
+    # Runs _index_records() in a worker process.
+    return _pack_indexes(_index_records(*task))
+
+
+def _pack_indexes(state):
+    # Under Python 2, arrays pickle as lists of ints (and bytearrays as Unicode). Store raw bytes instead.
+    for name in ProcessedSource.INDEXES:
+        state[name] = dict((key, dict((value, postings.tostring()) for (value, postings) in index.iteritems()))
+                           for (key, index) in state[name].iteritems())
+    state["digests"] = dict((key, str(digests)) for (key, digests) in state["digests"].iteritems())
+    state["signatures"] = dict((key, signatures.tostring()) for (key, signatures) in state["signatures"].iteritems())
+    state["numbers"] = dict((key, numbers.tostring()) for (key, numbers) in state["numbers"].iteritems())
+    if "ranges" in state:
+        state["ranges"] = dict((key, (values.tostring(), ordinals.tostring()))
+                               for (key, (values, ordinals)) in state["ranges"].iteritems())
+
+    return state
+
+
+def _unpack_indexes(state):
+    for name in ProcessedSource.INDEXES:
+        for key in state[name]:
+            index = AdditiveDict()
+            for (value, postings) in state[name][key].iteritems():
+                index[value] = array.array("I", postings)
+            state[name][key] = index
+    state["digests"] = dict((key, bytearray(digests)) for (key, digests) in state["digests"].iteritems())
+    state["signatures"] = dict((key, array.array("I", signatures))
+                               for (key, signatures) in state["signatures"].iteritems())
+    state["numbers"] = dict((key, array.array("d", numbers)) for (key, numbers) in state["numbers"].iteritems())
+    if "ranges" in state:
+        state["ranges"] = dict((key, (array.array("d", values), array.array("I", ordinals)))
+                               for (key, (values, ordinals)) in state["ranges"].iteritems())
+
+    return state
+
+
+def _parse_number(value):
+    # Returns a range mapping's value as a number, or a date as its day number, or None if it is neither.
+    try:
+        number = float(value.replace(u",", u""))
+        return number if not (math.isnan(number) or math.isinf(number)) else None
+    except ValueError:
+        pass
+
+    for date_format in _DATE_FORMATS:
+        try:
+            return float(datetime.datetime.strptime(value, date_format).toordinal())
+        except ValueError:
+            pass
+
+    return None
+
+
+def _tokens(value):
+    return set(_TOKEN.findall(value.lower()))
+
+
+def _jaccard(a, b):
+    if len(a) == 0 or len(b) == 0:
+        return 0
+
+    return float(len(a & b)) / len(a | b)
+
+
+def _minhash(tokens):
+    hashes = [zlib.crc32(token.encode("utf-8")) & 0xffffffff for token in tokens]
+
+    return array.array("I", [min((a * h + b) % _MINHASH_PRIME for h in hashes) for (a, b) in _MINHASH_COEFFICIENTS])
+
+
+def _bands(signature):
+    rows = ProcessedSource.MINHASH_LENGTH / ProcessedSource.MINHASH_BANDS
+
+    for band in range(ProcessedSource.MINHASH_BANDS):
+        yield chr(band) + signature[band * rows:(band + 1) * rows].tostring()
+
+
+def _signature_similarity(a, b):
+    return float(sum(1 for (x, y) in zip(a, b) if x == y)) / len(a)
+
+
+def _deletions(value, distance):
+    # value and every string obtained by deleting up to distance characters from it.
+    variants = set([value])
+    edge = variants
+
+    for i in range(distance):
+        edge = set(variant[:j] + variant[j + 1:] for variant in edge for j in range(len(variant))) - variants
+        variants |= edge
+
+    return variants
+
+
+def _bounded_levenshtein(a, b, limit):
+    # The Levenshtein distance between a and b, or limit + 1 as soon as it is known to exceed limit.
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    if len(a) > len(b):
+        (a, b) = (b, a)
+
+    previous = range(len(b) + 1)
+    for (i, a_char) in enumerate(a, 1):
+        current = [i]
+        for (j, b_char) in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a_char != b_char)))
+
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+
+    return min(previous[-1], limit + 1)
+
+
 def _nilsimsa_ratio_as_percent(digest1, nilsimsa_obj):
     return (nilsimsa_obj.compare(digest1) + 127) / 255.0
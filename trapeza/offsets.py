@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+#  trapeza/offsets.py
+#
+#  Copyright 2013-2014 David Reed <david@ktema.org>
+#  This file is available under the terms of the MIT License.
+#
+
+# Random access to the records of a large file by primary key, without loading it. One pass over the file (see
+# Importer.index()) maps each primary key to the byte offset of its row; the map is kept beside the file, with
+# SUFFIX appended to its name, and rebuilt whenever the file's size or modification time no longer match. Lookups
+# parse only the requested rows, from an mmap of the file.
+
+import cPickle
+import mmap
+import os
+import tempfile
+import formats
+
+__all__ = ["OffsetIndexedSource"]
+
+
+class OffsetIndexedSource(object):
+    # A read-only stand-in for a Source with a primary key, offering headers(), primary_key(), get_record_with_id()
+    # and contains_record(). infile must be an uncompressed, seekable file in an indexable format.
+    SUFFIX = ".tidx"
+    # Bump whenever the layout of the index file changes.
+    FORMAT_VERSION = 1
+
+    def __init__(self, infile, filetype, primary_key, encoding="utf-8"):
+        (inner_filetype, compression) = formats.split_format(filetype)
+        importers = [importer for importer in formats.importers_for_format(filetype) if importer.indexable]
+        if compression is not None or len(importers) == 0:
+            raise Exception("Only uncompressed files of an indexable format can be indexed ({} is {}).".format(
+                infile.name, filetype))
+
+        if os.fstat(infile.fileno()).st_size == 0:
+            raise Exception("Cannot index the empty file {}.".format(infile.name))
+
+        self.infile = infile
+        self.filetype = inner_filetype
+        self.encoding = encoding
+        self.__primary_key = primary_key
+        self.importer = importers[0]()
+        self.buffer = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index_path = infile.name + OffsetIndexedSource.SUFFIX
+
+        self.__headers = None
+        self.offsets = None
+        self.built = False
+        self.__load() or self.__build()
+
+    def headers(self):
+        return self.__headers
+
+    def primary_key(self):
+        return self.__primary_key
+
+    def ids(self):
+        return self.offsets.iterkeys()
+
+    def get_record_with_id(self, key):
+        offset = self.offsets.get(key)
+        if offset is None:
+            return None
+
+        record = self.importer.read_record(self.buffer, offset, self.filetype, self.__headers, self.encoding)
+        record.primary_key = self.__primary_key
+
+        return record
+
+    def contains_record(self, record):
+        # Identity is by primary key alone, as in a Source with a primary key.
+        if record.values.get(self.__primary_key) is None:
+            raise Exception("Record {} is missing the primary key {}.".format(record, self.__primary_key))
+
+        return record.values[self.__primary_key] in self.offsets
+
+    def close(self):
+        self.buffer.close()
+
+    def __settings(self):
+        status = os.fstat(self.infile.fileno())
+
+        return {"version": OffsetIndexedSource.FORMAT_VERSION, "size": status.st_size, "mtime": status.st_mtime,
+                "filetype": self.filetype, "encoding": self.encoding, "primary_key": self.__primary_key}
+
+    def __load(self):
+        # Returns True if a valid index was read.
+        try:
+            with open(self.index_path, "rb") as index_file:
+                (settings, headers, offsets) = cPickle.load(index_file)
+        except Exception:
+            # A missing or corrupt index; rebuild it.
+            return False
+
+        if settings != self.__settings():
+            return False
+
+        (self.__headers, self.offsets) = (headers, offsets)
+
+        return True
+
+    def __build(self):
+        settings = self.__settings()
+        (self.__headers, self.offsets) = self.importer.index(self.buffer, self.filetype, self.__primary_key,
+                                                             self.encoding)
+        self.built = True
+
+        # Failing to save the index (e.g. beside a read-only file) costs only the next run a rebuild.
+        try:
+            (handle, temporary_path) = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(self.index_path) or ".")
+        except OSError:
+            return
+
+        try:
+            with os.fdopen(handle, "wb") as index_file:
+                cPickle.dump((settings, self.__headers, self.offsets), index_file, cPickle.HIGHEST_PROTOCOL)
+
+            if os.name == "nt" and os.path.exists(self.index_path):
+                # Windows cannot rename over an existing file.
+                os.remove(self.index_path)
+            os.rename(temporary_path, self.index_path)
+        except (IOError, OSError):
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+#
+#  trapeza/phonetic.py
+#
+#  Copyright 2013-2014 David Reed <david@ktema.org>
+#  This file is available under the terms of the MIT License.
+#
+
+import re
+import unicodedata
+
+__all__ = ["soundex", "phonetic_key"]
+
+_SOUNDEX_CODES = {}
+for (letters, code) in [(u"bfpv", u"1"), (u"cgjkqsxz", u"2"), (u"dt", u"3"), (u"l", u"4"), (u"mn", u"5"), (u"r", u"6")]:
+    for letter in letters:
+        _SOUNDEX_CODES[letter] = code
+
+_WORD_SEPARATOR = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def _fold(value):
+    # Strip accents, so that e.g. "Zoë" codes as "Zoe".
+    return u"".join(c for c in unicodedata.normalize("NFKD", value) if not unicodedata.combining(c))
+
+
+def soundex(word):
+    # American Soundex. Letters outside a-z (after folding accents) are ignored; a word without any
+    # codes to the empty string.
+    letters = [c for c in _fold(word).lower() if u"a" <= c <= u"z"]
+    if len(letters) == 0:
+        return u""
+
+    code = letters[0].upper()
+    last = _SOUNDEX_CODES.get(letters[0], u"")
+
+    for letter in letters[1:]:
+        digit = _SOUNDEX_CODES.get(letter)
+        if digit is None:
+            # Vowels separate letters with the same code; h and w do not.
+            if letter not in u"hw":
+                last = u""
+            continue
+
+        if digit != last:
+            code += digit
+            if len(code) == 4:
+                break
+        last = digit
+
+    return (code + u"000")[:4]
+
+
+def phonetic_key(value):
+    # The Soundex codes of each word in value, in order.
+    return u" ".join(code for code in (soundex(word) for word in _WORD_SEPARATOR.split(value)) if len(code) > 0)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+#  trapeza/pipeline.py
+#
+#  Copyright 2013-2014 David Reed <david@ktema.org>
+#  This file is available under the terms of the MIT License.
+#
+
+# Runs the read, transform and write stages of a job concurrently, so that it takes about as long as its slowest
+# stage rather than the sum of all three. Stages pass batches through bounded queues: a stage that gets ahead
+# blocks until the next catches up, so memory use is bounded by the queue depth, not the size of the input.
+
+import Queue
+import collections
+import multiprocessing
+import sys
+import threading
+
+__all__ = ["pipeline", "process_pool", "parallel_map", "batches"]
+
+_DONE = object()
+
+
+class _Stopped(Exception):
+    # Raised to a stage reading from a queue once another stage has failed, so that it cannot mistake the end of its
+    # input for completion.
+    pass
+
+
+def batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if len(batch) > 0:
+        yield batch
+
+
+def pipeline(items, transform, consume, depth=4):
+    # Iterates over items in a reader thread and calls consume with an iterable of results in a writer thread,
+    # while the calling thread passes an iterable of items to transform, which returns an iterable of results. Each
+    # queue holds at most depth entries. If any stage fails, the others stop (their input raising an exception,
+    # rather than ending) and its exception is raised here.
+    inbound = Queue.Queue(depth)
+    outbound = Queue.Queue(depth)
+    failed = threading.Event()
+    errors = []
+
+    def put(queue, item):
+        # Blocks while the queue is full. Returns False, without waiting further, if another stage has failed.
+        while not failed.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+
+        return False
+
+    def take(queue):
+        # Yields items until _DONE. Raises _Stopped if another stage has failed.
+        while not failed.is_set():
+            try:
+                item = queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+
+            if item is _DONE:
+                return
+            yield item
+
+        raise _Stopped()
+
+    def read():
+        for item in items:
+            if not put(inbound, item):
+                return
+        put(inbound, _DONE)
+
+    def match():
+        for result in transform(take(inbound)):
+            if not put(outbound, result):
+                return
+        put(outbound, _DONE)
+
+    def write():
+        consume(take(outbound))
+
+    def run(stage):
+        try:
+            stage()
+        except BaseException:
+            errors.append(sys.exc_info())
+            failed.set()
+
+    threads = [threading.Thread(target=run, args=(stage,)) for stage in [read, write]]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    run(match)
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def process_pool(function, jobs):
+    # A pool of jobs processes for parallel_map() to run function in. The workers are started by forking, so function
+    # need not be picklable. Create the pool before starting any threads (such as pipeline()'s): a process forked
+    # while another thread holds a lock can deadlock. The caller terminates and joins the pool when done.
+    return multiprocessing.Pool(jobs, _set_function, (function,))
+
+
+def parallel_map(pool, items, window):
+    # Like itertools.imap(function, items), for the function of a process_pool(). At most window items are in flight
+    # at once, so that a slow consumer holds back the producer. Items and results must be picklable.
+    pending = collections.deque()
+
+    for item in items:
+        pending.append(pool.apply_async(_call, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+_function = None
+
+
+def _set_function(function):
+    # Runs in each worker process of a process_pool().
+    global _function
+    _function = function
+
+
+def _call(item):
+    return _function(item)
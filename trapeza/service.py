@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+#
+#  trapeza/service.py
+#  
+#  Copyright 2013-2014 David Reed <david@ktema.org>
+#  This file is available under the terms of the MIT License.
+#
+
+# A long-running match service holding a ProcessedSource in memory, and a client for it.
+#
+# Clients connect over a Unix socket (address is a path) or to localhost TCP (address is host:port) and
+# send requests as lines of JSON: {"headers": [...], "rows": [[...], ...], "lines": [...], "cutoff": n}.
+# The service replies to each request with one JSON line per result, {"line": l, "id": id, "score": s},
+# followed by {"done": true, "count": n}, or with {"error": message}. Many requests may be sent on one
+# connection. Requests from all clients are queued for a single matching thread, which takes every
+# request waiting at once as a batch: records in the batch with the same values in the columns the profile
+# reads are scored only once. The service is unauthenticated, so it listens only on localhost.
+
+import Queue
+import SocketServer
+import json
+import os
+import pipeline
+import re
+import socket
+import threading
+import stats
+import trapeza
+
+__all__ = ["MatchService", "serve", "match_remote", "match_shards", "merge_results", "parse_address"]
+
+
+LOCAL_HOSTS = ["", "localhost", "127.0.0.1"]
+
+_HOST_PORT = re.compile(r"^([^:]*):(\d+)$")
+
+
+def parse_address(address):
+    # Returns (family, address) for a Unix socket path or a host:port pair. Anything containing a path separator,
+    # or not of the form host:port, is a path.
+    host_port = _HOST_PORT.match(address)
+    if host_port is None or os.path.sep in address:
+        return (socket.AF_UNIX, address)
+
+    (host, port) = host_port.groups()
+    if host not in LOCAL_HOSTS:
+        raise Exception("The match service is only available on localhost, not {} (give a Unix socket in the current "
+                        "directory as ./{}).".format(host, address))
+
+    return (socket.AF_INET, ("127.0.0.1", int(port)))
+
+
+class MatchService(object):
+    def __init__(self, processed):
+        self.processed = processed
+        self.profile = processed.profile
+        self.requests = Queue.Queue()
+        self.plans = {}
+        self.worker = threading.Thread(target=self.__run)
+        self.worker.daemon = True
+
+    def start(self):
+        self.worker.start()
+
+    def submit(self, records, cutoff=0):
+        # Blocks until the matching thread has handled this request, and returns a list of
+        # (input line, master record id, score) tuples.
+        reply = Queue.Queue(1)
+        self.requests.put((records, cutoff, reply))
+        result = reply.get()
+
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+    def match(self, records, cutoff=0, scored=None):
+        # scored, if given, holds the scores already found for records' values at this cutoff, and is shared by
+        # the requests of a batch.
+        if cutoff not in self.plans:
+            self.plans[cutoff] = self.profile.plan(self.processed, cutoff)
+        if scored is None:
+            scored = {}
+
+        columns = self.profile.columns(False)
+        results = []
+        for record in records:
+            values = (cutoff,) + tuple(record.values[column] for column in columns)
+            if values not in scored:
+                scored[values] = [(self.processed.record(ordinal).record_id(), score) for (ordinal, score)
+                                  in self.profile._score_record(self.processed, record, self.plans[cutoff],
+                                                                cutoff).iteritems()]
+            else:
+                stats.current.count("service.shared")
+
+            for (record_id, score) in scored[values]:
+                results.append((record.input_line(), record_id, score))
+
+        return results
+
+    def __run(self):
+        while True:
+            batch = [self.requests.get()]
+            while True:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except Queue.Empty:
+                    break
+
+            stats.current.count("service.batches")
+            stats.current.count("service.requests", len(batch))
+
+            scored = {}
+            for (records, cutoff, reply) in batch:
+                try:
+                    reply.put(self.match(records, cutoff, scored))
+                except Exception as e:
+                    reply.put(e)
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            try:
+                request = json.loads(line)
+                headers = request["headers"]
+                records = [trapeza.Record(dict(zip(headers, row)), inputline=input_line)
+                           for (row, input_line) in zip(request["rows"], request["lines"])]
+                results = self.server.service.submit(records, request.get("cutoff", 0))
+            except Exception as e:
+                self.wfile.write(json.dumps({"error": str(e)}) + "\n")
+                return
+
+            for (input_line, record_id, score) in results:
+                self.wfile.write(json.dumps({"line": input_line, "id": record_id, "score": score}) + "\n")
+            self.wfile.write(json.dumps({"done": True, "count": len(results)}) + "\n")
+            self.wfile.flush()
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(processed, address, ready=None):
+    # Serves until interrupted. If provided, ready is called with the server once it is listening.
+    (family, bind_address) = parse_address(address)
+    service = MatchService(processed)
+
+    if family == socket.AF_UNIX:
+        if os.path.exists(bind_address):
+            os.unlink(bind_address)
+        server = _UnixServer(bind_address, _Handler)
+    else:
+        server = _TCPServer(bind_address, _Handler)
+
+    server.service = service
+    service.start()
+
+    try:
+        if ready is not None:
+            ready(server)
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if family == socket.AF_UNIX and os.path.exists(bind_address):
+            os.unlink(bind_address)
+
+
+def match_remote(address, headers, records, cutoff=0, batch_size=1000):
+    # Sends records to the service at address in batches, yielding (input line, master record id, score)
+    # tuples as results arrive.
+    (connection, reader, writer) = _connect(address)
+
+    try:
+        for batch in pipeline.batches(records, batch_size):
+            _send(writer, headers, batch, cutoff)
+            for result in _receive(reader):
+                yield result
+    finally:
+        reader.close()
+        writer.close()
+        connection.close()
+
+
+def match_shards(addresses, headers, records, cutoff=0, batch_size=1000):
+    # As match_remote(), but each batch is sent to all of the services at addresses, each serving one shard of a
+    # master (see trapeza.shards), which match it in parallel. Their results are merged with merge_results().
+    connections = []
+
+    try:
+        for address in addresses:
+            connections.append(_connect(address))
+
+        for batch in pipeline.batches(records, batch_size):
+            for (connection, reader, writer) in connections:
+                _send(writer, headers, batch, cutoff)
+
+            shard_results = [list(_receive(reader)) for (connection, reader, writer) in connections]
+            for result in merge_results(batch, shard_results):
+                yield result
+    finally:
+        for (connection, reader, writer) in connections:
+            reader.close()
+            writer.close()
+            connection.close()
+
+
+def merge_results(records, results):
+    # Merges lists of (input line, master record id, score) tuples for the same records, one from each shard, into
+    # one list in the order of records. Every master record belongs to exactly one shard, and is scored there just
+    # as it would be by the whole master, so each shard has already applied the cutoff correctly.
+    found = dict((record.input_line(), []) for record in records)
+
+    for shard_results in results:
+        for result in shard_results:
+            found[result[0]].append(result)
+
+    return [result for record in records for result in found.pop(record.input_line(), [])]
+
+
+def _connect(address):
+    (family, connect_address) = parse_address(address)
+    connection = socket.socket(family, socket.SOCK_STREAM)
+    connection.connect(connect_address)
+
+    return (connection, connection.makefile("rb"), connection.makefile("wb"))
+
+
+def _send(writer, headers, records, cutoff):
+    writer.write(json.dumps({"headers": headers,
+                             "rows": [[record.values[header] for header in headers] for record in records],
+                             "lines": [record.input_line() for record in records],
+                             "cutoff": cutoff}) + "\n")
+    writer.flush()
+
+
+def _receive(reader):
+    for line in iter(reader.readline, ""):
+        response = json.loads(line)
+        if "error" in response:
+            raise Exception("The match service reported an error: {}".format(response["error"]))
+        if response.get("done"):
+            return
+
+        yield (response["line"], response["id"], response["score"])
+
+    raise Exception("The match service closed the connection unexpectedly.")
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+#  trapeza/shards.py
+#
+#  Copyright 2013-2014 David Reed <david@ktema.org>
+#  This file is available under the terms of the MIT License.
+#
+
+# A master processed in shards, so that no one process need hold every index in memory. Records are partitioned
+# by a hash of their primary key, and each shard is a ProcessedSource of its own, told the size of the whole master
+# and the frequencies of its exact values there: stop values and IDF weights are then those of the whole master,
+# and every master record scores in its shard exactly as it would in a single index. Incoming records are matched
+# against every shard and the results merged (see service.merge_results()).
+
+import cPickle
+import multiprocessing
+import os
+import zlib
+import match
+import service
+import trapeza
+
+__all__ = ["shard_of", "process_shards", "ShardManifest", "ShardPool"]
+
+
+def shard_of(record_id, count):
+    return (zlib.crc32(record_id.encode("utf-8")) & 0xffffffff) % count
+
+
+def process_shards(source, profile, count, stop_value_limit=None, jobs=1):
+    # Yields a processed shard for each of count partitions of source, which must have a primary key. Shards are
+    # processed one at a time, so that each may be written out and released before the next is built.
+    shards = [trapeza.Source(source.headers()) for i in range(count)]
+    for record in source.records():
+        shards[shard_of(record.record_id(), count)].add_record(record)
+
+    # Count exact values over the whole master, stripping them just as ProcessedSource.process() does.
+    strip_keys = set(mapping.master_key for mapping in profile.mappings if mapping.strip)
+    frequencies = {}
+    for mapping in profile.mappings:
+        if mapping.compare in [match.COMPARE_EXACT, match.COMPARE_PREFIX]:
+            frequencies[mapping.master_key] = {}
+
+    for record in source.records():
+        for (key, counts) in frequencies.iteritems():
+            value = record.values[key]
+            if key in strip_keys:
+                value = value.strip().strip("\"'")
+            if len(value) > 0:
+                counts[value] = counts.get(value, 0) + 1
+
+    for shard in shards:
+        shard.set_primary_key(source.primary_key())
+        processed = match.ProcessedSource(shard, True, profile, stop_value_limit)
+        processed.total_records = len(source.records())
+        processed.total_frequencies = frequencies
+        processed.process(jobs)
+
+        yield processed
+
+
+class ShardManifest(object):
+    # Written by trapeza-process in place of a processed master when it writes shards. Paths are relative to the
+    # directory holding the manifest.
+    def __init__(self, paths, profile):
+        self.paths = paths
+        self.profile = profile
+
+    def resolve(self, manifest_path):
+        return [os.path.join(os.path.dirname(manifest_path), path) for path in self.paths]
+
+
+class ShardPool(object):
+    # A worker process for each shard, which loads it from disk and matches batches of records against it.
+    def __init__(self, paths):
+        self.connections = []
+        self.workers = []
+
+        for path in paths:
+            (connection, worker_connection) = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_match_shard, args=(path, worker_connection))
+            worker.daemon = True
+            worker.start()
+            worker_connection.close()
+
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def match(self, records, cutoff=0, batch_size=1000):
+        # Yields (input line, master record id, score) tuples, in the order of records.
+        for start in xrange(0, len(records), batch_size):
+            batch = records[start:start + batch_size]
+            for connection in self.connections:
+                connection.send((batch, cutoff))
+
+            results = [connection.recv() for connection in self.connections]
+            for shard_results in results:
+                if isinstance(shard_results, Exception):
+                    raise shard_results
+
+            for result in service.merge_results(batch, results):
+                yield result
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except (IOError, OSError):
+                pass
+            connection.close()
+
+        for worker in self.workers:
+            worker.join()
+
+
+def _match_shard(path, connection):
+    # Runs in a worker process: replies to each (records, cutoff) request with a list of results, or an exception.
+    try:
+        with open(path, "rb") as shard_file:
+            shard = service.MatchService(cPickle.load(shard_file))
+    except Exception as e:
+        shard = Exception("Unable to load shard {}: {}".format(path, e))
+
+    for request in iter(connection.recv, None):
+        if isinstance(shard, Exception):
+            connection.send(shard)
+            continue
+
+        try:
+            connection.send(shard.match(*request))
+        except Exception as e:
+            connection.send(Exception(str(e)))
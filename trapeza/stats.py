@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+#  trapeza/stats.py
+#  
+#  Copyright 2013-2014 David Reed <david@ktema.org>
+#  This file is available under the terms of the MIT License.
+#
+
+# Lightweight instrumentation. Library code reports to stats.current, which is a NullStats (whose methods do
+# nothing) unless enable() has been called. Hot loops should wrap their iterables with track() and accumulate
+# counters locally, reporting them once, so that the disabled case costs next to nothing.
+
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__all__ = ["Stats", "NullStats", "current", "enable", "disable"]
+
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on OS X and kilobytes elsewhere.
+    return peak / 1024 if sys.platform == "darwin" else peak
+
+
+class _Stage(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.add_stage(self.name, time.time() - self.start, _peak_rss_kb())
+        return False
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class Stats(object):
+    enabled = True
+
+    def __init__(self, progress=False, progress_stream=None, progress_interval=1.0):
+        self.stages = []
+        self.counters = {}
+        self.show_progress = progress
+        self.progress_stream = progress_stream or sys.stderr
+        self.progress_interval = progress_interval
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def add_stage(self, name, seconds, peak_rss_kb=None):
+        self.stages.append({"name": name, "seconds": seconds, "peak_rss_kb": peak_rss_kb})
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        self.counters[name] = value
+
+    def track(self, label, iterable):
+        rows = 0
+        start = last = time.time()
+
+        for item in iterable:
+            rows += 1
+            if self.show_progress and rows % 1000 == 0:
+                now = time.time()
+                if now - last >= self.progress_interval:
+                    self.__report(label, rows, now - start, "\r")
+                    last = now
+
+            yield item
+
+        self.count("rows.{}".format(label), rows)
+        if self.show_progress:
+            self.__report(label, rows, time.time() - start, "\n")
+
+    def __report(self, label, rows, elapsed, end):
+        self.progress_stream.write("\r{}: {} rows ({:.0f} rows/sec){}".format(label,
+                                                                              rows,
+                                                                              rows / elapsed if elapsed > 0 else 0,
+                                                                              end))
+        self.progress_stream.flush()
+
+    def as_dict(self):
+        return {"stages": self.stages, "counters": self.counters, "peak_rss_kb": _peak_rss_kb()}
+
+    def write(self, file_like_object):
+        json.dump(self.as_dict(), file_like_object, indent=2, sort_keys=True)
+        file_like_object.write("\n")
+
+
+class NullStats(object):
+    enabled = False
+
+    __stage = _NullStage()
+
+    def stage(self, name):
+        return self.__stage
+
+    def add_stage(self, name, seconds, peak_rss_kb=None):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def track(self, label, iterable):
+        return iterable
+
+
+current = NullStats()
+
+
+def enable(**kwargs):
+    global current
+
+    current = Stats(**kwargs)
+    return current
+
+
+def disable():
+    global current
+
+    current = NullStats()
@@ -8,8 +8,13 @@
 
 import os
 import formats
+import stats
 
-__all__ = ["Record", "Source", "get_format", "load_source", "sources_consistent", "unify_sources", "write_source"]
+# Kept in step with setup.py.
+__version__ = "0.1"
+
+__all__ = ["Record", "Source", "get_format", "load_source", "iterate_source", "sources_consistent", "unify_sources",
+           "write_source", "write_records"]
 
 
 class Record(object):
@@ -151,26 +156,83 @@ class Source(object):
 
 
 def get_format(path, default="csv"):
-    ext = os.path.splitext(path)[1][1:]
+    # Compressed files have compound formats, such as csv.gz. A compressed file with no other extension is taken
+    # to be in the default format.
+    (root, ext) = os.path.splitext(path)
+    ext = ext[1:].lower()
+
+    if ext in formats.compression.COMPRESSIONS:
+        return "{}.{}".format(os.path.splitext(root)[1][1:].lower() or formats.split_format(default)[0], ext)
 
     if len(ext) > 0:
-        return ext.lower()
+        return ext
                 
     return default
 
 
-def load_source(infile, filetype, sheet_name=None, encoding="utf-8"):
+def load_source(infile, filetype, sheet_name=None, encoding="utf-8", columns=None, predicate=None):
+    # If columns is given, only those columns (where present) are loaded. If predicate is given, only records
+    # for which it returns True are kept; the others are discarded as they are read.
     if len(formats.importers_for_format(filetype)) == 0:
         raise Exception("No importer available for file {} (type {}).\n".format(infile.name, filetype))
+
+    if predicate is not None:
+        (headers, records) = iterate_source(infile, filetype, sheet_name, encoding, columns)
+        source = Source(headers)
+        for record in records:
+            if predicate(record):
+                source.add_record(record)
+
+        return source
+
+    (filetype, compression) = formats.split_format(filetype)
+    if compression is not None:
+        infile = formats.CompressedReader(infile, compression)
     
-    return formats.importers_for_format(filetype)[0]().read(infile, filetype, sheet_name, encoding)
-    
+    return formats.importers_for_format(filetype)[0]().read(infile, filetype, sheet_name, encoding, columns)
+
+
+def iterate_source(infile, filetype, sheet_name=None, encoding="utf-8", columns=None):
+    # Returns a tuple (headers, records), where records is an iterator that parses rows as they are consumed.
+    if len(formats.importers_for_format(filetype)) == 0:
+        raise Exception("No importer available for file {} (type {}).\n".format(infile.name, filetype))
+
+    (filetype, compression) = formats.split_format(filetype)
+    if compression is not None:
+        infile = formats.CompressedReader(infile, compression)
+
+    (headers, records) = formats.importers_for_format(filetype)[0]().iterate(infile, filetype, sheet_name, encoding,
+                                                                             columns)
+
+    return (headers, stats.current.track("load", records))
+
 
 def write_source(source, outfile, filetype, sheet_name=None, encoding="utf-8", **kwd):
     if len(formats.importers_for_format(filetype)) == 0:
         raise Exception("No exporter available for format {}.".format(filetype))
+
+    (filetype, compression) = formats.split_format(filetype)
+    output = formats.CompressedWriter(outfile, compression) if compression is not None else outfile
         
-    formats.exporters_for_format(filetype)[0]().write(source, outfile, filetype, sheet_name, encoding, **kwd)
+    formats.exporters_for_format(filetype)[0]().write(source, output, filetype, sheet_name, encoding, **kwd)
+
+    if compression is not None:
+        output.close()
+
+
+def write_records(headers, records, outfile, filetype, sheet_name=None, encoding="utf-8", **kwd):
+    # Like write_source(), but consumes any iterable of records, writing them out as they are produced.
+    if len(formats.exporters_for_format(filetype)) == 0:
+        raise Exception("No exporter available for format {}.".format(filetype))
+
+    (filetype, compression) = formats.split_format(filetype)
+    output = formats.CompressedWriter(outfile, compression) if compression is not None else outfile
+
+    formats.exporters_for_format(filetype)[0]().write_records(headers, records, output, filetype, sheet_name, encoding,
+                                                              **kwd)
+
+    if compression is not None:
+        output.close()
 
 
 def sources_consistent(sources):